@@ -0,0 +1,205 @@
+# actions.py
+# Extracted actions: the task/deadline/assignee schema, and turning a model
+# reply into a validated list. The extract_actions call asks for JSON output
+# where the model supports it (llm.json_request); replies that still come
+# back wrapped in prose or code fences, or with trailing commas, are repaired
+# locally (utils.extract_json). Only a reply that can't be repaired costs one
+# more, short, model call that asks for the JSON again.
+
+import os
+import threading
+
+import metrics
+from llm import LLM_JSON_MODE, acall_llm, call_llm, is_error_reply
+from utils import extract_json
+
+ACTIONS_REPAIR_CALLS = int(os.getenv("ACTIONS_REPAIR_CALLS", "1"))  # model retries for unparseable replies
+ACTIONS_MAX_TOKENS = 400
+ACTION_FIELDS = ("task", "deadline", "assignee")
+TASK_MAX_CHARS = 500
+
+_ACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "task": {"type": "string"},
+        "deadline": {"type": ["string", "null"]},
+        "assignee": {"type": ["string", "null"]},
+    },
+    "required": list(ACTION_FIELDS),
+    "additionalProperties": False,
+}
+
+# JSON mode only produces objects, so the array is wrapped in {"actions": ...}
+ACTIONS_SCHEMA = {
+    "title": "actions",
+    "type": "object",
+    "properties": {"actions": {"type": "array", "items": _ACTION_SCHEMA}},
+    "required": ["actions"],
+    "additionalProperties": False,
+}
+
+REPAIR_PROMPT = (
+    "Your reply above could not be read as JSON. Answer again with only a JSON object "
+    'in this shape and nothing else: {"actions": [{"task": "...", "deadline": "...", "assignee": "..."}]}. '
+    'Use null for an unknown deadline or assignee, and {"actions": []} if there are no actions.'
+)
+REPAIR_REPLY_CHARS = 4000  # of the unreadable reply, quoted back in the repair call
+
+# Parse outcomes: "ok" (valid as sent), "repaired" (fixed locally), "retried"
+# (needed the repair call), "failed" (no valid list, actions_json is null)
+PARSE_OUTCOMES = ("ok", "repaired", "retried", "failed")
+
+_NULLS = {"", "null", "none", "n/a", "na", "-", "unknown", "not specified", "tbd"}
+
+_stats_lock = threading.Lock()
+_stats = {outcome: 0 for outcome in PARSE_OUTCOMES}  # per process
+
+
+# ---------- VALIDATION ----------
+
+def _optional_text(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    return None if value.lower() in _NULLS else value
+
+
+def normalize_action(item):
+    """
+    One action as {"task", "deadline", "assignee"}, or None if it has no task.
+    Keys are matched case-insensitively, other keys are dropped, and empty or
+    placeholder deadlines/assignees ("", "N/A", "none") become null.
+    """
+    if isinstance(item, str):
+        item = {"task": item}
+    if not isinstance(item, dict):
+        return None
+    fields = {str(k).strip().lower(): v for k, v in item.items()}
+    task = fields.get("task")
+    if not isinstance(task, str) or not task.strip() or len(task) > TASK_MAX_CHARS:
+        return None
+    return {
+        "task": task.strip(),
+        "deadline": _optional_text(fields.get("deadline")),
+        "assignee": _optional_text(fields.get("assignee")),
+    }
+
+
+def validate(value):
+    """
+    The action list in a parsed reply: a bare array, {"actions": [...]} (JSON
+    mode), another object holding a single array, or a single action object.
+    Returns (actions, changed) where changed says something had to be fixed
+    (dropped items or keys, coerced values); actions is None if nothing fits.
+    """
+    if isinstance(value, dict):
+        lists = [v for v in value.values() if isinstance(v, list)]
+        if isinstance(value.get("actions"), list):
+            items, changed = value["actions"], len(value) > 1
+        elif len(lists) == 1:
+            items, changed = lists[0], True
+        elif normalize_action(value) is not None:
+            items, changed = [value], True
+        else:
+            return None, False
+    elif isinstance(value, list):
+        items, changed = value, False
+    else:
+        return None, False
+
+    actions = [normalize_action(item) for item in items]
+    valid = [a for a in actions if a is not None]
+    if items and not valid:
+        return None, False
+    changed = changed or len(valid) != len(items) or any(a != item for a, item in zip(actions, items))
+    return valid, changed
+
+
+def parse(reply):
+    """(actions or None, "ok" | "repaired" | "failed") for one model reply, without any model call."""
+    if is_error_reply(reply):
+        return None, "failed"
+    value, repaired = extract_json(reply)
+    actions, changed = validate(value)
+    if actions is None:
+        return None, "failed"
+    return actions, "repaired" if repaired or changed else "ok"
+
+
+# ---------- EXTRACTION ----------
+
+def _repair_messages(prompt, reply):
+    return [
+        {"role": "user", "content": prompt},
+        {"role": "assistant", "content": reply[:REPAIR_REPLY_CHARS]},
+        {"role": "user", "content": REPAIR_PROMPT},
+    ]
+
+
+def extract(prompt, use_cache=True, priority="interactive", info=None):
+    """
+    The extract_actions call for a rendered prompt: returns (reply, actions, outcome).
+    reply is the model text (an error placeholder if the call failed), actions
+    the validated list or None, outcome one of PARSE_OUTCOMES ("failed" also
+    when the call itself failed; see is_error_reply(reply)).
+    """
+    messages = [{"role": "user", "content": prompt}]
+    reply = call_llm(messages, ACTIONS_MAX_TOKENS, use_cache, priority, "extract_actions", info, ACTIONS_SCHEMA)
+    actions, outcome = parse(reply)
+    if outcome == "failed" and not is_error_reply(reply):
+        for attempt in range(ACTIONS_REPAIR_CALLS):
+            # later attempts skip the cache, which holds the previous attempt's reply
+            retry = call_llm(
+                _repair_messages(prompt, reply), ACTIONS_MAX_TOKENS, use_cache and attempt == 0, priority,
+                "extract_actions", info, ACTIONS_SCHEMA,
+            )
+            retried, _ = parse(retry)
+            if retried is not None:
+                return retry, retried, "retried"
+    return reply, actions, outcome
+
+
+async def aextract(prompt, use_cache=True, priority="interactive", info=None):
+    """extract() for coroutines."""
+    messages = [{"role": "user", "content": prompt}]
+    reply = await acall_llm(
+        messages, ACTIONS_MAX_TOKENS, use_cache, priority, "extract_actions", info, ACTIONS_SCHEMA
+    )
+    actions, outcome = parse(reply)
+    if outcome == "failed" and not is_error_reply(reply):
+        for attempt in range(ACTIONS_REPAIR_CALLS):
+            retry = await acall_llm(
+                _repair_messages(prompt, reply), ACTIONS_MAX_TOKENS, use_cache and attempt == 0, priority,
+                "extract_actions", info, ACTIONS_SCHEMA,
+            )
+            retried, _ = parse(retry)
+            if retried is not None:
+                return retry, retried, "retried"
+    return reply, actions, outcome
+
+
+# ---------- STATS ----------
+
+def record(outcome, mode):
+    """Count one processed email's parse outcome (process result "actions_parse")."""
+    with _stats_lock:
+        _stats[outcome] += 1
+    metrics.ACTIONS_PARSE.inc(mode=mode, result=outcome)
+
+
+def parse_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    replies = sum(stats.values())
+    parsed = replies - stats["failed"]
+    return dict(
+        stats,
+        replies=replies,
+        success_rate=round(parsed / replies, 4) if replies else None,
+        # parsed without the repair call, i.e. no extra round-trip
+        first_pass_rate=round((stats["ok"] + stats["repaired"]) / replies, 4) if replies else None,
+        repair_calls=ACTIONS_REPAIR_CALLS,
+        json_mode=LLM_JSON_MODE,
+    )
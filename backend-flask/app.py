@@ -1,13 +1,27 @@
 # app.py
+import gzip
 import json
 import os
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, jsonify, request, send_from_directory, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 
-from db import init_db, get_connection
-from llm import call_llm
+import actions
+import budget
+import classifier
+import drafts
+import export
+import inbox
+import jobs
+import metrics
+import microbatch
+import similar
+from db import db_time_ms, init_db, get_connection, invalidate_prompt_cache, reset_db_time
+from ingest import INGEST_FORMATS, ingest_stream
+from llm import cache_clear, cache_stats, call_llm, is_error_reply, routing_stats, scheduler_stats, stream_llm
+from pipeline import BATCH_CONCURRENCY, PROCESS_MODES, load_templates, process_many, process_one
+from search import SEARCH_LIMIT_DEFAULT, SearchUnavailable, search_emails
 
 load_dotenv()
 
@@ -17,16 +31,35 @@ CORS(app)  # allow all origins for dev
 # Ensure DB exists when app starts
 init_db()
 
-BASE_DIR = os.path.dirname(__file__)
-DATA_DIR = os.path.join(BASE_DIR, "data")
-MOCK_INBOX_PATH = os.path.join(DATA_DIR, "mock_inbox.json")
 
+@app.before_request
+def ensure_background_threads():
+    # Started on the first request, never at import: importing app (asgi.py,
+    # scripts, a gunicorn --preload master) must not start threads that make
+    # LLM calls, since a fork while one holds a lock deadlocks the child
+    jobs.start_workers()
+    inbox.start_watcher()
 
-def safe_json_loads(s, fallback=None):
-    try:
-        return json.loads(s)
-    except Exception:
-        return fallback
+
+@app.before_request
+def start_request_timers():
+    reset_db_time()
+    metrics.begin_request()
+
+
+@app.after_request
+def add_server_timing(resp):
+    # streamed bodies: only the part before streaming starts is measured
+    timings, seconds = metrics.end_request()
+    db_ms = db_time_ms()
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.HTTP_DURATION.observe(seconds, method=request.method, endpoint=endpoint, status=resp.status_code)
+    metrics.DB_REQUEST_TIME.observe(db_ms / 1000, endpoint=endpoint)
+    timings.update(db=db_ms, total=seconds * 1000)
+    resp.headers.add("Server-Timing", metrics.server_timing_header(timings))
+    return resp
+
+DATA_DIR = inbox.DATA_DIR
 
 
 # ---------- HEALTH CHECK ----------
@@ -36,13 +69,165 @@ def health():
     return jsonify({"status": "ok", "env_has_api_key": bool(os.getenv("OPENAI_API_KEY"))})
 
 
+# ---------- METRICS ----------
+
+@app.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    """Prometheus scrape endpoint (values are per backend process)."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 # ---------- INBOX ----------
 
 @app.route("/api/inbox", methods=["GET"])
 def get_inbox():
-    if not os.path.exists(MOCK_INBOX_PATH):
+    """
+    Without query parameters: the whole inbox as a JSON array.
+    With limit/cursor/fields: one page, {"items", "next_cursor", "total"};
+    fields is a comma-separated projection (e.g. id,sender,subject,timestamp).
+    """
+    if not inbox.exists():
+        return jsonify({"error": "mock_inbox.json not found"}), 500
+
+    if not any(k in request.args for k in ("limit", "cursor", "fields")):
+        return send_from_directory(DATA_DIR, "mock_inbox.json")
+
+    try:
+        limit = int(request.args.get("limit", inbox.PAGE_SIZE_DEFAULT))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    fields = [f for f in request.args.get("fields", "").split(",") if f] or None
+
+    etag = inbox.etag()
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    try:
+        result = inbox.page(request.args.get("cursor"), limit, fields)
+    except inbox.InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
+
+    resp = jsonify(result)
+    resp.set_etag(etag)
+    return resp
+
+
+@app.route("/api/inbox/changes", methods=["GET"])
+def get_inbox_changes():
+    """
+    Messages added, changed or removed since the ?since= cursor (all of them
+    without one), oldest first: {"changes", "next_cursor", "has_more"}.
+    New and changed messages are already queued for processing ("job_id").
+    """
+    try:
+        limit = int(request.args.get("limit", inbox.CHANGES_PAGE_DEFAULT))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+
+    try:
+        return jsonify(inbox.changes(request.args.get("since"), limit))
+    except inbox.InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/api/inbox/<email_id>", methods=["GET"])
+def get_inbox_email(email_id):
+    if not inbox.exists():
         return jsonify({"error": "mock_inbox.json not found"}), 500
-    return send_from_directory(DATA_DIR, "mock_inbox.json")
+
+    etag = inbox.etag()
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    email = inbox.get_email(email_id)
+    if email is None:
+        # not in the inbox file; maybe an imported message (no ETag: not covered by it)
+        email = inbox.get_stored_email(email_id)
+        if email is None:
+            return jsonify({"error": "email not found"}), 404
+        return jsonify(email)
+
+    resp = jsonify(email)
+    resp.set_etag(etag)
+    return resp
+
+
+# ---------- SEARCH ----------
+
+@app.route("/api/search", methods=["GET"])
+def search():
+    """
+    Full-text search over inbox and processed emails.
+    ?q=<text>&category=<label>&sender=<substring>&limit=<n>
+    """
+    q = (request.args.get("q") or "").strip()
+    if not q:
+        return jsonify({"error": "q is required"}), 400
+    try:
+        limit = int(request.args.get("limit", SEARCH_LIMIT_DEFAULT))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+
+    if inbox.exists():
+        inbox.sync_to_db()
+
+    try:
+        results = search_emails(
+            q,
+            category=request.args.get("category") or None,
+            sender=request.args.get("sender") or None,
+            limit=limit,
+        )
+    except SearchUnavailable as e:
+        return jsonify({"error": str(e)}), 501
+
+    return jsonify({"query": q, "results": results})
+
+
+# ---------- SIMILAR EMAILS ----------
+
+def _similar_k():
+    k = int(request.args.get("k", similar.SIMILAR_K_DEFAULT))
+    return max(1, min(k, similar.SIMILAR_K_MAX))
+
+
+@app.route("/api/emails/<email_id>/similar", methods=["GET"])
+def similar_emails(email_id):
+    """Stored emails most similar to one message. ?k=<n>"""
+    try:
+        k = _similar_k()
+    except ValueError:
+        return jsonify({"error": "k must be an integer"}), 400
+
+    if inbox.exists():
+        inbox.sync_to_db()
+    similar.schedule_sync()
+
+    row = similar.find_email_row(email_id)
+    if row is None:
+        return jsonify({"error": "email not found"}), 404
+
+    hits = similar.similar_to_email(row, k)
+    return jsonify({"id": email_id, "results": similar.describe(hits)})
+
+
+@app.route("/api/similar", methods=["GET"])
+def similar_text():
+    """Stored emails most similar to free text. ?q=<text>&k=<n>"""
+    q = (request.args.get("q") or "").strip()
+    if not q:
+        return jsonify({"error": "q is required"}), 400
+    try:
+        k = _similar_k()
+    except ValueError:
+        return jsonify({"error": "k must be an integer"}), 400
+
+    if inbox.exists():
+        inbox.sync_to_db()
+    similar.schedule_sync()
+
+    hits = similar.similar_to_text(q, k)
+    return jsonify({"query": q, "results": similar.describe(hits)})
 
 
 # ---------- PROMPTS ----------
@@ -80,170 +265,407 @@ def create_prompt():
     cur.execute("SELECT id, name, type, content, created_at FROM prompts WHERE id = ?", (new_id,))
     row = cur.fetchone()
     conn.close()
+    invalidate_prompt_cache()
 
     return jsonify(dict(row)), 201
 
 
 # ---------- PROCESS EMAIL ----------
 
+def _threshold(data):
+    """Optional per-request classifier threshold (0-1; above 1 always asks the LLM)."""
+    value = data.get("threshold")
+    return None if value is None else float(value)
+
+
+def build_process_args(data):
+    """Return (process_one keyword arguments, error) for an /api/process request body."""
+    email = data.get("email")
+    if not email or not email.get("body"):
+        return None, "email.body is required"
+
+    mode = data.get("mode")
+    if mode is not None and mode not in PROCESS_MODES:
+        return None, f"mode must be one of {', '.join(PROCESS_MODES)}"
+    try:
+        threshold = _threshold(data)
+    except (TypeError, ValueError):
+        return None, "threshold must be a number"
+
+    return {
+        "email": email,
+        "mode": mode,
+        "use_cache": not data.get("fresh"),
+        "force": bool(data.get("force")),
+        "threshold": threshold,
+    }, None
+
+
+def add_stage_timings(result):
+    """Report the pipeline stages of a process result in this request's Server-Timing."""
+    for stage, ms in result["timings_ms"].items():
+        if stage != "total":
+            metrics.timing(stage, ms)
+
+
 @app.route("/api/process", methods=["POST"])
 def process_email():
     data = request.get_json(force=True, silent=True) or {}
+    kwargs, error = build_process_args(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    result = process_one(**kwargs)
+    add_stage_timings(result)
+    return jsonify(result)
+
+
+@app.route("/api/process/batch", methods=["POST"])
+def process_batch():
+    """
+    Process many emails at once. Body: {"emails": [...]} or {"inbox": true}
+    for the whole mock inbox, plus optional "concurrency", "mode", "fresh", "force"
+    and "threshold".
+    Results stream back as NDJSON, one line per email as it finishes.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+
+    if data.get("inbox"):
+        if not inbox.exists():
+            return jsonify({"error": "mock_inbox.json not found"}), 500
+        emails = inbox.all_emails()
+    else:
+        emails = data.get("emails")
+
+    if not isinstance(emails, list) or not emails:
+        return jsonify({"error": "emails (non-empty list) or inbox=true is required"}), 400
+
+    try:
+        concurrency = int(data.get("concurrency") or BATCH_CONCURRENCY)
+    except (TypeError, ValueError):
+        return jsonify({"error": "concurrency must be an integer"}), 400
+
+    mode = data.get("mode")
+    if mode is not None and mode not in PROCESS_MODES:
+        return jsonify({"error": f"mode must be one of {', '.join(PROCESS_MODES)}"}), 400
+    try:
+        threshold = _threshold(data)
+    except (TypeError, ValueError):
+        return jsonify({"error": "threshold must be a number"}), 400
+
+    # Resolve templates once for the whole batch
+    templates = load_templates()
+
+    def generate():
+        items = process_many(
+            emails, templates, concurrency, mode, not data.get("fresh"), bool(data.get("force")), threshold
+        )
+        for item in items:
+            yield json.dumps(item) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+# ---------- JOBS ----------
+
+@app.route("/api/jobs", methods=["POST"])
+def create_job():
+    """
+    Queue an email for background processing and return its id at once (202).
+    Body: {"email": {...}} plus the optional /api/process fields
+    ("mode", "fresh", "force", "threshold").
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    kind = data.get("kind") or "process"
+    if kind not in jobs.JOB_KINDS:
+        return jsonify({"error": f"kind must be one of {', '.join(jobs.JOB_KINDS)}"}), 400
+
     email = data.get("email")
-    if not email or not email.get("body"):
+    if not isinstance(email, dict) or not email.get("body"):
         return jsonify({"error": "email.body is required"}), 400
+    mode = data.get("mode")
+    if mode is not None and mode not in PROCESS_MODES:
+        return jsonify({"error": f"mode must be one of {', '.join(PROCESS_MODES)}"}), 400
+    try:
+        threshold = _threshold(data)
+    except (TypeError, ValueError):
+        return jsonify({"error": "threshold must be a number"}), 400
+
+    job = jobs.enqueue(
+        kind,
+        {
+            "email": email,
+            "mode": mode,
+            "fresh": bool(data.get("fresh")),
+            "force": bool(data.get("force")),
+            "threshold": threshold,
+        },
+    )
+    resp = jsonify(job)
+    resp.status_code = 202
+    resp.headers["Location"] = f"/api/jobs/{job['id']}"
+    return resp
+
+
+@app.route("/api/jobs", methods=["GET"])
+def list_jobs():
+    """Recent jobs (?status=<queued|running|done|failed>&limit=<n>) and counts per status."""
+    status = request.args.get("status") or None
+    if status is not None and status not in jobs.JOB_STATUSES:
+        return jsonify({"error": f"status must be one of {', '.join(jobs.JOB_STATUSES)}"}), 400
+    try:
+        limit = max(1, min(int(request.args.get("limit", 50)), 500))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    return jsonify(jobs.list_jobs(status, limit))
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job)
+
+
+@app.route("/api/jobs/<job_id>/result", methods=["GET"])
+def get_job_result(job_id):
+    """200 with the result when done, 202 (with Retry-After) while pending, 500 if it failed."""
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    if job["status"] == "done":
+        return jsonify(job["result"])
+    if job["status"] == "failed":
+        return jsonify({"error": job["error"], "status": "failed"}), 500
+    return jsonify({"status": job["status"]}), 202, {"Retry-After": "1"}
+
+
+# ---------- INGEST ----------
+
+@app.route("/api/ingest", methods=["POST"])
+def ingest_upload():
+    """
+    Import a mail dump sent as the raw request body, parsed as it streams in.
+    ?format=mbox|jsonl is required; a gzip body (Content-Encoding: gzip) is accepted.
+    Returns row counts and throughput.
+    """
+    fmt = request.args.get("format")
+    if fmt not in INGEST_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(INGEST_FORMATS)}"}), 400
+
+    stream = request.stream
+    if request.headers.get("Content-Encoding") == "gzip":
+        stream = gzip.GzipFile(fileobj=stream)
 
-    body_text = email["body"]
+    try:
+        stats = ingest_stream(stream, fmt)
+    except (OSError, EOFError) as e:
+        return jsonify({"error": f"could not read upload: {e}"}), 400
 
-    # fetch templates
-    conn = get_connection()
-    cur = conn.cursor()
+    return jsonify(stats)
 
-    # categorization prompt
-    cur.execute("SELECT content FROM prompts WHERE type = ? ORDER BY created_at DESC LIMIT 1", ("categorize",))
-    row_cat = cur.fetchone()
-    if row_cat:
-        cat_template = row_cat["content"]
-    else:
-        cat_template = (
-            "Categorize the email into one of these labels: Important, To-Do, Newsletter, Spam, Social.\n"
-            "Return only the label (one word).\n\nEmail:\n{email_body}"
-        )
 
-    # action extraction prompt
-    cur.execute("SELECT content FROM prompts WHERE type = ? ORDER BY created_at DESC LIMIT 1", ("extract_actions",))
-    row_act = cur.fetchone()
-    if row_act:
-        act_template = row_act["content"]
-    else:
-        act_template = (
-            "Extract actionable tasks from the email. "
-            "Return a JSON array of objects with keys 'task', 'deadline', and 'assignee'. "
-            "If there are no actions, return an empty JSON array [].\n\nEmail:\n{email_body}"
-        )
+# ---------- EXPORT ----------
 
-    conn.close()
+def _flag(name):
+    return request.args.get(name, "").lower() in ("1", "true", "yes")
 
-    cat_prompt = cat_template.replace("{email_body}", body_text)
-    actions_prompt = act_template.replace("{email_body}", body_text)
-
-    # Call LLMs (now always return a string, even on error)
-    cat_resp = call_llm([{"role": "user", "content": cat_prompt}], max_tokens=60)
-    actions_resp = call_llm([{"role": "user", "content": actions_prompt}], max_tokens=400)
-
-    # Try to parse actions as JSON only if it looks like JSON
-    parsed_actions = safe_json_loads(actions_resp, None)
-
-    # Save in DB (best-effort; errors here shouldn’t break the response)
-    try:
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO emails(external_id, sender, subject, timestamp, body, category, actions_json)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                email.get("id"),
-                email.get("sender"),
-                email.get("subject"),
-                email.get("timestamp"),
-                body_text,
-                (cat_resp or "").strip(),
-                json.dumps(parsed_actions) if parsed_actions is not None else actions_resp,
-            ),
+
+@app.route("/api/export/<kind>", methods=["GET"])
+def export_rows(kind):
+    """
+    Stream emails, actions (one line per extracted action) or drafts as NDJSON,
+    oldest first. Filters: since/until (ISO 8601 on created_at), category
+    (comma-separated; emails and actions), processed=1 (emails with a category),
+    body=1 (email bodies). gzip=1 compresses the stream (Content-Encoding: gzip).
+    """
+    try:
+        chunks = export.export_stream(
+            kind,
+            since=request.args.get("since"),
+            until=request.args.get("until"),
+            categories=request.args.get("category"),
+            processed=_flag("processed"),
+            body=_flag("body"),
+            compress=_flag("gzip"),
         )
-        conn.commit()
-        conn.close()
-    except Exception as db_err:
-        print("Warning: failed to persist processed email:", db_err)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    return jsonify({
-        "category": (cat_resp or "").strip(),
-        "actions_raw": actions_resp,
-        "actions_json": parsed_actions,
-    })
+    headers = {
+        "Content-Disposition": f'attachment; filename="{kind}.ndjson"',
+        "X-Accel-Buffering": "no",  # ask proxies (nginx) not to buffer the stream
+    }
+    if _flag("gzip"):
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(chunks), mimetype="application/x-ndjson", headers=headers)
 
 
 # ---------- AGENT (chat-like) ----------
 
-@app.route("/api/agent", methods=["POST"])
-def agent():
-    data = request.get_json(force=True, silent=True) or {}
+def agent_request_error(data):
+    """The 400 error for an /api/agent request body, or None if it is usable."""
     email = data.get("email")
-    prompt_template = data.get("promptTemplate")
-    user_instruction = data.get("userInstruction") or "Please perform the task."
-
     if not email or not email.get("body"):
-        return jsonify({"error": "email.body is required"}), 400
+        return "email.body is required"
+    return None
+
 
+def compose_agent_messages(data, body):
+    """The /api/agent prompt, given the (condensed) email body."""
+    user_instruction = data.get("userInstruction") or "Please perform the task."
     base_template = (
-        prompt_template
+        data.get("promptTemplate")
         or "You are an assistant that helps draft responses and summarize emails. Keep replies short and professional."
     )
-
     combined = (
         f"{base_template}\n\n"
-        f"Email:\n{email['body']}\n\n"
+        f"Email:\n{body}\n\n"
         f"User instruction:\n{user_instruction}"
     )
+    return [{"role": "user", "content": combined}]
+
+
+def build_agent_messages(data):
+    """Return (messages, error) for an /api/agent request body."""
+    error = agent_request_error(data)
+    if error:
+        return None, error
+
+    # long threads are condensed to TOKEN_BUDGET_AGENT (quoted history kept if it fits)
+    body, _ = budget.condense(
+        data["email"]["body"], budget.TOKEN_BUDGET_AGENT, use_cache=not data.get("fresh"), strip_quotes=False
+    )
+    return compose_agent_messages(data, body), None
+
+
+@app.route("/api/agent", methods=["POST"])
+def agent():
+    data = request.get_json(force=True, silent=True) or {}
+    messages, error = build_agent_messages(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    served = {}
+    reply = call_llm(messages, max_tokens=800, use_cache=not data.get("fresh"), task="agent", info=served)
+
+    return jsonify({"reply": reply, "model": served.get("model")})
+
+
+@app.route("/api/agent/stream", methods=["POST"])
+def agent_stream():
+    """
+    Same input as /api/agent, but the reply is sent as server-sent events:
+    one "data: {"delta": ...}" event per chunk, then an "event: done"
+    carrying the full reply and the model that served it, or an
+    "event: error" carrying the error if the model call failed.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    messages, error = build_agent_messages(data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    def generate():
+        parts, served = [], {}
+        for delta in stream_llm(messages, max_tokens=800, use_cache=not data.get("fresh"), task="agent", info=served):
+            if is_error_reply(delta):
+                yield f"event: error\ndata: {json.dumps({'error': delta})}\n\n"
+                return
+            parts.append(delta)
+            yield f"data: {json.dumps({'delta': delta})}\n\n"
+        yield f"event: done\ndata: {json.dumps({'reply': ''.join(parts), 'model': served.get('model')})}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        # no caching, and ask proxies (nginx) not to buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
-    reply = call_llm([{"role": "user", "content": combined}], max_tokens=800)
+# ---------- CLASSIFIER ----------
 
-    return jsonify({"reply": reply})
+@app.route("/api/classifier", methods=["GET"])
+def get_classifier_stats():
+    """Fast-path threshold, decisions per tier, escalation rate and model info."""
+    return jsonify(classifier.classifier_stats())
+
+
+@app.route("/api/classifier/train", methods=["POST"])
+def train_classifier():
+    return jsonify(classifier.train())
+
+
+# ---------- LLM CACHE & SCHEDULER ----------
+
+@app.route("/api/llm/cache", methods=["GET"])
+def get_llm_cache_stats():
+    return jsonify(cache_stats())
+
+
+@app.route("/api/llm/cache", methods=["DELETE"])
+def clear_llm_cache():
+    return jsonify({"deleted": cache_clear()})
+
+
+@app.route("/api/llm/scheduler", methods=["GET"])
+def get_llm_scheduler_stats():
+    """Rate-limit budgets, queue depth per priority, retries and coalesced calls."""
+    return jsonify(scheduler_stats())
+
+
+@app.route("/api/llm/batching", methods=["GET"])
+def get_llm_batching_stats():
+    """Micro-batched categorize calls: emails per call, retry rate and settings."""
+    return jsonify(microbatch.batch_stats())
+
+
+@app.route("/api/llm/parsing", methods=["GET"])
+def get_actions_parsing_stats():
+    """How extract_actions replies parsed: ok, repaired locally, retried with the model, failed."""
+    return jsonify(actions.parse_stats())
+
+
+@app.route("/api/llm/routing", methods=["GET"])
+def get_llm_routing_stats():
+    """Routing table, fast/large model ids and recent latency per model (the SLO check's input)."""
+    return jsonify(routing_stats())
 
 
 # ---------- DRAFTS ----------
 
 @app.route("/api/drafts", methods=["GET"])
 def list_drafts():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, subject, body, meta_json, created_at FROM drafts ORDER BY created_at DESC"
-    )
-    rows = cur.fetchall()
-    conn.close()
+    """
+    Without query parameters: every draft as a JSON array (meta decoded),
+    streamed row by row.
+    With limit/cursor/fields: one page, newest first, {"items", "next_cursor",
+    "total_estimate"}; fields is a comma-separated projection of
+    id,subject,body,created_at,meta (default: everything but meta).
+    """
+    if not any(k in request.args for k in ("limit", "cursor", "fields")):
+        return Response(stream_with_context(drafts.iter_json_array()), mimetype="application/json")
 
-    drafts = []
-    for row in rows:
-        d = dict(row)
-        d["meta"] = safe_json_loads(d.get("meta_json"), None)
-        drafts.append(d)
+    try:
+        limit = int(request.args.get("limit", drafts.PAGE_SIZE_DEFAULT))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    fields = [f for f in request.args.get("fields", "").split(",") if f] or None
 
-    return jsonify(drafts)
+    try:
+        return jsonify(drafts.page(request.args.get("cursor"), limit, fields))
+    except ValueError as e:  # includes drafts.InvalidCursor
+        return jsonify({"error": str(e)}), 400
 
 
 @app.route("/api/drafts", methods=["POST"])
 def save_draft():
     data = request.get_json(force=True, silent=True) or {}
-    subject = data.get("subject")
-    body = data.get("body")
-    meta = data.get("meta")
-
-    if not body:
+    if not data.get("body"):
         return jsonify({"error": "draft body is required"}), 400
 
-    meta_json = json.dumps(meta) if meta is not None else None
-
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO drafts(subject, body, meta_json) VALUES (?, ?, ?)",
-        (subject, body, meta_json),
-    )
-    conn.commit()
-    new_id = cur.lastrowid
-    cur.execute(
-        "SELECT id, subject, body, meta_json, created_at FROM drafts WHERE id = ?",
-        (new_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
-
-    draft = dict(row)
-    draft["meta"] = safe_json_loads(draft.get("meta_json"), None)
-    return jsonify(draft), 201
+    return jsonify(drafts.create(data.get("subject"), data["body"], data.get("meta"))), 201
 
 
 # ---------- MAIN ----------
@@ -0,0 +1,242 @@
+# asgi.py
+# Async serving mode. The routes that wait on the model (/api/process,
+# /api/agent, /api/agent/stream) are served as coroutines on AsyncGroq, so an
+# in-flight LLM call holds no thread and one process can keep hundreds of them
+# open. Every other route is handed to the Flask app on a thread pool.
+#
+#   gunicorn -k asgi -w 2 --worker-connections 1000 --bind 0.0.0.0:5000 asgi:app
+#
+# The sync entry points (python app.py, gunicorn app:app) keep working as before.
+
+import asyncio
+import json
+import os
+import traceback
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+import budget
+import inbox
+import jobs
+import metrics
+from app import add_stage_timings, agent_request_error, app as flask_app, build_process_args, compose_agent_messages
+from db import db_time_ms, reset_db_time
+from llm import acall_llm, astream_llm, is_error_reply
+from pipeline import aprocess_one
+
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "32"))  # Flask requests running at once
+
+_flask_asgi = WsgiToAsgi(flask_app)
+_flask_slots = None  # asyncio.Semaphore(ASGI_WSGI_THREADS), made on the serving loop
+
+
+async def _serve_flask(scope, receive, send):
+    """
+    Hand a request to Flask. WsgiToAsgi runs WSGI apps on one thread shared by
+    the whole process unless the request has its own ThreadSensitiveContext;
+    with one per request, Flask requests run side by side (up to ASGI_WSGI_THREADS).
+    """
+    global _flask_slots
+    if _flask_slots is None:
+        _flask_slots = asyncio.Semaphore(ASGI_WSGI_THREADS)
+    flask_send, flush = _hold_closing_message(send)
+    async with _flask_slots:
+        async with ThreadSensitiveContext():
+            await _flask_asgi(scope, receive, flask_send)
+    await flush()
+
+
+def _hold_closing_message(send):
+    """
+    Return (send, flush). gunicorn's ASGI worker resets a keep-alive connection
+    for the next request when the app returns, and a request that arrives
+    between the last body bytes and that return is lost. A WSGI bridge sends
+    from its worker thread, a little before the app returns, so the message
+    that ends the body is held back here and flushed right before returning.
+    """
+    state = {"remaining": None, "closing": None}
+
+    async def wrapped(message):
+        if message["type"] == "http.response.start":
+            for name, value in message.get("headers", []):
+                if name.lower() == b"content-length":
+                    state["remaining"] = int(value)
+        elif message["type"] == "http.response.body":
+            if state["closing"] is not None:
+                return  # an empty message after a complete Content-Length body
+            if state["remaining"] is not None:
+                state["remaining"] -= len(message.get("body", b""))
+            if not message.get("more_body") or (state["remaining"] is not None and state["remaining"] <= 0):
+                state["closing"] = dict(message, more_body=False)
+                return
+        await send(message)
+
+    async def flush():
+        if state["closing"] is not None:
+            await send(state["closing"])
+
+    return wrapped, flush
+
+
+# ---------- HELPERS ----------
+
+async def _read_json(receive):
+    """The request body as a JSON object, {} if it is missing or invalid (like get_json(silent=True))."""
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    try:
+        data = json.loads(b"".join(chunks) or b"{}")
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def _agent_messages(data):
+    """build_agent_messages for coroutines: a long body is condensed with awaited LLM calls."""
+    error = agent_request_error(data)
+    if error:
+        return None, error
+    body, _ = await budget.acondense(
+        data["email"]["body"], budget.TOKEN_BUDGET_AGENT, use_cache=not data.get("fresh"), strip_quotes=False
+    )
+    return compose_agent_messages(data, body), None
+
+
+async def _send_json(send, status, payload):
+    body = json.dumps(payload).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+# ---------- ROUTES ----------
+
+async def process_email(receive, send):
+    kwargs, error = build_process_args(await _read_json(receive))
+    if error:
+        return await _send_json(send, 400, {"error": error})
+
+    result = await aprocess_one(**kwargs)
+    add_stage_timings(result)
+    await _send_json(send, 200, result)
+
+
+async def agent(receive, send):
+    data = await _read_json(receive)
+    messages, error = await _agent_messages(data)
+    if error:
+        return await _send_json(send, 400, {"error": error})
+
+    served = {}
+    reply = await acall_llm(messages, max_tokens=800, use_cache=not data.get("fresh"), task="agent", info=served)
+    await _send_json(send, 200, {"reply": reply, "model": served.get("model")})
+
+
+async def agent_stream(receive, send):
+    data = await _read_json(receive)
+    messages, error = await _agent_messages(data)
+    if error:
+        return await _send_json(send, 400, {"error": error})
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            # no caching, and ask proxies (nginx) not to buffer the stream
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+    parts, served = [], {}
+    use_cache = not data.get("fresh")
+    async for delta in astream_llm(messages, max_tokens=800, use_cache=use_cache, task="agent", info=served):
+        if is_error_reply(delta):
+            error = f"event: error\ndata: {json.dumps({'error': delta})}\n\n"
+            return await send({"type": "http.response.body", "body": error.encode("utf-8")})
+        parts.append(delta)
+        event = f"data: {json.dumps({'delta': delta})}\n\n"
+        await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+    done = f"event: done\ndata: {json.dumps({'reply': ''.join(parts), 'model': served.get('model')})}\n\n"
+    await send({"type": "http.response.body", "body": done.encode("utf-8")})
+
+
+ROUTES = {
+    ("POST", "/api/process"): process_email,
+    ("POST", "/api/agent"): agent,
+    ("POST", "/api/agent/stream"): agent_stream,
+}
+
+
+# ---------- APP ----------
+
+async def _serve(handler, scope, receive, send):
+    """
+    Run a native route with the same Server-Timing, metrics and CORS headers as
+    the Flask routes. An exception is logged and answered with a 500, or, if the
+    response has already started (a stream), ends it.
+    """
+    reset_db_time()
+    metrics.begin_request()
+    endpoint = scope["path"]
+    state = {"started": False, "ended": False}
+
+    async def send_with_headers(message):
+        if message["type"] == "http.response.body" and not message.get("more_body"):
+            state["ended"] = True
+        if message["type"] == "http.response.start":
+            state["started"] = True
+            timings, seconds = metrics.end_request()
+            db_ms = db_time_ms()
+            metrics.HTTP_DURATION.observe(
+                seconds, method=scope["method"], endpoint=endpoint, status=message["status"]
+            )
+            metrics.DB_REQUEST_TIME.observe(db_ms / 1000, endpoint=endpoint)
+            timings.update(db=db_ms, total=seconds * 1000)
+            message["headers"] = list(message.get("headers", [])) + [
+                (b"server-timing", metrics.server_timing_header(timings).encode("latin-1")),
+                (b"access-control-allow-origin", b"*"),
+            ]
+        await send(message)
+
+    try:
+        await handler(receive, send_with_headers)
+    except Exception as e:
+        print(f"Warning: {scope['method']} {endpoint} failed:", repr(e))
+        traceback.print_exc()
+        if not state["started"]:
+            await _send_json(send_with_headers, 500, {"error": "internal server error"})
+        elif not state["ended"]:
+            await send_with_headers({"type": "http.response.body", "body": b""})
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                jobs.start_workers()
+                inbox.start_watcher()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    jobs.start_workers()  # no-ops once running in this process
+    inbox.start_watcher()
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is None:
+        await _serve_flask(scope, receive, send)
+    else:
+        await _serve(handler, scope, receive, send)
@@ -0,0 +1,299 @@
+# budget.py
+# Token budgets for email bodies before they go into a prompt. Signatures are
+# stripped first, and quoted reply history once a body is over its task's
+# budget (forwarded messages are kept); a body that is still over budget is
+# split into chunks, the chunks are summarized in parallel
+# (map) and the summaries joined or, if needed, condensed once more (reduce).
+# The number of chunks is capped, so an email costs at most two rounds of
+# LLM calls however large it is.
+
+import asyncio
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from llm import acall_llm, call_llm, count_tokens, is_error_reply
+
+# prompt tokens allowed for the email body, per task
+TOKEN_BUDGET_CATEGORIZE = int(os.getenv("TOKEN_BUDGET_CATEGORIZE", "500"))  # a prefix is enough for a label
+TOKEN_BUDGET_ACTIONS = int(os.getenv("TOKEN_BUDGET_ACTIONS", "3000"))  # extract_actions and fused prompts
+TOKEN_BUDGET_AGENT = int(os.getenv("TOKEN_BUDGET_AGENT", "3000"))
+TOKEN_BUDGET_CHUNK = int(os.getenv("TOKEN_BUDGET_CHUNK", "2000"))  # map step input size
+TOKEN_BUDGET_MAX_CHUNKS = int(os.getenv("TOKEN_BUDGET_MAX_CHUNKS", "8"))  # beyond this, the middle is dropped
+CONDENSE_WORKERS = int(os.getenv("CONDENSE_WORKERS", "8"))
+
+TRUNCATION_MARK = "\n[... truncated]"
+
+CHUNK_SUMMARY_TEMPLATE = (
+    "Below is part {part} of {parts} of a long email. Condense it to at most {words} words. "
+    "Keep every request, task, deadline, date, amount, name and decision; drop greetings, "
+    "boilerplate and repetition. Reply with the condensed text only.\n\n{text}"
+)
+REDUCE_TEMPLATE = (
+    "Below are condensed parts of one long email, in order. Merge them into a single text of "
+    "at most {words} words, keeping every request, task, deadline, date, amount, name and "
+    "decision. Reply with the merged text only.\n\n{text}"
+)
+
+# own pool: the map step runs inside pipeline calls that may already hold a pipeline pool thread
+_pool = ThreadPoolExecutor(max_workers=CONDENSE_WORKERS, thread_name_prefix="condense")
+
+_QUOTE_LINE = re.compile(r"^\s*>")
+_HISTORY_MARKERS = [
+    re.compile(r"^\s*On\b.{0,300}\bwrote:\s*$", re.IGNORECASE | re.DOTALL),
+    re.compile(r"^\s*-{2,}\s*Original Message\s*-{2,}", re.IGNORECASE),
+    re.compile(r"^\s*_{10,}\s*$"),  # Outlook's rule above the quoted header
+]
+_OUTLOOK_HEADER = re.compile(r"^\s*(From|De|Von):\s", re.IGNORECASE)
+_OUTLOOK_NEXT = re.compile(r"^\s*(Sent|Date|Envoyé|Gesendet|To):\s", re.IGNORECASE)
+# a forwarded message is content the sender is passing on, not history: keep it
+_FORWARD_MARKER = re.compile(r"^\s*(-{2,}\s*Forwarded message\s*-{2,}|Begin forwarded message:)", re.IGNORECASE)
+_FORWARD_SUBJECT = re.compile(r"^\s*(Subject|Objet|Betreff):\s*(Fwd?|WG|TR)\s*:", re.IGNORECASE)
+_SIGNATURE_DELIMITER = re.compile(r"^--\s*$")
+_MOBILE_FOOTER = re.compile(r"^\s*(Sent from my \w+|Get Outlook for \w+)", re.IGNORECASE)
+
+
+# ---------- CLEANING ----------
+
+def _header_end(lines, start):
+    """Index just past the From:/Date:/Subject: block that starts at or after start."""
+    i = start
+    while i < len(lines) and not lines[i].strip() and i < start + 2:
+        i += 1
+    end = i
+    while end < len(lines) and lines[end].strip() and end < i + 12:
+        end += 1
+    return end
+
+
+def _history_start(lines):
+    """Index of the first line of quoted reply history, or None. Forwarded messages are skipped over."""
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if _FORWARD_MARKER.match(line):
+            i = _header_end(lines, i + 1)
+            continue
+        # "On <date>, <name> wrote:" is often wrapped over two lines
+        joined = line + " " + lines[i + 1] if i + 1 < len(lines) else line
+        if any(m.match(line) for m in _HISTORY_MARKERS) or _HISTORY_MARKERS[0].match(joined):
+            # Outlook puts the same rule and header block above a forward ("Subject: FW: ...")
+            end = _header_end(lines, i + 1)
+            if _HISTORY_MARKERS[2].match(line) and any(_FORWARD_SUBJECT.match(n) for n in lines[i + 1:end]):
+                i = end
+                continue
+            return i
+        if _OUTLOOK_HEADER.match(line) and any(_OUTLOOK_NEXT.match(n) for n in lines[i + 1:i + 4]):
+            end = _header_end(lines, i)
+            if any(_FORWARD_SUBJECT.match(n) for n in lines[i:end]):
+                i = end
+                continue
+            return i
+        i += 1
+    return None
+
+
+def strip_quoted(text):
+    """
+    Drop reply history ("On ... wrote:", "-----Original Message-----", Outlook
+    From:/Sent: blocks and everything after them) and ">"-quoted lines. A
+    message that is nothing but quoted text is left as it is. Forwarded
+    messages ("Forwarded message", "Begin forwarded message:", Outlook blocks
+    with a "Subject: FW:") are kept: their tasks are what the sender is asking about.
+    """
+    lines = (text or "").splitlines()
+    cut = _history_start(lines)
+    kept = lines[:cut] if cut is not None else lines
+    kept = [line for line in kept if not _QUOTE_LINE.match(line)]
+    if len("".join(kept).strip()) < 20:
+        return text or ""
+    return "\n".join(kept)
+
+
+def strip_signature(text):
+    """
+    Drop a "-- " signature block near the end and "Sent from my ..." footers.
+    Quoted history after the signature is kept (strip_quoted decides about it).
+    """
+    lines = [line for line in (text or "").splitlines() if not _MOBILE_FOOTER.match(line)]
+    for i in range(len(lines) - 1, -1, -1):
+        if _SIGNATURE_DELIMITER.match(lines[i]):
+            history = _history_start(lines[i:])
+            end = i + history if history is not None else len(lines)
+            if end - i <= 20:  # anything longer is not a signature
+                lines = lines[:i] + lines[end:]
+            break
+    return "\n".join(lines)
+
+
+def clean_body(text):
+    """Quoted history and signature removed, runs of blank lines collapsed."""
+    cleaned = strip_signature(strip_quoted(text))
+    cleaned = re.sub(r"[ \t]+\n", "\n", cleaned)
+    return re.sub(r"\n{3,}", "\n\n", cleaned).strip()
+
+
+# ---------- BUDGETS ----------
+
+def fit(text, budget_tokens):
+    """text cut at a word boundary so that it fits budget_tokens (marked when cut)."""
+    text = text or ""
+    if count_tokens(text) <= budget_tokens:
+        return text
+    limit = max(0, budget_tokens * 4 - len(TRUNCATION_MARK))
+    cut = text[:limit]
+    space = cut.rfind(" ", 0, limit)
+    if space > limit * 0.8:
+        cut = cut[:space]
+    while cut and count_tokens(cut) + count_tokens(TRUNCATION_MARK) > budget_tokens:
+        cut = cut[: int(len(cut) * 0.9)]  # word-dense text: shrink until it fits
+    return cut.rstrip() + TRUNCATION_MARK
+
+
+def split_chunks(text, chunk_tokens=TOKEN_BUDGET_CHUNK):
+    """Split text into chunks of at most chunk_tokens, on paragraph boundaries where possible."""
+    chunks, current = [], []
+    for paragraph in re.split(r"\n\s*\n", text):
+        while count_tokens(paragraph) > chunk_tokens:  # a single huge paragraph
+            head = fit(paragraph, chunk_tokens)[: -len(TRUNCATION_MARK)]
+            if not head:
+                break
+            if current:
+                chunks.append("\n\n".join(current))
+                current = []
+            chunks.append(head)
+            paragraph = paragraph[len(head):].lstrip()
+        if current and count_tokens("\n\n".join(current + [paragraph])) > chunk_tokens:
+            chunks.append("\n\n".join(current))
+            current = []
+        if paragraph.strip():
+            current.append(paragraph)
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def _summary_messages(template, budget_tokens, **fields):
+    prompt = template.format(words=max(20, budget_tokens * 3 // 4), **fields)
+    return [{"role": "user", "content": prompt}]
+
+
+def _summarize(template, budget_tokens, use_cache, priority, **fields):
+    return call_llm(
+        _summary_messages(template, budget_tokens, **fields),
+        max_tokens=budget_tokens,
+        use_cache=use_cache,
+        priority=priority,
+        task="summarize",
+    )
+
+
+async def _asummarize(template, budget_tokens, use_cache, priority, **fields):
+    return await acall_llm(
+        _summary_messages(template, budget_tokens, **fields),
+        max_tokens=budget_tokens,
+        use_cache=use_cache,
+        priority=priority,
+        task="summarize",
+    )
+
+
+def _plan(text, budget_tokens, strip_quotes):
+    """
+    The LLM-free part of condensing: (body, info, chunks). chunks is None when
+    the cleaned body already fits; otherwise the (capped) chunks to summarize.
+    """
+    original = text or ""
+    info = {"tokens": count_tokens(original), "chunks": 0, "omitted_chunks": 0}
+
+    body = clean_body(original) if strip_quotes else strip_signature(original).strip()
+    if not strip_quotes and count_tokens(body) > budget_tokens:
+        body = clean_body(original)
+    info["stripped"] = body.split() != original.split()  # ignoring whitespace-only changes
+    if count_tokens(body) <= budget_tokens:
+        info["sent_tokens"] = count_tokens(body)
+        return body, info, None
+
+    chunks = split_chunks(body)
+    if len(chunks) > TOKEN_BUDGET_MAX_CHUNKS:
+        # keep the opening (the ask) and the end (the latest context)
+        info["omitted_chunks"] = len(chunks) - TOKEN_BUDGET_MAX_CHUNKS
+        chunks = chunks[: TOKEN_BUDGET_MAX_CHUNKS - 1] + chunks[-1:]
+    info["chunks"] = len(chunks)
+    return body, info, chunks
+
+
+def _chunk_share(budget_tokens, chunks):
+    return max(64, budget_tokens // len(chunks))
+
+
+def _merge(chunks, replies, share):
+    # a failed call falls back to the start of its chunk
+    summaries = [fit(chunk, share) if is_error_reply(reply) else reply.strip() for chunk, reply in zip(chunks, replies)]
+    return "\n\n".join(summaries)
+
+
+def _finish(merged, reduced, budget_tokens, info):
+    if reduced is not None and not is_error_reply(reduced):
+        merged = reduced.strip()
+    body = fit(merged, budget_tokens)
+    info["sent_tokens"] = count_tokens(body)
+    return body, info
+
+
+def condense(text, budget_tokens, use_cache=True, priority="interactive", strip_quotes=False):
+    """
+    Return (body, info) with body within budget_tokens. Bodies that fit after
+    cleaning are returned as they are; larger ones are map-reduced. info has
+    "tokens" (original), "sent_tokens", "chunks" (0 = no LLM condensing),
+    "omitted_chunks" and "stripped".
+
+    Quoted history is kept unless the body is over budget (a short thread is
+    cheap, and the earlier messages may hold the ask); strip_quotes=True
+    always drops it.
+    """
+    body, info, chunks = _plan(text, budget_tokens, strip_quotes)
+    if chunks is None:
+        return body, info
+
+    share = _chunk_share(budget_tokens, chunks)
+    futures = [
+        _pool.submit(
+            _summarize, CHUNK_SUMMARY_TEMPLATE, share, use_cache, priority,
+            part=i + 1, parts=len(chunks), text=chunk,
+        )
+        for i, chunk in enumerate(chunks)
+    ]
+    merged = _merge(chunks, [future.result() for future in futures], share)
+
+    reduced = None
+    if count_tokens(merged) > budget_tokens:
+        reduced = _summarize(REDUCE_TEMPLATE, budget_tokens, use_cache, priority, text=merged)
+    return _finish(merged, reduced, budget_tokens, info)
+
+
+async def acondense(text, budget_tokens, use_cache=True, priority="interactive", strip_quotes=False):
+    """
+    condense() for coroutines (ASGI mode): the map step is awaited with
+    asyncio.gather on acall_llm, so condensing a long body holds no thread.
+    """
+    body, info, chunks = _plan(text, budget_tokens, strip_quotes)
+    if chunks is None:
+        return body, info
+
+    share = _chunk_share(budget_tokens, chunks)
+    replies = await asyncio.gather(*(
+        _asummarize(CHUNK_SUMMARY_TEMPLATE, share, use_cache, priority, part=i + 1, parts=len(chunks), text=chunk)
+        for i, chunk in enumerate(chunks)
+    ))
+    merged = _merge(chunks, replies, share)
+
+    reduced = None
+    if count_tokens(merged) > budget_tokens:
+        reduced = await _asummarize(REDUCE_TEMPLATE, budget_tokens, use_cache, priority, text=merged)
+    return _finish(merged, reduced, budget_tokens, info)
+
+
+def categorize_prefix(text):
+    """The cleaned start of a body, bounded by TOKEN_BUDGET_CATEGORIZE (no LLM calls)."""
+    return fit(clean_body(text), TOKEN_BUDGET_CATEGORIZE)
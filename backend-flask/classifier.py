@@ -0,0 +1,287 @@
+# classifier.py
+# Local fast path in front of the categorize LLM call. Two cheap tiers run
+# first: sender/keyword rules, then a naive Bayes model trained on past
+# emails.category rows. Only low-confidence emails escalate to the LLM.
+
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from db import get_connection
+from utils import tokenize
+
+LABELS = ("Important", "To-Do", "Newsletter", "Spam", "Social")
+TIERS = ("rules", "model", "llm")
+
+CLASSIFIER_ENABLED = os.getenv("CLASSIFIER_ENABLED", "1") != "0"
+CLASSIFIER_THRESHOLD = float(os.getenv("CLASSIFIER_THRESHOLD", "0.9"))  # min confidence to skip the LLM
+CLASSIFIER_MIN_TRAINING = int(os.getenv("CLASSIFIER_MIN_TRAINING", "50"))  # labeled rows before the model is used
+CLASSIFIER_MIN_PRECISION = float(os.getenv("CLASSIFIER_MIN_PRECISION", "0.95"))  # on held-out rows
+CLASSIFIER_MAX_TRAINING = int(os.getenv("CLASSIFIER_MAX_TRAINING", "20000"))  # most recent rows used
+CLASSIFIER_RETRAIN_SECONDS = int(os.getenv("CLASSIFIER_RETRAIN_SECONDS", "600"))
+
+_LABEL_LOOKUP = {label.lower(): label for label in LABELS}
+
+_stats_lock = threading.Lock()
+# per-process counters
+_stats = {"rules": 0, "model": 0, "llm": 0, "compared": 0, "agreed": 0}
+
+_train_lock = threading.Lock()
+_model = None
+
+
+def normalize_label(text):
+    """Map an LLM reply like "spam." or "TO-DO" to one of LABELS, or None."""
+    return _LABEL_LOOKUP.get((text or "").strip().strip(".!\"'").lower())
+
+
+def _sender_parts(sender):
+    address = (sender or "").lower()
+    match = re.search(r"<([^>]+)>", address)
+    if match:
+        address = match.group(1)
+    local, _, domain = address.strip().partition("@")
+    return local, domain
+
+
+# ---------- TIER 1: RULES ----------
+
+# (label, weight, test(local, domain, subject, body, headers)); the weights of
+# every rule that fires for a label are combined as independent evidence
+_RULES = [
+    ("Newsletter", 0.8, lambda l, d, s, b, h: re.search(r"newsletter|digest|news$|updates?$|marketing", l)),
+    ("Newsletter", 0.9, lambda l, d, s, b, h: "list-unsubscribe" in h or "list-id" in h),
+    ("Newsletter", 0.7, lambda l, d, s, b, h: "unsubscribe" in b or "view in browser" in b or "view this email in" in b),
+    ("Newsletter", 0.6, lambda l, d, s, b, h: re.search(r"\b(digest|newsletter|roundup|bulletin)\b", s)),
+    ("Spam", 0.85, lambda l, d, s, b, h: re.search(
+        r"you(?:'ve| have)? won|claim your (?:prize|reward)|you are selected|lottery|"
+        r"million dollars|wire transfer fee|100% free|risk[- ]free|act now",
+        f"{s} {b}",
+    )),
+    ("Spam", 0.6, lambda l, d, s, b, h: l == "spam" or re.search(r"\.(sale|win|click|loan|bid|xyz)$", d)),
+    ("Social", 0.85, lambda l, d, s, b, h: re.search(
+        r"(^|\.)(facebook|linkedin|instagram|twitter|x|meetup|reddit)\.com$", d
+    )),
+    ("Social", 0.7, lambda l, d, s, b, h: re.search(
+        r"tagged you|friend request|invited you to connect|wants to connect|mentioned you", b
+    )),
+    ("Social", 0.5, lambda l, d, s, b, h: l == "social"),
+]
+
+
+def rules_classify(email):
+    """Return (label, confidence) from the rules, or (None, 0.0) when none fire."""
+    local, domain = _sender_parts(email.get("sender"))
+    subject = (email.get("subject") or "").lower()
+    body = (email.get("body") or "")[:4000].lower()
+    headers = {str(k).lower() for k in (email.get("headers") or {})}
+
+    evidence = defaultdict(lambda: 1.0)  # label -> probability that every fired rule is wrong
+    for label, weight, test in _RULES:
+        if test(local, domain, subject, body, headers):
+            evidence[label] *= 1.0 - weight
+    if not evidence:
+        return None, 0.0
+
+    scores = {label: 1.0 - miss for label, miss in evidence.items()}
+    label = max(scores, key=scores.get)
+    confidence = scores[label]
+    for other, score in scores.items():
+        if other != label:
+            confidence *= 1.0 - score  # conflicting rules lower the confidence
+    return label, round(confidence, 4)
+
+
+# ---------- TIER 2: NAIVE BAYES ----------
+
+def _features(sender, subject, body):
+    local, domain = _sender_parts(sender)
+    features = {"from:" + local, "domain:" + domain}
+    features.update("s:" + t for t in tokenize(subject))
+    features.update(tokenize((body or "")[:4000]))
+    return features
+
+
+def _fit(samples):
+    """samples: [(label, features)] -> model dict (Bernoulli-style NB on unique features)."""
+    label_counts = Counter(label for label, _ in samples)
+    feature_counts = defaultdict(Counter)
+    vocab = set()
+    for label, features in samples:
+        feature_counts[label].update(features)
+        vocab.update(features)
+
+    total = len(samples)
+    vocab_size = len(vocab) + 1
+    model = {"priors": {}, "loglik": {}, "unseen": {}}
+    for label, n in label_counts.items():
+        tokens = sum(feature_counts[label].values())
+        denominator = tokens + vocab_size
+        model["priors"][label] = math.log(n / total)
+        model["loglik"][label] = {f: math.log((c + 1) / denominator) for f, c in feature_counts[label].items()}
+        model["unseen"][label] = math.log(1 / denominator)
+    return model
+
+
+def _predict(model, features):
+    scores = {}
+    known = [f for f in features if any(f in ll for ll in model["loglik"].values())]
+    # averaging over sqrt(n) damps naive Bayes' overconfidence on long messages
+    damp = math.sqrt(len(known)) or 1.0
+    for label, prior in model["priors"].items():
+        loglik, unseen = model["loglik"][label], model["unseen"][label]
+        scores[label] = prior + sum(loglik.get(f, unseen) for f in known) / damp
+    top = max(scores.values())
+    norm = sum(math.exp(s - top) for s in scores.values())
+    label = max(scores, key=scores.get)
+    return label, round(1.0 / norm, 4)
+
+
+def _load_samples():
+    """Labeled rows whose category came from the LLM (never our own guesses)."""
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT sender, subject, body, category FROM emails
+            WHERE category IS NOT NULL AND COALESCE(category_tier, 'llm') = 'llm'
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (CLASSIFIER_MAX_TRAINING,),
+        )
+        rows = cur.fetchall()
+    finally:
+        conn.close()
+    samples = []
+    for row in rows:
+        label = normalize_label(row["category"])
+        if label:
+            samples.append((label, _features(row["sender"], row["subject"], row["body"])))
+    return samples
+
+
+def train():
+    """
+    (Re)train the model from stored rows. A fifth of the rows is held out first to
+    measure precision at the default threshold; the model tier stays off unless
+    that precision reaches CLASSIFIER_MIN_PRECISION.
+    """
+    global _model
+    samples = _load_samples()
+    info = {
+        "trained_at": time.time(),
+        "trained_on": len(samples),
+        "labels": dict(Counter(label for label, _ in samples)),
+        "holdout": None,
+        "usable": False,
+    }
+
+    model = None
+    if len(samples) >= CLASSIFIER_MIN_TRAINING and len(info["labels"]) > 1:
+        holdout, fit_on = samples[::5], [s for i, s in enumerate(samples) if i % 5]
+        trial = _fit(fit_on)
+        confident = correct = 0
+        for label, features in holdout:
+            guess, confidence = _predict(trial, features)
+            if confidence >= CLASSIFIER_THRESHOLD:
+                confident += 1
+                correct += guess == label
+        precision = correct / confident if confident else None
+        info["holdout"] = {"rows": len(holdout), "confident": confident, "precision": precision}
+        info["usable"] = precision is not None and precision >= CLASSIFIER_MIN_PRECISION
+        model = _fit(samples)
+
+    _model = {"model": model, "info": info}
+    return info
+
+
+def _train_in_background():
+    """Start train() on a daemon thread, unless a training run is already going."""
+    if not _train_lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            train()
+        except Exception as e:
+            print("Warning: classifier training failed:", repr(e))
+        finally:
+            _train_lock.release()
+
+    threading.Thread(target=run, name="classifier-train", daemon=True).start()
+
+
+def _current_model():
+    """
+    The trained model, or None until the first training run (started on first
+    use, in the background) has finished: until then only the rules tier
+    answers, so no request waits for training. A stale model is retrained the
+    same way while the old one keeps serving.
+    """
+    current = _model
+    if current is None or time.time() - current["info"]["trained_at"] > CLASSIFIER_RETRAIN_SECONDS:
+        _train_in_background()
+    return current
+
+
+def model_classify(email):
+    """Return (label, confidence) from the trained model, or (None, 0.0) if it isn't usable (or trained) yet."""
+    current = _current_model()
+    if current is None or not current["info"]["usable"]:
+        return None, 0.0
+    features = _features(email.get("sender"), email.get("subject"), email.get("body"))
+    return _predict(current["model"], features)
+
+
+# ---------- CASCADE ----------
+
+def classify(email, threshold=None):
+    """
+    Run the local tiers in order. Returns {"category", "confidence", "tier", "guess"}:
+    category is None when no tier reached the threshold (the caller asks the LLM);
+    guess is the best local label either way, for agreement stats.
+    """
+    threshold = CLASSIFIER_THRESHOLD if threshold is None else threshold
+    best = {"category": None, "confidence": 0.0, "tier": "llm", "guess": None}
+    if not CLASSIFIER_ENABLED:
+        return best
+
+    for tier, fn in (("rules", rules_classify), ("model", model_classify)):
+        label, confidence = fn(email)
+        if label is None:
+            continue
+        if confidence >= threshold:
+            return {"category": label, "confidence": confidence, "tier": tier, "guess": label}
+        if confidence > best["confidence"]:
+            best.update(confidence=confidence, guess=label)
+    return best
+
+
+def record(decision, llm_category=None):
+    """Count which tier decided; for escalations, whether the LLM agreed with the local guess."""
+    with _stats_lock:
+        _stats[decision["tier"]] += 1
+        if decision["tier"] == "llm" and decision["guess"] and llm_category is not None:
+            _stats["compared"] += 1
+            _stats["agreed"] += normalize_label(llm_category) == decision["guess"]
+
+
+def classifier_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    decided = sum(stats[tier] for tier in TIERS)
+    current = _model
+    return {
+        "enabled": CLASSIFIER_ENABLED,
+        "threshold": CLASSIFIER_THRESHOLD,
+        "decisions": {tier: stats[tier] for tier in TIERS},
+        "escalation_rate": round(stats["llm"] / decided, 4) if decided else None,
+        # how often escalated emails got the label the local tiers would have picked
+        "escalated_agreement": round(stats["agreed"] / stats["compared"], 4) if stats["compared"] else None,
+        "model": current["info"] if current else None,
+    }
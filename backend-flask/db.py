@@ -1,25 +1,294 @@
 # db.py
-# SQLite helper: creates DB file & tables.
+# SQLite helper: creates DB file & tables, and hands out pooled connections.
 
+import asyncio
+import contextvars
+import functools
 import os
+import queue
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import DB_CONNECT_DURATION, DB_CONNECTIONS, DB_STATEMENT_DURATION
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
-DB_PATH = os.path.join(DATA_DIR, "app.db")
+DB_PATH = os.getenv("APP_DB_PATH", os.path.join(DATA_DIR, "app.db"))
 
+# Idle connections kept per process; extra ones are opened on demand and closed on release.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "10"))  # seconds to wait for a write lock
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384"))  # page cache per connection
+DB_MMAP_BYTES = int(os.getenv("DB_MMAP_BYTES", str(128 * 1024 * 1024)))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))  # prepared statements per connection
+DB_OFFLOAD_THREADS = int(os.getenv("DB_OFFLOAD_THREADS", str(DB_POOL_SIZE)))  # run_sync threads (ASGI mode)
 
-def get_connection():
-    conn = sqlite3.connect(DB_PATH)
+_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+_pool_pid = os.getpid()
+
+# Time spent inside SQLite for the current request: [seconds], or None outside
+# requests. A context variable, so calls offloaded with run_sync still count.
+_db_time = contextvars.ContextVar("db_time", default=None)
+
+
+def reset_db_time():
+    _db_time.set([0.0])
+
+
+def db_time_ms():
+    """Milliseconds spent executing statements, fetching and committing since reset_db_time()."""
+    spent = _db_time.get()
+    return round(spent[0] * 1000, 2) if spent else 0.0
+
+
+def _timed(method, operation=None):
+    """Wrap a cursor/connection method to add its time to db_time_ms() (and, for
+    statement-level operations, to the db_statement_duration_seconds histogram)."""
+
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            spent = _db_time.get()
+            if spent is not None:
+                spent[0] += elapsed
+            if operation:
+                DB_STATEMENT_DURATION.observe(elapsed, operation=operation)
+
+    return wrapper
+
+
+class TimedCursor(sqlite3.Cursor):
+    # SQLite does most of its work while rows are stepped through, so fetches count too
+    execute = _timed(sqlite3.Cursor.execute, "execute")
+    executemany = _timed(sqlite3.Cursor.executemany, "executemany")
+    fetchone = _timed(sqlite3.Cursor.fetchone)
+    fetchmany = _timed(sqlite3.Cursor.fetchmany)
+    fetchall = _timed(sqlite3.Cursor.fetchall)
+    __next__ = _timed(sqlite3.Cursor.__next__)
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    sqlite3 connection whose close() hands it back to the pool.
+    Callers keep the usual get_connection() ... conn.close() pattern.
+    Statements run through TimedCursor, so db_time_ms() covers them.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    commit = _timed(sqlite3.Connection.commit, "commit")
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        self.row_factory = sqlite3.Row
+        if self.pid != os.getpid():
+            # opened by the parent process before a fork; never reuse it here
+            return
+        try:
+            _pool.put_nowait(self)
+        except queue.Full:
+            super().close()
+
+
+def _open_connection():
+    # check_same_thread=False: a pooled connection moves between threads,
+    # but the pool guarantees only one thread uses it at a time.
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False,
+        factory=PooledConnection,
+    )
     conn.row_factory = sqlite3.Row  # return rows like dicts
+    conn.pid = os.getpid()
+    conn.execute("PRAGMA synchronous=NORMAL")  # safe with WAL, far fewer fsyncs
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_BYTES}")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
 
+def get_connection():
+    """
+    Return a pooled connection. Call conn.close() when done; that returns it
+    to the pool (rolling back anything left uncommitted).
+    Each process has its own pool, so gunicorn workers never share connections.
+    """
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        _pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+        _pool_pid = os.getpid()
+
+    try:
+        conn = _pool.get_nowait()
+        DB_CONNECTIONS.inc(source="pool")
+        return conn
+    except queue.Empty:
+        started = time.perf_counter()
+        conn = _open_connection()
+        DB_CONNECT_DURATION.observe(time.perf_counter() - started)
+        DB_CONNECTIONS.inc(source="new")
+        return conn
+
+
+# ---------- ASYNC OFFLOAD ----------
+
+_offload = {"pid": None, "executor": None}
+_offload_lock = threading.Lock()
+
+
+def _offload_executor():
+    if _offload["pid"] != os.getpid():  # threads don't survive a fork
+        with _offload_lock:
+            if _offload["pid"] != os.getpid():
+                _offload["executor"] = ThreadPoolExecutor(DB_OFFLOAD_THREADS, thread_name_prefix="db")
+                _offload["pid"] = os.getpid()
+    return _offload["executor"]
+
+
+async def run_sync(fn, *args, **kwargs):
+    """
+    Await a blocking call (SQLite, file I/O) from a coroutine. It runs on a
+    bounded thread pool, at most DB_OFFLOAD_THREADS at once, with the
+    caller's context (request timings).
+    """
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_offload_executor(), call)
+
+
+# ---------- ACTIVE PROMPT CACHE ----------
+
+# Latest prompt per type, cached per process. Any write to the prompts table
+# bumps app_meta.prompts_version (via triggers), so every worker notices the
+# change on its next lookup with a single primary-key read.
+_prompt_cache = {}
+_prompt_cache_version = None
+_prompt_cache_lock = threading.Lock()
+
+
+def get_active_prompts(ptypes):
+    """Return {type: {"id", "content"} or None} for the latest prompt of each type."""
+    global _prompt_cache_version
+
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM app_meta WHERE key = 'prompts_version'")
+        row = cur.fetchone()
+        version = row["value"] if row else None
+
+        with _prompt_cache_lock:
+            if version != _prompt_cache_version:
+                _prompt_cache.clear()
+                _prompt_cache_version = version
+            result = {p: _prompt_cache[p] for p in ptypes if p in _prompt_cache}
+
+        for ptype in ptypes:
+            if ptype in result:
+                continue
+            cur.execute(
+                "SELECT id, content FROM prompts WHERE type = ? ORDER BY created_at DESC, id DESC LIMIT 1",
+                (ptype,),
+            )
+            row = cur.fetchone()
+            result[ptype] = dict(row) if row else None
+            with _prompt_cache_lock:
+                if version == _prompt_cache_version:
+                    _prompt_cache[ptype] = result[ptype]
+    finally:
+        conn.close()
+
+    return result
+
+
+def invalidate_prompt_cache():
+    """Drop this process's cached prompts (other workers see the version bump)."""
+    global _prompt_cache_version
+    with _prompt_cache_lock:
+        _prompt_cache.clear()
+        _prompt_cache_version = None
+
+
+def fts_available(conn):
+    cur = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'emails_fts'")
+    return cur.fetchone() is not None
+
+
+def init_fts(cur):
+    """
+    Create the emails_fts FTS5 table and the triggers that keep it in sync.
+    Only subject/body/sender are indexed, so category updates from processing
+    don't touch the index. Skipped (with a warning) if SQLite lacks FTS5.
+    """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'emails_fts'")
+    if cur.fetchone() is None:
+        try:
+            cur.execute(
+                """
+                CREATE VIRTUAL TABLE emails_fts USING fts5(
+                    subject, body, sender,
+                    content='emails', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+                """
+            )
+        except sqlite3.OperationalError as e:
+            print("WARNING: SQLite FTS5 unavailable, search disabled:", e)
+            return
+        # index rows that existed before the table
+        cur.execute("INSERT INTO emails_fts(emails_fts) VALUES ('rebuild')")
+
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN
+            INSERT INTO emails_fts(rowid, subject, body, sender)
+            VALUES (new.id, new.subject, new.body, new.sender);
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN
+            INSERT INTO emails_fts(emails_fts, rowid, subject, body, sender)
+            VALUES ('delete', old.id, old.subject, old.body, old.sender);
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE OF subject, body, sender ON emails BEGIN
+            INSERT INTO emails_fts(emails_fts, rowid, subject, body, sender)
+            VALUES ('delete', old.id, old.subject, old.body, old.sender);
+            INSERT INTO emails_fts(rowid, subject, body, sender)
+            VALUES (new.id, new.subject, new.body, new.sender);
+        END
+        """
+    )
+
+
 def init_db():
     conn = get_connection()
     cur = conn.cursor()
 
+    # WAL lets readers run while a writer commits (persistent, stored in the DB file)
+    cur.execute("PRAGMA journal_mode=WAL")
+
     # prompts table
     cur.execute(
         """
@@ -33,6 +302,31 @@ def init_db():
         """
     )
 
+    # latest-prompt-per-type lookups walk this index instead of sorting the table
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_prompts_type_created ON prompts(type, created_at DESC, id DESC)"
+    )
+
+    # small key/value table for counters shared by all workers
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS app_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+        """
+    )
+    cur.execute("INSERT OR IGNORE INTO app_meta(key, value) VALUES ('prompts_version', 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS prompts_version_{event.lower()} AFTER {event} ON prompts
+            BEGIN
+                UPDATE app_meta SET value = value + 1 WHERE key = 'prompts_version';
+            END
+            """
+        )
+
     # emails table
     cur.execute(
         """
@@ -51,6 +345,79 @@ def init_db():
         """
     )
 
+    # idempotency key: one processed row per (message, body, template version).
+    # Columns added after the first release, so migrate existing databases.
+    cur.execute("PRAGMA table_info(emails)")
+    existing = {row["name"] for row in cur.fetchall()}
+    for column in ("body_hash", "prompt_version"):
+        if column not in existing:
+            cur.execute(f"ALTER TABLE emails ADD COLUMN {column} TEXT")
+    cur.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_emails_dedupe
+        ON emails(COALESCE(external_id, ''), body_hash, prompt_version)
+        """
+    )
+
+    # which classifier tier chose the category ("rules", "model", "llm");
+    # NULL for rows stored before the cascade existed (those came from the LLM)
+    if "category_tier" not in existing:
+        cur.execute("ALTER TABLE emails ADD COLUMN category_tier TEXT")
+
+    # time-ordered scans for the NDJSON export (export.py)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_emails_created ON emails(created_at, id)")
+
+    # full-text index over emails (external content: the text lives only in emails)
+    init_fts(cur)
+
+    # background jobs (see jobs.py); rows outlive the process that queued them
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            payload_json TEXT NOT NULL,
+            result_json TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            lease_until REAL,
+            run_after REAL,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+        """
+    )
+    # run_after (retry backoff) came after the first jobs release
+    cur.execute("PRAGMA table_info(jobs)")
+    if "run_after" not in {row["name"] for row in cur.fetchall()}:
+        cur.execute("ALTER TABLE jobs ADD COLUMN run_after REAL")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at)")
+
+    # inbox change feed (see inbox.py): the last seen content hash per message,
+    # and one row per message added, changed or removed in the inbox source
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS inbox_state (
+            external_id TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS inbox_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            external_id TEXT NOT NULL,
+            change TEXT NOT NULL,
+            job_id TEXT,
+            changed_at REAL NOT NULL
+        )
+        """
+    )
+
     # drafts table
     cur.execute(
         """
@@ -63,6 +430,8 @@ def init_db():
         )
         """
     )
+    # newest-first keyset pagination of GET /api/drafts
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_drafts_created ON drafts(created_at DESC, id DESC)")
 
     conn.commit()
     conn.close()
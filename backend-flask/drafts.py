@@ -0,0 +1,146 @@
+# drafts.py
+# Saved reply drafts. GET /api/drafts pages through them newest first with a
+# keyset cursor on (created_at, id), so a page costs the same however many
+# drafts exist; meta_json is only decoded for callers that ask for "meta".
+
+import base64
+import json
+
+from db import get_connection
+from utils import safe_json_loads
+
+PAGE_SIZE_DEFAULT = 20
+PAGE_SIZE_MAX = 200
+
+FIELDS = ("id", "subject", "body", "created_at", "meta")
+LIST_FIELDS_DEFAULT = ("id", "subject", "body", "created_at")  # meta only on request
+
+_COLUMNS = {"id": "id", "subject": "subject", "body": "body", "created_at": "created_at", "meta": "meta_json"}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _encode_cursor(created_at, draft_id):
+    raw = json.dumps([created_at, draft_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor):
+    try:
+        created_at, draft_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(created_at), int(draft_id)
+    except Exception:
+        raise InvalidCursor("invalid cursor")
+
+
+def _to_draft(row):
+    draft = dict(row)
+    if "meta_json" in draft:
+        draft["meta"] = safe_json_loads(draft.get("meta_json"), None)
+    return draft
+
+
+def iter_all(fetch_size=500):
+    """
+    Every draft, newest first, with meta decoded. Read in keyset pages, each
+    its own short read, so a slow client never keeps a read snapshot open.
+    """
+    last = None
+    while True:
+        where, params = "", []
+        if last is not None:
+            where, params = "WHERE (created_at, id) < (?, ?)", list(last)
+        conn = get_connection()
+        try:
+            rows = conn.execute(
+                f"SELECT id, subject, body, meta_json, created_at FROM drafts {where} "
+                "ORDER BY created_at DESC, id DESC LIMIT ?",
+                (*params, fetch_size),
+            ).fetchall()
+        finally:
+            conn.close()
+
+        for row in rows:
+            yield _to_draft(row)
+        if len(rows) < fetch_size:
+            return
+        last = (rows[-1]["created_at"], rows[-1]["id"])
+
+
+def iter_json_array():
+    """The unpaginated GET /api/drafts body (a JSON array) in pieces, without building the list."""
+    yield "["
+    for n, draft in enumerate(iter_all()):
+        yield ("," if n else "") + json.dumps(draft)
+    yield "]\n"
+
+
+def count_estimate(conn):
+    """
+    Approximate number of drafts from the rowid range (two b-tree seeks instead
+    of a COUNT(*) scan); exact unless drafts have been deleted.
+    """
+    low, high = conn.execute("SELECT MIN(id), MAX(id) FROM drafts").fetchone()
+    return 0 if high is None else high - low + 1
+
+
+def page(cursor=None, limit=PAGE_SIZE_DEFAULT, fields=None):
+    """
+    Return one page of drafts, newest first: {"items", "next_cursor", "total_estimate"}.
+    cursor is the opaque next_cursor of the previous page; fields picks the keys
+    per draft from FIELDS (default LIST_FIELDS_DEFAULT, "id" is always included).
+    Leaving out "body" skips reading bodies, and meta is decoded only when asked for.
+    """
+    fields = list(fields or LIST_FIELDS_DEFAULT)
+    unknown = [f for f in fields if f not in _COLUMNS]
+    if unknown:
+        raise ValueError(f"unknown field(s): {', '.join(unknown)}; choose from {', '.join(FIELDS)}")
+    limit = max(1, min(limit, PAGE_SIZE_MAX))
+
+    # created_at and id are always read: they make up the cursor
+    selected = ["id", "created_at"] + [f for f in fields if f not in ("id", "created_at")]
+    columns = ", ".join(_COLUMNS[f] for f in selected)
+    where, params = "", []
+    if cursor:
+        where = "WHERE (created_at, id) < (?, ?)"
+        params.extend(_decode_cursor(cursor))
+
+    conn = get_connection()
+    try:
+        rows = conn.execute(
+            f"SELECT {columns} FROM drafts {where} ORDER BY created_at DESC, id DESC LIMIT ?",
+            (*params, limit + 1),
+        ).fetchall()
+        total = count_estimate(conn)
+    finally:
+        conn.close()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+
+    keep = set(fields) | {"id"}
+    items = []
+    for row in rows:
+        draft = _to_draft(row)
+        items.append({k: draft[k] for k in FIELDS if k in keep})
+    return {"items": items, "next_cursor": next_cursor, "total_estimate": total}
+
+
+def create(subject, body, meta=None):
+    """Insert a draft and return it as stored (with created_at and decoded meta)."""
+    meta_json = json.dumps(meta) if meta is not None else None
+    conn = get_connection()
+    try:
+        row = conn.execute(
+            "INSERT INTO drafts(subject, body, meta_json) VALUES (?, ?, ?) "
+            "RETURNING id, subject, body, meta_json, created_at",
+            (subject, body, meta_json),
+        ).fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    return _to_draft(row)
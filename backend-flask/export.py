@@ -0,0 +1,235 @@
+# export.py
+# Streaming NDJSON export of processed emails, extracted actions and saved
+# drafts for analytics. Rows are read in keyset pages on (created_at, id),
+# each in its own short read, and encoded as they arrive: memory stays flat
+# however many rows match, the first bytes go out after the first page, and a
+# slow client never holds a read snapshot open (which would stop SQLite from
+# checkpointing the WAL while the API keeps writing).
+#
+#   python export.py emails --since 2025-11-01 --category Work,Urgent -o emails.ndjson
+#   python export.py actions --gzip -o actions.ndjson.gz
+#   python export.py drafts --until 2025-12-01T00:00:00
+
+import argparse
+import json
+import os
+import sys
+import zlib
+from datetime import datetime, timezone
+
+from db import get_connection, init_db
+from utils import safe_json_loads
+
+EXPORT_KINDS = ("emails", "actions", "drafts")
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "500"))  # rows per page (one short read each)
+EXPORT_FLUSH_BYTES = int(os.getenv("EXPORT_FLUSH_BYTES", "65536"))  # encoded bytes per chunk written/sent
+
+_EMAIL_COLUMNS = "id, external_id, sender, subject, timestamp, category, category_tier, prompt_version, created_at"
+
+
+# ---------- FILTERS ----------
+
+def parse_time(value, name="time"):
+    """
+    An ISO 8601 date or datetime as SQLite's CURRENT_TIMESTAMP text (UTC,
+    'YYYY-MM-DD HH:MM:SS'), the form created_at is stored in; None passes through.
+    """
+    if value in (None, ""):
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO 8601 date or datetime")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def parse_categories(value):
+    """A comma-separated string or a list of categories as a list ([] = no filter)."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [c.strip() for c in value if c and c.strip()]
+
+
+def _where(kind, since=None, until=None, categories=None, processed=False):
+    """WHERE conditions and parameters for one export; since is inclusive, until exclusive."""
+    clauses, params = [], []
+    if since:
+        clauses.append("created_at >= ?")
+        params.append(since)
+    if until:
+        clauses.append("created_at < ?")
+        params.append(until)
+    if categories:
+        if kind == "drafts":
+            raise ValueError("drafts have no category; drop the category filter")
+        clauses.append(f"category IN ({', '.join('?' * len(categories))})")
+        params.extend(categories)
+    if kind == "actions":
+        clauses.append("actions_json IS NOT NULL")
+    elif processed and kind == "emails":
+        clauses.append("category IS NOT NULL")
+    return clauses, params
+
+
+# ---------- ROWS ----------
+
+def _iter_rows(columns, table, clauses, params, fetch_size):
+    """
+    Yield the matching rows oldest first, one keyset page of fetch_size at a
+    time. The connection goes back to the pool before a page's rows are
+    yielded, so no read is open while the caller (the client) is slow.
+    columns must include created_at and id.
+    """
+    last = None
+    while True:
+        page_clauses, page_params = list(clauses), list(params)
+        if last is not None:
+            page_clauses.append("(created_at, id) > (?, ?)")
+            page_params.extend(last)
+        where = f"WHERE {' AND '.join(page_clauses)}" if page_clauses else ""
+        conn = get_connection()
+        try:
+            rows = conn.execute(
+                f"SELECT {columns} FROM {table} {where} ORDER BY created_at, id LIMIT ?", (*page_params, fetch_size)
+            ).fetchall()
+        finally:
+            conn.close()
+
+        yield from rows
+        if len(rows) < fetch_size:
+            return
+        last = (rows[-1]["created_at"], rows[-1]["id"])
+
+
+def iter_records(kind, since=None, until=None, categories=None, processed=False, body=False,
+                 fetch_size=EXPORT_FETCH_SIZE):
+    """
+    Yield export records of one kind, oldest first (created_at, id):
+    emails: one dict per stored email (body only when asked for);
+    actions: one dict per extracted action, with its email's id, category and created_at;
+    drafts: one dict per saved draft, meta decoded.
+    since/until are parse_time() strings; raises ValueError on an unknown kind or bad filter.
+    """
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"kind must be one of {', '.join(EXPORT_KINDS)}")
+    clauses, params = _where(kind, since, until, categories, processed)
+
+    if kind == "emails":
+        columns = _EMAIL_COLUMNS + (", body" if body else "") + ", actions_json"
+        # each page is a seek into idx_emails_created, not a sort of the whole table
+        for row in _iter_rows(columns, "emails", clauses, params, fetch_size):
+            record = dict(row)
+            record["actions"] = safe_json_loads(record.pop("actions_json"), None)
+            yield record
+
+    elif kind == "actions":
+        columns = "id, external_id, category, actions_json, created_at"
+        for row in _iter_rows(columns, "emails", clauses, params, fetch_size):
+            actions = safe_json_loads(row["actions_json"], None)
+            if not isinstance(actions, list):
+                continue
+            for n, action in enumerate(actions):
+                yield {
+                    "email_id": row["id"],
+                    "external_id": row["external_id"],
+                    "category": row["category"],
+                    "index": n,
+                    "action": action,
+                    "created_at": row["created_at"],
+                }
+
+    else:
+        for row in _iter_rows("id, subject, body, meta_json, created_at", "drafts", clauses, params, fetch_size):
+            record = dict(row)
+            record["meta"] = safe_json_loads(record.pop("meta_json"), None)
+            yield record
+
+
+# ---------- ENCODING ----------
+
+def iter_ndjson(records, flush_bytes=EXPORT_FLUSH_BYTES):
+    """
+    Encode records as NDJSON bytes, grouped into chunks of about flush_bytes.
+    The first record goes out on its own, so a client sees data right away.
+    """
+    buffer, size, first = [], 0, True
+    for record in records:
+        line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        buffer.append(line)
+        size += len(line)
+        if first or size >= flush_bytes:
+            first = False
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def iter_gzip(chunks, level=6):
+    """
+    Gzip a stream of byte chunks. Every chunk is sync-flushed, so the receiver
+    can decompress everything sent so far instead of waiting for the end.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(kind, since=None, until=None, categories=None, processed=False, body=False, compress=False):
+    """
+    NDJSON (optionally gzip) byte chunks for one export. The filters are
+    checked before the first chunk is produced, so a bad request raises
+    ValueError here rather than halfway through a response.
+    """
+    since, until = parse_time(since, "since"), parse_time(until, "until")
+    categories = parse_categories(categories)
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"kind must be one of {', '.join(EXPORT_KINDS)}")
+    _where(kind, since, until, categories, processed)
+
+    chunks = iter_ndjson(iter_records(kind, since, until, categories, processed, body))
+    return iter_gzip(chunks) if compress else chunks
+
+
+# ---------- CLI ----------
+
+def main():
+    parser = argparse.ArgumentParser(description="Export emails, extracted actions or drafts as NDJSON.")
+    parser.add_argument("kind", choices=EXPORT_KINDS)
+    parser.add_argument("--since", help="created at or after (ISO 8601, UTC unless an offset is given)")
+    parser.add_argument("--until", help="created before (ISO 8601)")
+    parser.add_argument("--category", help="comma-separated categories (emails and actions)")
+    parser.add_argument("--processed", action="store_true", help="only emails that have a category")
+    parser.add_argument("--body", action="store_true", help="include email bodies")
+    parser.add_argument("--gzip", action="store_true", help="gzip the output")
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    args = parser.parse_args()
+
+    init_db()
+    try:
+        chunks = export_stream(
+            args.kind, args.since, args.until, args.category, args.processed, args.body, args.gzip
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+        else:
+            out.flush()
+
+
+if __name__ == "__main__":
+    main()
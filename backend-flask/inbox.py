@@ -0,0 +1,327 @@
+# inbox.py
+# Id-indexed, in-memory view of the inbox source (data/mock_inbox.json).
+# The file is parsed once and re-read only when its mtime/size change.
+# Each re-read is diffed against the last recorded state into a change log
+# (GET /api/inbox/changes?since=<cursor>), and new or changed messages are
+# queued for processing, so clients and workers only handle what is new.
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+
+import jobs
+from db import get_connection
+from ingest import ingest_records
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+MOCK_INBOX_PATH = os.path.join(DATA_DIR, "mock_inbox.json")
+
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 500
+CHANGES_PAGE_DEFAULT = 100
+CHANGES_PAGE_MAX = 1000
+
+INBOX_AUTO_PROCESS = os.getenv("INBOX_AUTO_PROCESS", "1") != "0"  # queue a "process" job per new/changed message
+# also queue jobs for the messages already in the inbox the first time it is seen (empty change log)
+INBOX_PROCESS_EXISTING = os.getenv("INBOX_PROCESS_EXISTING", "0") == "1"
+INBOX_WATCH_SECONDS = float(os.getenv("INBOX_WATCH_SECONDS", "2"))  # source file check interval (0 = on requests only)
+
+_lock = threading.Lock()
+# Replaced as a whole on reload, so readers never see a half-updated view
+_state = {
+    "signature": None,  # (mtime_ns, size) of the file we parsed
+    "emails": [],
+    "positions": {},  # id -> index in "emails"
+    "etag": None,
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _refresh():
+    """Re-parse the inbox file if it changed on disk; returns the current state."""
+    global _state
+
+    st = os.stat(MOCK_INBOX_PATH)
+    signature = (st.st_mtime_ns, st.st_size)
+    state = _state
+    if state["signature"] == signature:
+        return state
+
+    with _lock:
+        if _state["signature"] == signature:
+            return _state
+        with open(MOCK_INBOX_PATH, "rb") as f:
+            raw = f.read()
+        emails = json.loads(raw)
+        _state = {
+            "signature": signature,
+            "emails": emails,
+            "positions": {str(e.get("id")): i for i, e in enumerate(emails)},
+            "etag": hashlib.sha1(raw).hexdigest(),
+        }
+        return _state
+
+
+_synced_etag = None
+_sync_lock = threading.Lock()
+
+
+def sync_to_db():
+    """
+    Copy inbox messages into the emails table so they can be searched.
+    Runs only when the inbox changed; already-stored messages are skipped.
+    """
+    global _synced_etag
+    with _sync_lock:
+        state = _refresh()
+        if state["etag"] == _synced_etag:
+            return
+        ingest_records(state["emails"])
+        _synced_etag = state["etag"]
+
+
+def exists():
+    return os.path.exists(MOCK_INBOX_PATH)
+
+
+def etag():
+    """Changes whenever the inbox content changes; valid for every inbox response."""
+    return _refresh()["etag"]
+
+
+def all_emails():
+    return _refresh()["emails"]
+
+
+def get_email(email_id):
+    state = _refresh()
+    pos = state["positions"].get(str(email_id))
+    return state["emails"][pos] if pos is not None else None
+
+
+def get_stored_email(email_id):
+    """Look up a message that isn't in the inbox file (e.g. imported by ingest.py)."""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT external_id AS id, sender, subject, timestamp, body FROM emails
+        WHERE external_id = ?
+        ORDER BY category IS NULL, id DESC
+        LIMIT 1
+        """,
+        (str(email_id),),
+    )
+    row = cur.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def _encode_cursor(email_id):
+    return base64.urlsafe_b64encode(str(email_id).encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except Exception:
+        raise InvalidCursor("invalid cursor")
+
+
+def page(cursor=None, limit=PAGE_SIZE_DEFAULT, fields=None):
+    """
+    Return one page of the inbox in source order.
+    cursor is the opaque next_cursor of the previous page; fields limits the
+    keys returned per email ("id" is always included).
+    """
+    state = _refresh()
+    emails = state["emails"]
+    limit = max(1, min(limit, PAGE_SIZE_MAX))
+
+    start = 0
+    if cursor:
+        pos = state["positions"].get(_decode_cursor(cursor))
+        if pos is None:
+            raise InvalidCursor("cursor refers to an email that no longer exists")
+        start = pos + 1
+
+    items = emails[start:start + limit]
+    if fields:
+        keep = set(fields) | {"id"}
+        items = [{k: v for k, v in e.items() if k in keep} for e in items]
+
+    next_cursor = None
+    if start + limit < len(emails):
+        next_cursor = _encode_cursor(emails[start + limit - 1].get("id"))
+
+    return {"items": items, "next_cursor": next_cursor, "total": len(emails)}
+
+
+# ---------- CHANGE LOG ----------
+
+_recorded_etag = None
+_record_lock = threading.Lock()
+_watcher = {"pid": None}
+
+
+def _content_hash(email):
+    return hashlib.sha1(json.dumps(email, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def record_changes():
+    """
+    Diff the inbox source against the recorded state and append one
+    inbox_changes row per message added, changed or removed. Added and changed
+    messages get a "process" job in the same transaction (INBOX_AUTO_PROCESS),
+    at "batch" priority so they queue behind interactive requests. The first
+    diff against an empty change log only records the inbox as it is, without
+    jobs, unless INBOX_PROCESS_EXISTING is set. Does nothing unless the file changed since this process last looked;
+    returns the number of changes recorded.
+    """
+    global _recorded_etag
+    with _record_lock:
+        state = _refresh()
+        if state["etag"] == _recorded_etag:
+            return 0
+
+        current = {}  # id -> (email, hash), in file order; messages without an id can't be tracked
+        for email in state["emails"]:
+            if email.get("id") is not None:
+                current[str(email["id"])] = (email, _content_hash(email))
+
+        conn = get_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")  # one process diffs at a time; the others then see its state
+            known = dict(conn.execute("SELECT external_id, content_hash FROM inbox_state").fetchall())
+            updated = [
+                (i, "changed" if i in known else "added")
+                for i, (_, content_hash) in current.items()
+                if known.get(i) != content_hash
+            ]
+            removed = [i for i in known if i not in current]
+            first_sight = conn.execute("SELECT 1 FROM inbox_changes LIMIT 1").fetchone() is None
+
+            enqueue_jobs = bool(INBOX_AUTO_PROCESS and updated and (INBOX_PROCESS_EXISTING or not first_sight))
+            job_ids = [None] * len(updated)
+            if enqueue_jobs:
+                job_ids = jobs.insert_jobs(
+                    conn, "process", [{"email": current[i][0], "priority": "batch"} for i, _ in updated]
+                )
+            now = time.time()
+            conn.executemany(
+                "INSERT INTO inbox_changes(external_id, change, job_id, changed_at) VALUES (?, ?, ?, ?)",
+                [(i, change, job_id, now) for (i, change), job_id in zip(updated, job_ids)]
+                + [(i, "removed", None, now) for i in removed],
+            )
+            conn.executemany(
+                """
+                INSERT INTO inbox_state(external_id, content_hash) VALUES (?, ?)
+                ON CONFLICT(external_id) DO UPDATE SET content_hash = excluded.content_hash
+                """,
+                [(i, current[i][1]) for i, _ in updated],
+            )
+            conn.executemany("DELETE FROM inbox_state WHERE external_id = ?", [(i,) for i in removed])
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        _recorded_etag = state["etag"]
+    if enqueue_jobs:
+        jobs.notify()
+    return len(updated) + len(removed)
+
+
+def _encode_change_cursor(seq):
+    return base64.urlsafe_b64encode(f"seq:{seq}".encode("ascii")).decode("ascii")
+
+
+def _decode_change_cursor(cursor):
+    try:
+        prefix, _, seq = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii").partition(":")
+        if prefix != "seq":
+            raise ValueError
+        return int(seq)
+    except Exception:
+        raise InvalidCursor("invalid cursor")
+
+
+def changes(since=None, limit=CHANGES_PAGE_DEFAULT):
+    """
+    Messages added, changed or removed after the since cursor (from the start
+    of the log without one), oldest first: {"changes", "next_cursor",
+    "has_more"}. Each change has "id", "change", "job_id" (the queued
+    processing job) and, unless removed, the current "email". A message that
+    changed several times within the page appears once, at its last change.
+    next_cursor is always set: pass it back as since to get only newer changes.
+    """
+    if exists():
+        record_changes()
+    seq = _decode_change_cursor(since) if since else 0
+    limit = max(1, min(limit, CHANGES_PAGE_MAX))
+
+    conn = get_connection()
+    try:
+        (last_seq,) = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM inbox_changes").fetchone()
+        rows = conn.execute(
+            """
+            SELECT seq, external_id, change, job_id, changed_at FROM inbox_changes
+            WHERE seq > ? ORDER BY seq LIMIT ?
+            """,
+            (seq, limit + 1),
+        ).fetchall()
+    finally:
+        conn.close()
+    if seq > last_seq:
+        raise InvalidCursor("cursor is ahead of the change log (was it reset?); start again without since")
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    latest = {}
+    for row in rows:
+        latest.pop(row["external_id"], None)  # re-insert: ordered by last change
+        latest[row["external_id"]] = row
+
+    items = []
+    for row in latest.values():
+        item = {
+            "id": row["external_id"],
+            "change": row["change"],
+            "job_id": row["job_id"],
+            "changed_at": row["changed_at"],
+        }
+        if row["change"] != "removed":
+            item["email"] = get_email(row["external_id"])
+        items.append(item)
+
+    next_seq = rows[-1]["seq"] if rows else seq
+    return {"changes": items, "next_cursor": _encode_change_cursor(next_seq), "has_more": has_more}
+
+
+def _watch():
+    while True:
+        time.sleep(INBOX_WATCH_SECONDS)
+        try:
+            if exists():
+                record_changes()
+        except Exception as e:
+            print("Warning: inbox change check failed:", e)
+
+
+def start_watcher():
+    """Check the inbox source every INBOX_WATCH_SECONDS in this process (no-op if running or disabled)."""
+    if INBOX_WATCH_SECONDS <= 0 or _watcher["pid"] == os.getpid():
+        return
+    with _record_lock:
+        if _watcher["pid"] == os.getpid():
+            return
+        threading.Thread(target=_watch, name="inbox-watch", daemon=True).start()
+        _watcher["pid"] = os.getpid()
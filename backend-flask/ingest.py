@@ -0,0 +1,274 @@
+# ingest.py
+# Streaming bulk import of mail dumps (mbox or JSONL) into the emails table.
+# Files are read line by line, so memory stays bounded by the largest single
+# message; rows go in with batched executemany inside large transactions.
+#
+#   python ingest.py archive.mbox
+#   python ingest.py export.jsonl.gz --batch-size 5000
+
+import argparse
+import gzip
+import json
+import os
+import re
+import time
+from email import policy
+from email.header import decode_header, make_header
+from email.parser import BytesParser
+from email.utils import parsedate_to_datetime
+
+from db import get_connection, init_db
+from utils import body_hash
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "1000"))  # rows per executemany
+INGEST_COMMIT_EVERY = int(os.getenv("INGEST_COMMIT_EVERY", "50000"))  # rows per transaction
+INGEST_FORMATS = ("mbox", "jsonl")
+
+# Skips messages already stored with the same id and body, so re-importing a
+# dump is a no-op (the lookup is served by idx_emails_dedupe)
+INSERT_SQL = """
+    INSERT INTO emails(external_id, sender, subject, timestamp, body, body_hash)
+    SELECT ?, ?, ?, ?, ?, ?
+    WHERE NOT EXISTS (
+        SELECT 1 FROM emails WHERE COALESCE(external_id, '') = ? AND body_hash = ?
+    )
+"""
+
+# compat32 is several times faster than policy.default; headers and
+# payloads are decoded by hand below
+_parser = BytesParser(policy=policy.compat32)
+_TAG_RE = re.compile(r"<[^>]+>")
+
+
+# ---------- PARSERS ----------
+
+def _count_bytes(lines, stats):
+    for line in lines:
+        stats["bytes"] += len(line)
+        yield line
+
+
+def iter_jsonl(lines):
+    """Yield one dict per non-empty JSON line; undecodable lines yield None."""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def iter_mbox(lines):
+    """
+    Yield one normalized email dict per message of an mbox stream.
+    A message starts at a "From " line that follows a blank line (or the start).
+    """
+    current = []
+    prev_blank = True
+    for line in lines:
+        if line.startswith(b"From ") and prev_blank:
+            if current:
+                yield _message_to_email(current)
+            current = []
+        else:
+            # mboxrd/mboxo escape body lines that start with "From "
+            if line.startswith(b">From ") or line.startswith(b">>From "):
+                line = line[1:]
+            current.append(line)
+        prev_blank = line in (b"\n", b"\r\n")
+    if current:
+        yield _message_to_email(current)
+
+
+def _header(msg, name):
+    value = msg.get(name)
+    if value is None:
+        return None
+    value = str(value)
+    if "=?" in value:  # RFC 2047 encoded words
+        try:
+            value = str(make_header(decode_header(value)))
+        except Exception:
+            pass
+    return value.strip()
+
+
+def _text_body(msg):
+    """Decoded text/plain body (falls back to tag-stripped text/html)."""
+    html = None
+    for part in msg.walk():
+        ctype = part.get_content_type()
+        if ctype not in ("text/plain", "text/html") or part.get_filename():
+            continue
+        payload = part.get_payload(decode=True) or b""
+        text = payload.decode(part.get_content_charset() or "utf-8", errors="replace")
+        if ctype == "text/plain":
+            return text
+        if html is None:
+            html = _TAG_RE.sub("", text)
+    return html or ""
+
+
+def _message_to_email(lines):
+    try:
+        msg = _parser.parsebytes(b"".join(lines))
+
+        timestamp = _header(msg, "Date")
+        if timestamp:
+            try:
+                timestamp = parsedate_to_datetime(timestamp).isoformat()
+            except (TypeError, ValueError):
+                pass
+
+        return {
+            "id": (_header(msg, "Message-ID") or "").strip("<>") or None,
+            "sender": _header(msg, "From"),
+            "subject": _header(msg, "Subject"),
+            "timestamp": timestamp,
+            "body": _text_body(msg),
+        }
+    except Exception as e:
+        print("Warning: skipping unparseable message:", repr(e))
+        return None
+
+
+def _to_row(record):
+    """Map an email dict (mock_inbox.json schema, plus common aliases) to an INSERT row."""
+    if not isinstance(record, dict):
+        return None
+    body = record.get("body") or record.get("text")
+    if not body:
+        return None
+    external_id = record.get("id") or record.get("message_id")
+    external_id = None if external_id is None else str(external_id)
+    digest = body_hash(body)
+    return (
+        external_id,
+        record.get("sender") or record.get("from"),
+        record.get("subject"),
+        record.get("timestamp") or record.get("date"),
+        body,
+        digest,
+        external_id or "",
+        digest,
+    )
+
+
+# ---------- INGESTION ----------
+
+def _insert_batch(cur, batch, stats):
+    cur.executemany(INSERT_SQL, batch)
+    inserted = cur.rowcount
+    stats["rows"] += inserted
+    stats["duplicates"] += len(batch) - inserted
+    return inserted
+
+
+def ingest_records(records, batch_size=INGEST_BATCH_SIZE, progress=None, stats=None):
+    """
+    Insert email dicts (mock_inbox.json schema) in batches; None entries count as skipped.
+    progress(stats) is called after each committed transaction.
+    Returns {"rows", "duplicates", "skipped", "seconds", "rows_per_sec", ...};
+    "duplicates" counts messages that were already stored.
+    """
+    if stats is None:
+        stats = {"rows": 0, "duplicates": 0, "skipped": 0}
+    started = time.perf_counter()
+
+    def report():
+        seconds = time.perf_counter() - started
+        stats["seconds"] = round(seconds, 3)
+        stats["rows_per_sec"] = round(stats["rows"] / seconds, 1) if seconds else None
+        if "bytes" in stats:
+            stats["mb_per_sec"] = round(stats["bytes"] / 1e6 / seconds, 2) if seconds else None
+        return stats
+
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        batch = []
+        uncommitted = 0
+        for record in records:
+            row = _to_row(record)
+            if row is None:
+                stats["skipped"] += 1
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                inserted = _insert_batch(cur, batch, stats)
+                uncommitted += inserted
+                batch.clear()
+                if uncommitted >= INGEST_COMMIT_EVERY:
+                    conn.commit()
+                    uncommitted = 0
+                    if progress:
+                        progress(report())
+
+        if batch:
+            _insert_batch(cur, batch, stats)
+        conn.commit()
+    finally:
+        conn.close()
+
+    return report()
+
+
+def ingest_stream(stream, fmt, batch_size=INGEST_BATCH_SIZE, progress=None):
+    """
+    Import every message from a binary, line-iterable stream.
+    Same stats as ingest_records, plus "bytes" read and "mb_per_sec".
+    """
+    if fmt not in INGEST_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(INGEST_FORMATS)}")
+
+    stats = {"rows": 0, "duplicates": 0, "skipped": 0, "bytes": 0}
+    lines = _count_bytes(stream, stats)
+    records = iter_mbox(lines) if fmt == "mbox" else iter_jsonl(lines)
+    return ingest_records(records, batch_size, progress, stats)
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    if name.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    if name.endswith((".mbox", ".mbx")) or "." not in os.path.basename(name):
+        return "mbox"
+    return None
+
+
+def ingest_file(path, fmt=None, batch_size=INGEST_BATCH_SIZE, progress=None):
+    """Import an mbox/JSONL file (optionally .gz); the format is guessed from the extension."""
+    fmt = fmt or detect_format(path)
+    if fmt is None:
+        raise ValueError(f"can't tell the format of {path}; pass --format")
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        return ingest_stream(f, fmt, batch_size, progress)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import an mbox or JSONL mail dump into the emails table.")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=INGEST_FORMATS)
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    args = parser.parse_args()
+
+    init_db()
+
+    def progress(stats):
+        print(
+            f"{stats['rows']} rows, {stats['bytes'] / 1e6:.1f} MB read, "
+            f"{stats['rows_per_sec']} rows/s, {stats['mb_per_sec']} MB/s"
+        )
+
+    stats = ingest_file(args.path, args.format, args.batch_size, progress)
+    print(
+        f"Ingest complete: {stats['rows']} rows ({stats['duplicates']} duplicates, {stats['skipped']} skipped) "
+        f"in {stats['seconds']}s, {stats['rows_per_sec']} rows/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+# jobs.py
+# Persistent background jobs. POST /api/jobs inserts a row into the jobs table
+# and returns at once; a small worker pool in each backend process claims
+# queued rows and stores the result. A job that fails (a Groq 429 or 5xx) is
+# queued again with exponential backoff, and a job whose worker died (restart,
+# crash) is picked up again once its lease runs out, both up to JOB_MAX_ATTEMPTS.
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from db import get_connection
+from llm import is_error_reply
+from pipeline import process_one
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))  # worker threads per backend process
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))  # idle re-check (jobs queued by other processes)
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "600"))  # a running job is retried after this
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_SECONDS = float(os.getenv("JOB_RETRY_SECONDS", "10"))  # first retry delay, doubled per attempt
+JOB_RETRY_MAX_SECONDS = 300
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(7 * 86400)))  # finished jobs kept
+JOB_STATUSES = ("queued", "running", "done", "failed")
+
+_wake = threading.Event()
+_workers = {"pid": None, "threads": []}
+_workers_lock = threading.Lock()
+_last_purge = 0.0
+
+
+def _run_process(payload):
+    result = process_one(
+        payload["email"],
+        mode=payload.get("mode"),
+        use_cache=not payload.get("fresh"),
+        force=bool(payload.get("force")),
+        threshold=payload.get("threshold"),
+        priority=payload.get("priority", "interactive"),
+    )
+    # LLM failures come back as placeholder strings; don't report them as a result
+    if not result.get("reused") and (
+        is_error_reply(result.get("category")) or is_error_reply(result.get("actions_raw"))
+    ):
+        raise RuntimeError(result.get("category") or result.get("actions_raw") or "LLM call failed")
+    return result
+
+
+# kind -> handler(payload) returning a JSON-serializable result
+JOB_KINDS = {"process": _run_process}
+
+# a malformed payload fails the same way every time: don't retry it
+_PERMANENT_ERRORS = (KeyError, TypeError, ValueError)
+
+
+# ---------- QUEUE ----------
+
+def _row_to_job(row):
+    job = dict(row)
+    result_json = job.pop("result_json")
+    job["result"] = json.loads(result_json) if result_json else None
+    return job
+
+
+def enqueue(kind, payload):
+    """Queue a job and return it (status "queued")."""
+    conn = get_connection()
+    try:
+        (job_id,) = insert_jobs(conn, kind, [payload])
+        conn.commit()
+    finally:
+        conn.close()
+    notify()
+    return get_job(job_id)
+
+
+def insert_jobs(conn, kind, payloads):
+    """
+    Add queued jobs inside the caller's transaction and return their ids; the
+    caller commits, then calls notify().
+    """
+    if kind not in JOB_KINDS:
+        raise ValueError(f"kind must be one of {', '.join(JOB_KINDS)}")
+    now = time.time()
+    rows = [(uuid.uuid4().hex, kind, json.dumps(payload), now) for payload in payloads]
+    conn.executemany("INSERT INTO jobs(id, kind, payload_json, created_at) VALUES (?, ?, ?, ?)", rows)
+    return [row[0] for row in rows]
+
+
+def notify():
+    """Wake this process's idle workers (other processes notice within JOB_POLL_SECONDS)."""
+    _wake.set()
+
+
+def get_job(job_id):
+    conn = get_connection()
+    try:
+        row = conn.execute(
+            """
+            SELECT id, kind, status, result_json, error, attempts,
+                   created_at, started_at, finished_at
+            FROM jobs WHERE id = ?
+            """,
+            (job_id,),
+        ).fetchone()
+    finally:
+        conn.close()
+    return _row_to_job(row) if row else None
+
+
+def list_jobs(status=None, limit=50):
+    """Most recent jobs first, without results."""
+    conn = get_connection()
+    try:
+        rows = conn.execute(
+            f"""
+            SELECT id, kind, status, error, attempts, created_at, started_at, finished_at
+            FROM jobs {"WHERE status = ?" if status else ""}
+            ORDER BY created_at DESC
+            LIMIT ?
+            """,
+            (status, limit) if status else (limit,),
+        ).fetchall()
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    finally:
+        conn.close()
+    return {"jobs": [dict(r) for r in rows], "counts": {s: counts.get(s, 0) for s in JOB_STATUSES}}
+
+
+def _claim(worker):
+    """Atomically take the oldest queued job (or one whose lease expired); None if idle."""
+    now = time.time()
+    conn = get_connection()
+    try:
+        row = conn.execute(
+            """
+            UPDATE jobs
+            SET status = 'running', attempts = attempts + 1, worker = ?,
+                lease_until = ?, started_at = ?
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE (status = 'queued' AND COALESCE(run_after, 0) <= ?)
+                   OR (status = 'running' AND lease_until < ?)
+                ORDER BY created_at
+                LIMIT 1
+            )
+            RETURNING id, kind, payload_json, attempts
+            """,
+            (worker, now + JOB_LEASE_SECONDS, now, now, now),
+        ).fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    return dict(row) if row else None
+
+
+def _finish(job_id, worker, status, result=None, error=None):
+    # the worker check keeps a job that was re-claimed after its lease ran out
+    # from being overwritten by the original, late worker
+    conn = get_connection()
+    try:
+        conn.execute(
+            """
+            UPDATE jobs
+            SET status = ?, result_json = ?, error = ?, finished_at = ?, lease_until = NULL
+            WHERE id = ? AND worker = ?
+            """,
+            (status, json.dumps(result) if result is not None else None, error, time.time(), job_id, worker),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _retry_later(job_id, worker, attempts, error):
+    """Put a failed job back in the queue, to be claimed again after its backoff."""
+    delay = min(JOB_RETRY_SECONDS * 2 ** (attempts - 1), JOB_RETRY_MAX_SECONDS)
+    conn = get_connection()
+    try:
+        conn.execute(
+            """
+            UPDATE jobs
+            SET status = 'queued', error = ?, run_after = ?, lease_until = NULL
+            WHERE id = ? AND worker = ?
+            """,
+            (error, time.time() + delay, job_id, worker),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return delay
+
+
+def _purge_if_due():
+    global _last_purge
+    now = time.time()
+    if now - _last_purge < 600:
+        return
+    _last_purge = now
+    conn = get_connection()
+    try:
+        conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+            (now - JOB_RETENTION_SECONDS,),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def recover():
+    """
+    Requeue jobs left "running" by a dead process on this host, so a restart
+    doesn't have to wait for their lease to expire.
+    """
+    host = socket.gethostname()
+    conn = get_connection()
+    try:
+        rows = conn.execute("SELECT id, worker FROM jobs WHERE status = 'running'").fetchall()
+        orphaned = []
+        for row in rows:
+            w_host, _, rest = (row["worker"] or "").partition(":")
+            pid = rest.partition(":")[0]
+            if w_host == host and pid.isdigit() and not _pid_alive(int(pid)):
+                orphaned.append((row["id"],))
+        conn.executemany("UPDATE jobs SET status = 'queued', lease_until = NULL WHERE id = ?", orphaned)
+        conn.commit()
+    finally:
+        conn.close()
+    if orphaned:
+        print(f"Requeued {len(orphaned)} jobs interrupted by a restart")
+    return len(orphaned)
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return False  # a previous run that had our pid can't still be running
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# ---------- WORKERS ----------
+
+def _work_one(job, worker):
+    if job["attempts"] > JOB_MAX_ATTEMPTS:
+        _finish(job["id"], worker, "failed", error=f"gave up after {JOB_MAX_ATTEMPTS} attempts")
+        return
+    try:
+        result = JOB_KINDS[job["kind"]](json.loads(job["payload_json"]))
+    except _PERMANENT_ERRORS as e:
+        print(f"Warning: job {job['id']} failed:", repr(e))
+        _finish(job["id"], worker, "failed", error=str(e))
+    except Exception as e:
+        if job["attempts"] >= JOB_MAX_ATTEMPTS:
+            print(f"Warning: job {job['id']} failed after {job['attempts']} attempts:", repr(e))
+            _finish(job["id"], worker, "failed", error=str(e))
+        else:
+            delay = _retry_later(job["id"], worker, job["attempts"], str(e))
+            print(f"Warning: job {job['id']} failed, retrying in {delay:.0f}s:", repr(e))
+    else:
+        _finish(job["id"], worker, "done", result=result)
+
+
+def _worker_loop():
+    worker = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+    while True:
+        try:
+            job = _claim(worker)
+            if job is None:
+                _purge_if_due()
+                _wake.wait(JOB_POLL_SECONDS)
+                _wake.clear()
+                continue
+            _work_one(job, worker)
+        except Exception as e:
+            print("Warning: job worker error:", repr(e))
+            time.sleep(JOB_POLL_SECONDS)
+
+
+def start_workers(n=None):
+    """Start the worker threads for this process (no-op if already running)."""
+    if _workers["pid"] == os.getpid():
+        return
+    with _workers_lock:
+        if _workers["pid"] == os.getpid():
+            return
+        recover()
+        threads = []
+        for i in range(n or JOB_WORKERS):
+            t = threading.Thread(target=_worker_loop, name=f"job-{i}", daemon=True)
+            t.start()
+            threads.append(t)
+        _workers.update(pid=os.getpid(), threads=threads)
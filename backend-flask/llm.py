@@ -1,8 +1,24 @@
 # llm.py - Correct Groq LLaMA 3.1 client integration (Dec 2025)
 
+import asyncio
+import collections
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import httpx
 from dotenv import load_dotenv
-from groq import Groq
+from groq import APIConnectionError, APIStatusError, AsyncGroq, DefaultAsyncHttpxClient, Groq
+
+import metrics
+from db import run_sync
 
 load_dotenv()
 
@@ -10,41 +26,963 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.1-8b-instant")
 TEMPERATURE_DEFAULT = 0.2
 
+# call_llm never raises; failures come back as one of these strings
+LLM_DISABLED_REPLY = "[LLM disabled — missing GROQ_API_KEY]\nSet your Groq key in backend-flask/.env"
+LLM_ERROR_PREFIX = "[LLM error]"
+
+# Response cache: identical (model, messages, max_tokens, temperature) calls
+# are answered from a small SQLite file instead of hitting Groq again.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") != "0"
+LLM_CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH", os.path.join(os.path.dirname(__file__), "data", "llm_cache.db")
+)
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "86400"))  # seconds
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+
+# Client-side limits, kept a little under the Groq account limits (0 = unlimited)
+LLM_RPM = int(os.getenv("LLM_RPM", "30"))  # requests per minute
+LLM_TPM = int(os.getenv("LLM_TPM", "6000"))  # tokens per minute (prompt estimate + max_tokens)
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))  # seconds, doubled per attempt
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30"))
+RETRY_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+
+# Model routing (see MODEL ROUTING below): cheap tasks on the fast model,
+# drafts and long inputs on the large one
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", GROQ_MODEL)
+LLM_LARGE_MODEL = os.getenv("LLM_LARGE_MODEL", "llama-3.3-70b-versatile")
+LLM_ROUTES = os.getenv("LLM_ROUTES", "")  # JSON merged into DEFAULT_ROUTES, e.g. {"agent": {"model": "fast"}}
+LLM_SLO_HEADROOM = float(os.getenv("LLM_SLO_HEADROOM", "0.8"))  # fall back once recent p90 > SLO * this
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "50"))  # recent calls kept per model
+LLM_LATENCY_HORIZON = float(os.getenv("LLM_LATENCY_HORIZON", "300"))  # seconds; older calls are ignored
+LLM_LATENCY_MIN_SAMPLES = int(os.getenv("LLM_LATENCY_MIN_SAMPLES", "5"))
+
+# JSON output for callers that pass a json_schema (see JSON OUTPUT below):
+# structured outputs where the model enforces the schema, else JSON mode
+LLM_JSON_MODE = os.getenv("LLM_JSON_MODE", "1") != "0"
+LLM_JSON_SCHEMA_MODELS = os.getenv("LLM_JSON_SCHEMA_MODELS", "openai/gpt-oss-20b,openai/gpt-oss-120b")
+LLM_JSON_OBJECT_MODELS = os.getenv("LLM_JSON_OBJECT_MODELS", "llama-3.1-8b-instant,llama-3.3-70b-versatile")
+
+# Open connections to Groq per process for the async client (the SDK default of
+# 100 would queue calls beyond that inside httpx)
+LLM_ASYNC_MAX_CONNECTIONS = int(os.getenv("LLM_ASYNC_MAX_CONNECTIONS", "1000"))
+
+# Lower runs first: agent/UI calls are never stuck behind a batch triage run
+PRIORITIES = {"interactive": 0, "batch": 1}
+
 client = None
+aclient = None  # AsyncGroq, for acall_llm/astream_llm (ASGI mode)
 
 if GROQ_API_KEY:
     try:
-        client = Groq(api_key=GROQ_API_KEY)
-        print("Groq initialized. Using model:", GROQ_MODEL)
+        # retries are done by the scheduler below, which knows about the rate limits
+        client = Groq(api_key=GROQ_API_KEY, max_retries=0)
+        aclient = AsyncGroq(
+            api_key=GROQ_API_KEY,
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_ASYNC_MAX_CONNECTIONS,
+                    max_keepalive_connections=min(LLM_ASYNC_MAX_CONNECTIONS, 100),
+                )
+            ),
+        )
+        print(f"Groq initialized. Using models: fast={LLM_FAST_MODEL}, large={LLM_LARGE_MODEL}")
     except Exception as e:
         print("ERROR initializing Groq client:", e)
 else:
     print("WARNING: GROQ_API_KEY missing. Using stub mode.")
 
 
-def call_llm(messages, max_tokens=800):
+# ---------- RESPONSE CACHE ----------
+
+_cache_local = threading.local()
+_cache_stats_lock = threading.Lock()
+# per-process counters
+_cache_stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+
+def _cache_connection():
+    """One connection per thread to the cache DB (created on first use)."""
+    conn = getattr(_cache_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(LLM_CACHE_PATH), exist_ok=True)
+        conn = sqlite3.connect(LLM_CACHE_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache(last_used_at)")
+        conn.commit()
+        _cache_local.conn = conn
+    return conn
+
+
+def _count(stat, n=1):
+    with _cache_stats_lock:
+        _cache_stats[stat] += n
+
+
+def cache_key(model, messages, max_tokens, temperature, response_format=None, stream=False):
+    request = {"model": model, "messages": messages, "max_tokens": max_tokens, "temperature": temperature}
+    # only when set, so older keys stay valid
+    if response_format is not None:
+        request["response_format"] = response_format
+    if stream:
+        request["stream"] = True  # a stream never replays a plain call's reply as one chunk
+    payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cache_get(key):
+    conn = _cache_connection()
+    row = conn.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        _count("misses")
+        return None
+
+    response, created_at = row
+    now = time.time()
+    if now - created_at > LLM_CACHE_TTL:
+        conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+        conn.commit()
+        _count("expired")
+        _count("misses")
+        return None
+
+    conn.execute("UPDATE llm_cache SET last_used_at = ?, hits = hits + 1 WHERE key = ?", (now, key))
+    conn.commit()
+    _count("hits")
+    return response
+
+
+def _cache_put(key, response):
+    conn = _cache_connection()
+    now = time.time()
+    conn.execute(
+        """
+        INSERT INTO llm_cache(key, response, created_at, last_used_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET response = excluded.response,
+            created_at = excluded.created_at, last_used_at = excluded.last_used_at
+        """,
+        (key, response, now, now),
+    )
+
+    # Drop expired entries, then the least recently used ones above the size bound
+    cur = conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - LLM_CACHE_TTL,))
+    evicted = cur.rowcount
+    (entries,) = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+    if entries > LLM_CACHE_MAX_ENTRIES:
+        cur = conn.execute(
+            "DELETE FROM llm_cache WHERE key IN "
+            "(SELECT key FROM llm_cache ORDER BY last_used_at ASC LIMIT ?)",
+            (entries - LLM_CACHE_MAX_ENTRIES,),
+        )
+        evicted += cur.rowcount
+    conn.commit()
+    if evicted:
+        _count("evictions", evicted)
+
+
+def _cache_lookup(key):
+    """_cache_get that logs and misses on SQLite errors."""
+    try:
+        return _cache_get(key)
+    except sqlite3.Error as cache_err:
+        print("Warning: LLM cache read failed:", cache_err)
+        return None
+
+
+def _cache_store(key, response):
+    try:
+        _cache_put(key, response)
+    except sqlite3.Error as cache_err:
+        print("Warning: LLM cache write failed:", cache_err)
+
+
+def cache_stats():
+    with _cache_stats_lock:
+        stats = dict(_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else None
+    stats["entries"] = _cache_connection().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+    stats.update(enabled=LLM_CACHE_ENABLED, ttl_seconds=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES)
+    return stats
+
+
+def cache_clear():
+    conn = _cache_connection()
+    cur = conn.execute("DELETE FROM llm_cache")
+    conn.commit()
+    return cur.rowcount
+
+
+# ---------- SCHEDULER ----------
+
+class TokenBucket:
+    """Refills `per_minute` units evenly over a minute; holds at most one minute's worth."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` is available (0 if it is now)."""
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)  # oversized requests wait for a full bucket
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        if self.capacity:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class Scheduler:
+    """
+    Admits upstream calls in priority order, within the request and token budgets.
+    Callers enqueue() a ticket, then block in acquire(), await acquire_async(),
+    or poll try_acquire(), which returns 0 once admitted or the seconds to wait.
+    Only the best-priority, oldest ticket can be admitted, so a waiting
+    interactive call always goes before batch work queued ahead of it.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._cond = threading.Condition()
+        self._queue = []  # heap of (priority, seq, ticket)
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self.stats = {"admitted": 0, "throttled": 0, "retries": 0, "rate_limited": 0, "coalesced": 0}
+
+    def enqueue(self, priority, tokens):
+        ticket = {"priority": PRIORITIES.get(priority, 0), "seq": next(self._seq), "tokens": tokens}
+        with self._cond:
+            heapq.heappush(self._queue, (ticket["priority"], ticket["seq"], ticket))
+        return ticket
+
+    def _try(self, ticket):
+        now = time.monotonic()
+        if self._queue[0][2] is not ticket:
+            return None  # not our turn: wait to be notified
+        wait = max(
+            self._paused_until - now,
+            self.requests.wait_time(1, now),
+            self.tokens.wait_time(ticket["tokens"], now),
+        )
+        if wait > 0:
+            return wait
+        heapq.heappop(self._queue)
+        self.requests.take(1)
+        self.tokens.take(ticket["tokens"])
+        self.stats["admitted"] += 1
+        self._wake_head()  # the next ticket is now at the head
+        return 0.0
+
+    def _wake_head(self):
+        self._cond.notify_all()
+        waiter = self._queue[0][2].get("waiter") if self._queue else None
+        if waiter is not None:
+            loop, future = waiter
+            loop.call_soon_threadsafe(_set_if_pending, future)
+
+    def try_acquire(self, ticket):
+        with self._cond:
+            wait = self._try(ticket)
+        return 0.05 if wait is None else wait
+
+    def acquire(self, ticket):
+        with self._cond:
+            throttled = False
+            while True:
+                wait = self._try(ticket)
+                if wait == 0:
+                    break
+                throttled = True
+                self._cond.wait(wait)
+            if throttled:
+                self.stats["throttled"] += 1
+
+    async def acquire_async(self, ticket):
+        """
+        acquire() for coroutines: waits without blocking the event loop, woken
+        as soon as the ticket reaches the head of the queue.
+        """
+        loop = asyncio.get_running_loop()
+        throttled = False
+        while True:
+            with self._cond:
+                wait = self._try(ticket)
+                if wait == 0:
+                    ticket.pop("waiter", None)
+                    break
+                future = loop.create_future()
+                ticket["waiter"] = (loop, future)
+            throttled = True
+            await asyncio.wait([future], timeout=wait)  # wait is None: until woken
+        if throttled:
+            self.count("throttled")
+
+    def cancel(self, ticket):
+        with self._cond:
+            self._queue = [entry for entry in self._queue if entry[2] is not ticket]
+            heapq.heapify(self._queue)
+            self._wake_head()
+
+    def settle(self, estimated, actual):
+        """Correct the token bucket once the real usage of a call is known."""
+        with self._cond:
+            if actual < estimated:
+                self.tokens.give_back(estimated - actual)
+            else:
+                self.tokens.take(actual - estimated)
+
+    def pause(self, seconds):
+        """Hold every queued call (the server said we're over its limit)."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self.stats["rate_limited"] += 1
+
+    def count(self, stat):
+        with self._cond:
+            self.stats[stat] += 1
+
+    def snapshot(self):
+        with self._cond:
+            now = time.monotonic()
+            self.requests._refill(now)
+            self.tokens._refill(now)
+            queued = {name: 0 for name in PRIORITIES}
+            names = {v: k for k, v in PRIORITIES.items()}
+            for priority, _, _ in self._queue:
+                queued[names[priority]] += 1
+            return dict(
+                self.stats,
+                queued=queued,
+                paused_for=round(max(0.0, self._paused_until - now), 2),
+                limits={"rpm": LLM_RPM, "tpm": LLM_TPM},
+                available={"requests": round(self.requests.level, 1), "tokens": round(self.tokens.level)},
+            )
+
+
+def _set_if_pending(future):
+    if not future.done():
+        future.set_result(None)
+
+
+scheduler = Scheduler(LLM_RPM, LLM_TPM)
+
+_inflight_lock = threading.Lock()
+_inflight = {}  # cache key -> Future of the upstream call in progress
+
+
+def count_tokens(text):
+    """
+    Cheap token estimate without a tokenizer: ~4 characters per token, but at
+    least one per word (numbers, URLs and short words split finely).
+    """
+    text = text or ""
+    return max((len(text) + 3) // 4, len(text.split()))
+
+
+def estimate_tokens(messages, max_tokens):
+    """Rough budget for a call: the prompt's estimated tokens plus the completion cap."""
+    return sum(count_tokens(m.get("content")) for m in messages) + max_tokens
+
+
+def _retry_after(err):
+    """Seconds the server asked us to wait (retry-after / retry-after-ms), or None."""
+    response = getattr(err, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def _is_retryable(err):
+    if isinstance(err, APIStatusError):
+        return err.status_code in RETRY_STATUSES
+    return isinstance(err, APIConnectionError)  # includes timeouts
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff, never shorter than the server's retry-after."""
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+    return max(delay, retry_after or 0.0)
+
+
+def _create(priority, tokens, **kwargs):
+    """
+    client.chat.completions.create behind the scheduler: waits for budget, retries
+    retryable failures with backoff, and raises the last error once retries run out.
+    """
+    attempt = 0
+    while True:
+        ticket = scheduler.enqueue(priority, tokens)
+        try:
+            scheduler.acquire(ticket)
+        except BaseException:
+            scheduler.cancel(ticket)
+            raise
+        started = time.perf_counter()
+        stream = "true" if kwargs.get("stream") else "false"
+        try:
+            response = client.chat.completions.create(**kwargs)
+        except Exception as e:
+            _observe_attempt(started, kwargs.get("model"), stream, "error")
+            time.sleep(_retry_delay(e, attempt))  # re-raises e when it shouldn't be retried
+            attempt += 1
+        else:
+            _observe_attempt(started, kwargs.get("model"), stream, "ok")
+            return response
+
+
+def _retry_delay(err, attempt):
+    """Count a failed attempt and return how long to wait before retrying it (or re-raise)."""
+    metrics.LLM_ERRORS.inc(type=type(err).__name__)
+    if not _is_retryable(err) or attempt >= LLM_MAX_RETRIES:
+        raise err
+    delay = backoff_delay(attempt, _retry_after(err))
+    if getattr(err, "status_code", None) == 429:
+        scheduler.pause(delay)
+    scheduler.count("retries")
+    print(f"Warning: Groq call failed ({err!r}), retry {attempt + 1} in {delay:.1f}s")
+    return delay
+
+
+def _observe_attempt(started, model, stream, outcome):
+    elapsed = time.perf_counter() - started
+    metrics.LLM_DURATION.observe(elapsed, model=model, stream=stream, outcome=outcome)
+    metrics.timing("llm", elapsed * 1000)
+    if outcome == "ok":
+        latency.record(model, stream == "true", elapsed)
+
+
+def _count_tokens(usage, model):
+    if usage is None:
+        return
+    metrics.LLM_TOKENS.inc(getattr(usage, "prompt_tokens", 0) or 0, model=model, type="prompt")
+    metrics.LLM_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, model=model, type="completion")
+
+
+def _settle_usage(estimated, response, model):
+    usage = getattr(response, "usage", None)
+    _count_tokens(usage, model)
+    if usage is not None and usage.total_tokens:
+        scheduler.settle(estimated, usage.total_tokens)
+
+
+def _settle_stream(estimated, usage, messages, parts):
+    """
+    Correct a stream's reservation: by Groq's usage if the last chunk carried
+    it, else by an estimate from the text received (a stream cut short).
+    """
+    actual = getattr(usage, "total_tokens", None) or estimate_tokens(messages, count_tokens("".join(parts)))
+    scheduler.settle(estimated, actual)
+
+
+def _single_flight(key, fn):
+    """Run fn() once per key at a time; concurrent callers with the same key share its result."""
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        scheduler.count("coalesced")
+        return future.result()
+
+    try:
+        result = fn()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+def scheduler_stats():
+    return scheduler.snapshot()
+
+
+# ---------- MODEL ROUTING ----------
+
+# task -> "model" ("fast", "large" or a model id), "large_above" (prompt tokens
+# from which the large model is used) and "slo" (seconds; when the chosen
+# model's recent p90 latency gets close to it, the fast model answers instead)
+DEFAULT_ROUTES = {
+    "categorize": {"model": "fast"},
+    "extract_actions": {"model": "fast", "large_above": 2000, "slo": 6.0},
+    "fused": {"model": "fast", "large_above": 2000, "slo": 6.0},
+    "summarize": {"model": "fast"},  # budget.py map/reduce steps
+    "agent": {"model": "large", "slo": 8.0},  # reply drafts
+    "default": {"model": "fast"},
+}
+
+
+def _load_routes():
+    routes = {task: dict(entry) for task, entry in DEFAULT_ROUTES.items()}
+    if LLM_ROUTES:
+        try:
+            for task, entry in json.loads(LLM_ROUTES).items():
+                routes.setdefault(task, {}).update(entry)
+        except (ValueError, AttributeError, TypeError) as e:
+            print("Warning: ignoring invalid LLM_ROUTES:", e)
+    return routes
+
+
+MODEL_ROUTES = _load_routes()
+
+
+class LatencyTracker:
+    """Durations of recent successful calls per (model, stream), for the SLO check."""
+
+    def __init__(self, window, horizon):
+        self.window, self.horizon = window, horizon
+        self._lock = threading.Lock()
+        self._samples = {}  # (model, stream) -> deque of (monotonic time, seconds)
+
+    def record(self, model, stream, seconds):
+        with self._lock:
+            samples = self._samples.get((model, stream))
+            if samples is None:
+                samples = self._samples[(model, stream)] = collections.deque(maxlen=self.window)
+            samples.append((time.monotonic(), seconds))
+
+    def _recent(self, model, stream):
+        cutoff = time.monotonic() - self.horizon
+        with self._lock:
+            return sorted(s for t, s in self._samples.get((model, stream), ()) if t >= cutoff)
+
+    def percentile(self, model, stream, q):
+        """q-quantile of the recent calls, or None with too few of them to judge."""
+        recent = self._recent(model, stream)
+        if len(recent) < LLM_LATENCY_MIN_SAMPLES:
+            return None
+        return recent[min(len(recent) - 1, int(q * len(recent)))]
+
+    def snapshot(self):
+        with self._lock:
+            keys = list(self._samples)
+        stats = {}
+        for model, stream in sorted(keys):
+            recent = self._recent(model, stream)
+            name = f"{model} (stream)" if stream else model
+            stats[name] = {
+                "calls": len(recent),
+                "p50": round(recent[len(recent) // 2], 3) if recent else None,
+                "p90": round(recent[min(len(recent) - 1, int(0.9 * len(recent)))], 3) if recent else None,
+            }
+        return stats
+
+
+latency = LatencyTracker(LLM_LATENCY_WINDOW, LLM_LATENCY_HORIZON)
+
+
+def _model_id(name):
+    return {"fast": LLM_FAST_MODEL, "large": LLM_LARGE_MODEL}.get(name, name)
+
+
+def route(task, messages, stream=False):
+    """
+    Return (model, reason) for a call of this task. reason is "table" (the
+    task's entry), "long_input" (prompt over the entry's large_above) or
+    "slo_fallback" (the chosen model's recent p90 is near the task's SLO and
+    the fast model is doing better).
+    """
+    entry = MODEL_ROUTES.get(task) or MODEL_ROUTES["default"]
+    model, reason = _model_id(entry.get("model", "fast")), "table"
+
+    large_above = entry.get("large_above")
+    if large_above and model != LLM_LARGE_MODEL:
+        if sum(count_tokens(m.get("content")) for m in messages) > large_above:
+            model, reason = LLM_LARGE_MODEL, "long_input"
+
+    slo = entry.get("slo")
+    if slo and model != LLM_FAST_MODEL:
+        p90 = latency.percentile(model, stream, 0.9)
+        if p90 is not None and p90 > slo * LLM_SLO_HEADROOM:
+            fast_p90 = latency.percentile(LLM_FAST_MODEL, stream, 0.9)
+            if fast_p90 is None or fast_p90 < p90:
+                model, reason = LLM_FAST_MODEL, "slo_fallback"
+
+    metrics.LLM_ROUTED.inc(task=task, model=model, reason=reason)
+    return model, reason
+
+
+def routing_stats():
+    return {
+        "models": {"fast": LLM_FAST_MODEL, "large": LLM_LARGE_MODEL},
+        "routes": MODEL_ROUTES,
+        "slo_headroom": LLM_SLO_HEADROOM,
+        "recent_latency": latency.snapshot(),
+    }
+
+
+# ---------- JSON OUTPUT ----------
+
+def _model_set(value):
+    return {m.strip() for m in value.split(",") if m.strip()}
+
+
+_json_schema_models = _model_set(LLM_JSON_SCHEMA_MODELS)
+_json_object_models = _model_set(LLM_JSON_OBJECT_MODELS)
+
+
+def json_request(model, messages, schema):
+    """
+    Return (messages, response_format, format) for a call that wants JSON
+    matching schema. format is "json_schema" (structured outputs: the model
+    is held to the schema), "json_object" (JSON mode: any JSON object; the
+    schema is added as a system message) or "text" (model without either,
+    or no schema: the prompt alone asks for JSON).
+    """
+    if not schema or not LLM_JSON_MODE:
+        return messages, None, "text"
+    if model in _json_schema_models:
+        json_schema = {"name": schema.get("title", "reply"), "schema": schema}
+        return messages, {"type": "json_schema", "json_schema": json_schema}, "json_schema"
+    if model in _json_object_models:
+        note = "Reply with a single JSON object that matches this JSON schema:\n" + json.dumps(schema)
+        return [{"role": "system", "content": note}] + list(messages), {"type": "json_object"}, "json_object"
+    return messages, None, "text"
+
+
+def _failed_generation(err):
+    """The text Groq rejected in JSON mode (400 json_validate_failed), which can often still be repaired."""
+    body = getattr(err, "body", None)
+    error = body.get("error", body) if isinstance(body, dict) else None
+    if isinstance(error, dict) and error.get("code") == "json_validate_failed":
+        failed = error.get("failed_generation")
+        return failed if isinstance(failed, str) and failed.strip() else None
+    return None
+
+
+# ---------- CHAT COMPLETION ----------
+
+def is_error_reply(text):
+    """True for the placeholder strings call_llm returns instead of raising."""
+    return not text or text == LLM_DISABLED_REPLY or text.startswith(LLM_ERROR_PREFIX)
+
+
+def _routed(task, messages, stream, info):
+    """route() for a call, recorded in the caller's info dict (if any)."""
+    model, reason = route(task, messages, stream)
+    if info is not None:
+        info.update(model=model, route=reason)
+    return model
+
+
+def call_llm(
+    messages, max_tokens=800, use_cache=True, priority="interactive", task="default", info=None, json_schema=None
+):
     """
     Wrapper that safely calls Groq ChatCompletion.
     ALWAYS returns a string (never raises exceptions).
+
+    Successful replies are cached; pass use_cache=False to force a fresh
+    generation (the fresh reply still replaces the cached one).
+    The call waits its turn in the scheduler ("interactive" before "batch"),
+    and identical concurrent calls share a single upstream request.
+    task picks the model (see MODEL_ROUTES); pass an info dict to get the
+    serving "model" and the "route" reason back.
+    json_schema asks for JSON output where the model supports it (see
+    json_request); info then also gets the "format" used. The reply is
+    still text for the caller to parse.
     """
 
     if client is None:
-        return (
-            "[LLM disabled — missing GROQ_API_KEY]\n"
-            "Set your Groq key in backend-flask/.env"
-        )
+        return LLM_DISABLED_REPLY
+
+    model = _routed(task, messages, False, info)
+    messages, response_format = _json_output(model, messages, json_schema, info)
+    key = cache_key(model, messages, max_tokens, TEMPERATURE_DEFAULT, response_format)
+    if LLM_CACHE_ENABLED and use_cache:
+        cached = _cache_lookup(key)
+        if cached is not None:
+            return cached
+
+    return _single_flight(key, lambda: _complete(key, model, messages, max_tokens, priority, response_format))
+
+
+def _json_output(model, messages, json_schema, info):
+    """json_request() for a call, with the format recorded in the caller's info dict (if any)."""
+    if json_schema is None:
+        return messages, None
+    messages, response_format, fmt = json_request(model, messages, json_schema)
+    if info is not None:
+        info["format"] = fmt
+    return messages, response_format
+
 
+def _completion_kwargs(model, messages, max_tokens, response_format):
+    kwargs = dict(model=model, messages=messages, max_tokens=max_tokens, temperature=TEMPERATURE_DEFAULT)
+    if response_format is not None:
+        kwargs["response_format"] = response_format
+    return kwargs
+
+
+def _rejected_json(err, response_format):
+    """For a JSON-mode call Groq refused as invalid JSON, the rejected text (not cached); else None."""
+    failed = _failed_generation(err) if response_format is not None else None
+    if failed is not None:
+        print("Warning: Groq rejected the reply as invalid JSON; returning it for local repair")
+    return failed
+
+
+def _complete(key, model, messages, max_tokens, priority, response_format=None):
+    tokens = estimate_tokens(messages, max_tokens)
+    try:
+        response = _create(priority, tokens, **_completion_kwargs(model, messages, max_tokens, response_format))
+
+        # FIX: message is an object, not a dict
+        content = response.choices[0].message.content
+
+    except Exception as e:
+        failed = _rejected_json(e, response_format)
+        if failed is not None:
+            return failed
+        print("Groq LLM ERROR:", repr(e))
+        return f"{LLM_ERROR_PREFIX} {e}"
+
+    _settle_usage(tokens, response, model)
+    if LLM_CACHE_ENABLED and content:
+        _cache_store(key, content)
+    return content
+
+
+def stream_llm(messages, max_tokens=800, use_cache=True, priority="interactive", task="default", info=None):
+    """
+    Streaming variant of call_llm: yields the reply as text deltas.
+    Never raises; errors are yielded as an "[LLM error] ..." chunk.
+    A cache hit is yielded as a single chunk, and a completed stream is cached.
+    Goes through the scheduler like call_llm (retries happen before the first
+    delta), but streams are not coalesced. info is filled before the first delta.
+    """
+
+    if client is None:
+        yield LLM_DISABLED_REPLY
+        return
+
+    model = _routed(task, messages, True, info)
+    key = None
+    if LLM_CACHE_ENABLED:
+        key = cache_key(model, messages, max_tokens, TEMPERATURE_DEFAULT, stream=True)
+        cached = _cache_lookup(key) if use_cache else None
+        if cached is not None:
+            yield cached
+            return
+
+    parts, usage, stream = [], None, None
+    tokens = estimate_tokens(messages, max_tokens)
     try:
-        response = client.chat.completions.create(
-            model=GROQ_MODEL,
+        stream = _create(
+            priority,
+            tokens,
+            model=model,
             messages=messages,
             max_tokens=max_tokens,
             temperature=TEMPERATURE_DEFAULT,
+            stream=True,
         )
+        for chunk in stream:
+            # Groq reports usage on the last chunk, under x_groq
+            chunk_usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+            if chunk_usage is not None:
+                usage = chunk_usage
+                _count_tokens(usage, model)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
 
-        # FIX: message is an object, not a dict
-        return response.choices[0].message.content
+    except Exception as e:
+        print("Groq LLM ERROR:", repr(e))
+        yield f"{LLM_ERROR_PREFIX} {e}"
+        return
+    finally:
+        # also when the consumer stops early (client gone)
+        if stream is not None:
+            _settle_stream(tokens, usage, messages, parts)
+
+    content = "".join(parts)
+    if key is not None and content:
+        _cache_store(key, content)
+
+
+# ---------- ASYNC (ASGI mode) ----------
+# Coroutine versions of the calls above for asgi.py: the upstream request is
+# awaited on AsyncGroq instead of holding a thread, so one process can keep
+# hundreds of model calls in flight. They share the scheduler, the cache and
+# in-flight coalescing with the sync versions; cache reads and writes (SQLite)
+# run on the DB offload threads.
+
+async def _acreate(priority, tokens, **kwargs):
+    """_create for coroutines."""
+    attempt = 0
+    while True:
+        ticket = scheduler.enqueue(priority, tokens)
+        try:
+            await scheduler.acquire_async(ticket)
+        except BaseException:
+            scheduler.cancel(ticket)
+            raise
+        started = time.perf_counter()
+        stream = "true" if kwargs.get("stream") else "false"
+        try:
+            response = await aclient.chat.completions.create(**kwargs)
+        except Exception as e:
+            _observe_attempt(started, kwargs.get("model"), stream, "error")
+            await asyncio.sleep(_retry_delay(e, attempt))
+            attempt += 1
+        else:
+            _observe_attempt(started, kwargs.get("model"), stream, "ok")
+            return response
 
+
+async def _asingle_flight(key, make_coro):
+    """_single_flight for coroutines; coalesces with sync callers of the same key too."""
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        scheduler.count("coalesced")
+        return await asyncio.wrap_future(future)
+
+    try:
+        result = await make_coro()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+async def acall_llm(
+    messages, max_tokens=800, use_cache=True, priority="interactive", task="default", info=None, json_schema=None
+):
+    """call_llm for coroutines. ALWAYS returns a string (never raises exceptions)."""
+    if aclient is None:
+        return LLM_DISABLED_REPLY
+
+    model = _routed(task, messages, False, info)
+    messages, response_format = _json_output(model, messages, json_schema, info)
+    key = cache_key(model, messages, max_tokens, TEMPERATURE_DEFAULT, response_format)
+    if LLM_CACHE_ENABLED and use_cache:
+        cached = await run_sync(_cache_lookup, key)
+        if cached is not None:
+            return cached
+
+    return await _asingle_flight(key, lambda: _acomplete(key, model, messages, max_tokens, priority, response_format))
+
+
+async def _acomplete(key, model, messages, max_tokens, priority, response_format=None):
+    tokens = estimate_tokens(messages, max_tokens)
+    try:
+        response = await _acreate(
+            priority, tokens, **_completion_kwargs(model, messages, max_tokens, response_format)
+        )
+        content = response.choices[0].message.content
     except Exception as e:
+        failed = _rejected_json(e, response_format)
+        if failed is not None:
+            return failed
         print("Groq LLM ERROR:", repr(e))
-        return f"[LLM error] {e}"
+        return f"{LLM_ERROR_PREFIX} {e}"
+
+    _settle_usage(tokens, response, model)
+    if LLM_CACHE_ENABLED and content:
+        await run_sync(_cache_store, key, content)
+    return content
+
+
+async def astream_llm(messages, max_tokens=800, use_cache=True, priority="interactive", task="default", info=None):
+    """stream_llm for coroutines: an async generator of text deltas (never raises)."""
+    if aclient is None:
+        yield LLM_DISABLED_REPLY
+        return
+
+    model = _routed(task, messages, True, info)
+    key = None
+    if LLM_CACHE_ENABLED:
+        key = cache_key(model, messages, max_tokens, TEMPERATURE_DEFAULT, stream=True)
+        cached = await run_sync(_cache_lookup, key) if use_cache else None
+        if cached is not None:
+            yield cached
+            return
+
+    parts, usage, stream = [], None, None
+    tokens = estimate_tokens(messages, max_tokens)
+    try:
+        stream = await _acreate(
+            priority,
+            tokens,
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=TEMPERATURE_DEFAULT,
+            stream=True,
+        )
+        async for chunk in stream:
+            chunk_usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+            if chunk_usage is not None:
+                usage = chunk_usage
+                _count_tokens(usage, model)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+
+    except Exception as e:
+        print("Groq LLM ERROR:", repr(e))
+        yield f"{LLM_ERROR_PREFIX} {e}"
+        return
+    finally:
+        if stream is not None:
+            _settle_stream(tokens, usage, messages, parts)
+
+    content = "".join(parts)
+    if key is not None and content:
+        await run_sync(_cache_store, key, content)
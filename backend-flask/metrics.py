@@ -0,0 +1,172 @@
+# metrics.py
+# In-process counters and histograms, rendered in the Prometheus text format
+# by GET /api/metrics, plus the per-request timings sent as Server-Timing.
+# Each process (gunicorn worker) keeps its own values, like the cache stats.
+
+import bisect
+import contextvars
+import threading
+import time
+
+# seconds; the defaults match the Prometheus client libraries
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_label_text(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # label values -> [per-bucket counts (+Inf last), sum, count]
+        _registry.append(self)
+
+    def observe(self, seconds, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += seconds
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, [list(v[0]), v[1], v[2]]) for k, v in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _label_text(self.labels, key, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {count}")
+        return lines
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format (0.0.4)."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---------- METRICS ----------
+
+HTTP_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time to build a response (streamed bodies excluded).",
+    ("method", "endpoint", "status"),
+)
+DB_REQUEST_TIME = Histogram(
+    "db_time_per_request_seconds", "Time spent in SQLite per HTTP request.", ("endpoint",), DB_BUCKETS
+)
+DB_STATEMENT_DURATION = Histogram(
+    "db_statement_duration_seconds", "SQLite execute/executemany/commit calls.", ("operation",), DB_BUCKETS
+)
+DB_CONNECTIONS = Counter("db_connections_total", "Connections handed out, from the pool or newly opened.", ("source",))
+DB_CONNECT_DURATION = Histogram(
+    "db_connect_duration_seconds", "Time to open a new SQLite connection.", buckets=DB_BUCKETS
+)
+PIPELINE_STAGE = Histogram(
+    "pipeline_stage_duration_seconds",
+    "process_one stages: templates, lookup, classify, condense, render, categorize, extract_actions, "
+    "fused, llm, persist, total.",
+    ("stage",),
+    LLM_BUCKETS,
+)
+LLM_DURATION = Histogram(
+    "llm_request_duration_seconds",
+    "Upstream chat-completion attempts (for streams: until the response starts).",
+    ("model", "stream", "outcome"),
+    LLM_BUCKETS,
+)
+LLM_ROUTED = Counter(
+    "llm_routed_total", "Calls per task and serving model, by routing reason.", ("task", "model", "reason")
+)
+CATEGORIZE_BATCHED = Counter(
+    "categorize_batched_emails_total",
+    "Emails sent in micro-batched categorize calls: labelled by the batch, or retried on their own.",
+    ("outcome",),
+)
+CATEGORIZE_BATCH_SIZE = Histogram(
+    "categorize_batch_size", "Emails per micro-batched categorize call.", buckets=(2, 4, 8, 16, 32, 64)
+)
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens reported in response.usage.", ("model", "type"))
+LLM_ERRORS = Counter("llm_errors_total", "Failed upstream attempts by exception type.", ("type",))
+ACTIONS_PARSE = Counter(
+    "actions_parse_total",
+    "Processed emails by how their actions reply parsed (ok, repaired, retried, failed).",
+    ("mode", "result"),
+)
+
+
+# ---------- SERVER-TIMING ----------
+
+# a context variable rather than a thread-local: under ASGI many requests share
+# one thread, and work offloaded with db.run_sync still counts for its request
+_request = contextvars.ContextVar("request_timings", default=None)
+
+
+def begin_request():
+    _request.set({"started": time.perf_counter(), "timings": {}})
+
+
+def timing(name, ms):
+    """Add to a Server-Timing entry of the current request (ignored outside requests)."""
+    current = _request.get()
+    if current is not None:
+        current["timings"][name] = current["timings"].get(name, 0.0) + ms
+
+
+def end_request():
+    """Return ({name: ms}, total seconds) for the current request and close it."""
+    current = _request.get()
+    _request.set(None)
+    if current is None:
+        return {}, 0.0
+    return current["timings"], time.perf_counter() - current["started"]
+
+
+def server_timing_header(timings):
+    return ", ".join(f"{name};dur={round(ms, 2)}" for name, ms in timings.items())
@@ -0,0 +1,211 @@
+# microbatch.py
+# Micro-batching for the categorize task. Categorize calls made at about the
+# same time (batch endpoint, concurrent /api/process requests) are collected
+# for a few milliseconds and packed, within a token budget, into one prompt
+# that returns a JSON array of labels keyed by email id. Each label is checked
+# on its own; an email whose label is missing or malformed gets None back and
+# its caller retries it with the usual single-email call.
+
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+from llm import call_llm, count_tokens, is_error_reply
+from utils import extract_json
+
+CATEGORIZE_BATCH = os.getenv("CATEGORIZE_BATCH", "batch")  # "off", "batch" (batch priority only) or "all"
+CATEGORIZE_BATCH_MAX = int(os.getenv("CATEGORIZE_BATCH_MAX", "16"))  # emails per call
+CATEGORIZE_BATCH_TOKENS = int(os.getenv("CATEGORIZE_BATCH_TOKENS", "4000"))  # email tokens per call
+CATEGORIZE_BATCH_WAIT_MS = float(os.getenv("CATEGORIZE_BATCH_WAIT_MS", "20"))  # collection window
+CATEGORIZE_BATCH_WORKERS = int(os.getenv("CATEGORIZE_BATCH_WORKERS", "4"))  # batch calls in flight
+
+BATCH_TEMPLATE = (
+    "Below are {count} emails, each starting with a line \"### id: <id>\". "
+    "Follow these instructions for each email separately:\n\n{instructions}\n\n"
+    "Answer with a JSON array and nothing else, one object per email, in this shape:\n"
+    '[{{"id": "<id>", "label": "<label>"}}]\n\n{emails}'
+)
+PER_EMAIL_OVERHEAD = 12  # tokens for the "### id:" line and separators
+
+_SIMPLE_ID = re.compile(r"^[\w.@:+-]{1,64}$")
+
+_pool = ThreadPoolExecutor(max_workers=CATEGORIZE_BATCH_WORKERS, thread_name_prefix="catbatch")
+
+
+def enabled_for(priority):
+    return CATEGORIZE_BATCH == "all" or (CATEGORIZE_BATCH == "batch" and priority == "batch")
+
+
+# ---------- PROMPT ----------
+
+def _keys(items):
+    """The id shown to the model per email: its own id if short and unique here, else its position."""
+    ids = [str(item["id"]) if item["id"] not in (None, "") else "" for item in items]
+    usable = [bool(_SIMPLE_ID.match(i)) and ids.count(i) == 1 for i in ids]
+    return [i if ok else f"email-{n + 1}" for n, (i, ok) in enumerate(zip(ids, usable))]
+
+
+def build_prompt(template, keys, bodies):
+    instructions = template.replace("{email_body}", "(each email below)")
+    emails = "\n\n".join(f"### id: {key}\n{body}" for key, body in zip(keys, bodies))
+    return BATCH_TEMPLATE.format(count=len(keys), instructions=instructions, emails=emails)
+
+
+def parse_labels(reply):
+    """{id: label} from the model's JSON array (prose around it tolerated); {} if unusable."""
+    parsed, _ = extract_json(reply, "[")
+    if not isinstance(parsed, list):
+        return {}
+    return {
+        str(entry["id"]): entry.get("label")
+        for entry in parsed
+        if isinstance(entry, dict) and entry.get("id") is not None
+    }
+
+
+def valid_label(label, labels=None):
+    """A short one-line string, and one of labels when the label set is known."""
+    if not isinstance(label, str) or is_error_reply(label):
+        return False
+    label = label.strip()
+    if not label or len(label) > 40 or "\n" in label or label[0] in "[{":
+        return False
+    return labels is None or label.strip(".!\"'").lower() in {l.lower() for l in labels}
+
+
+# ---------- BATCHER ----------
+
+class CategorizeBatcher:
+    """
+    Collects categorize requests per (template, use_cache, priority, labels)
+    and sends a group once it is full (CATEGORIZE_BATCH_MAX emails or
+    CATEGORIZE_BATCH_TOKENS) or its window has passed. submit() returns a
+    Future of {"label", "model", "batch_size"}, or None when the caller should
+    make the single call itself (missing or malformed label, failed call, or
+    no other email in the window).
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._groups = {}  # group key -> {"items", "tokens", "opened"}
+        self._thread_pid = None
+        self.stats = {"calls": 0, "batched": 0, "retried": 0, "alone": 0}
+
+    def submit(self, email_id, body, template, use_cache=True, priority="batch", labels=None):
+        future = Future()
+        item = {"id": email_id, "body": body, "tokens": count_tokens(body) + PER_EMAIL_OVERHEAD, "future": future}
+        key = (template, use_cache, priority, tuple(labels) if labels else None)
+        with self._cond:
+            self._ensure_thread()
+            group = self._groups.get(key)
+            if group is not None and group["tokens"] + item["tokens"] > CATEGORIZE_BATCH_TOKENS:
+                self._dispatch(key)
+                group = None
+            if group is None:
+                group = self._groups[key] = {"items": [], "tokens": 0, "opened": time.monotonic()}
+            group["items"].append(item)
+            group["tokens"] += item["tokens"]
+            if len(group["items"]) >= CATEGORIZE_BATCH_MAX:
+                self._dispatch(key)
+            self._cond.notify()
+        return future
+
+    def _ensure_thread(self):
+        # per process: a gunicorn worker forked from a parent has no flusher thread
+        if self._thread_pid != os.getpid():
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._flush_loop, name="catbatch-flush", daemon=True).start()
+
+    def _dispatch(self, key):
+        group = self._groups.pop(key)
+        try:
+            _pool.submit(self._run, key, group["items"])
+        except RuntimeError:
+            # pool shut down (interpreter exit): let every caller make its own call instead of waiting forever
+            for item in group["items"]:
+                item["future"].set_result(None)
+
+    def _flush_loop(self):
+        window = CATEGORIZE_BATCH_WAIT_MS / 1000
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                for key in [k for k, g in self._groups.items() if now - g["opened"] >= window]:
+                    self._dispatch(key)
+                deadlines = [g["opened"] + window - now for g in self._groups.values()]
+                self._cond.wait(min(deadlines) if deadlines else None)
+
+    def _run(self, key, items):
+        template, use_cache, priority, labels = key
+        results = [None] * len(items)
+        try:
+            if len(items) == 1:
+                self._count(alone=1)  # nothing arrived within the window: a single call is cheaper
+            else:
+                results = self._call(template, use_cache, priority, labels, items)
+                retried = sum(r is None for r in results)
+                self._count(batched=len(items) - retried, retried=retried)
+        except Exception as e:
+            print("Warning: batched categorize failed:", repr(e))
+        finally:
+            for item, result in zip(items, results):
+                item["future"].set_result(result)
+
+    def _call(self, template, use_cache, priority, labels, items):
+        keys = _keys(items)
+        prompt = build_prompt(template, keys, [item["body"] for item in items])
+        served = {}
+        reply = call_llm(
+            [{"role": "user", "content": prompt}],
+            max_tokens=16 + 24 * len(items),
+            use_cache=use_cache,
+            priority=priority,
+            task="categorize",
+            info=served,
+        )
+        self._count(calls=1)
+        metrics.CATEGORIZE_BATCH_SIZE.observe(len(items))
+        by_key = {} if is_error_reply(reply) else parse_labels(reply)
+
+        results = []
+        for k in keys:
+            label = by_key.get(k)
+            if valid_label(label, labels):
+                results.append({"label": label.strip(), "model": served.get("model"), "batch_size": len(items)})
+            else:
+                results.append(None)
+        return results
+
+    def _count(self, **amounts):
+        with self._cond:
+            for stat, n in amounts.items():
+                self.stats[stat] += n
+        for outcome in ("batched", "retried"):
+            if amounts.get(outcome):
+                metrics.CATEGORIZE_BATCHED.inc(amounts[outcome], outcome=outcome)
+
+    def snapshot(self):
+        with self._cond:
+            stats = dict(self.stats)
+            pending = sum(len(g["items"]) for g in self._groups.values())
+        emails = stats["batched"] + stats["retried"]
+        return dict(
+            stats,
+            pending=pending,
+            retry_rate=round(stats["retried"] / emails, 4) if emails else None,
+            emails_per_call=round(stats["batched"] / stats["calls"], 2) if stats["calls"] else None,
+            mode=CATEGORIZE_BATCH,
+            max_emails=CATEGORIZE_BATCH_MAX,
+            max_tokens=CATEGORIZE_BATCH_TOKENS,
+            wait_ms=CATEGORIZE_BATCH_WAIT_MS,
+        )
+
+
+batcher = CategorizeBatcher()
+
+
+def batch_stats():
+    return batcher.snapshot()
@@ -0,0 +1,569 @@
+# pipeline.py
+# Email processing pipeline (categorize + action extraction).
+# Shared by POST /api/process and the batch endpoint.
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import actions
+import budget
+import classifier
+import metrics
+import microbatch
+import similar
+from db import get_active_prompts, get_connection, run_sync
+from llm import acall_llm, call_llm, is_error_reply
+from utils import body_hash, extract_json, safe_json_loads
+
+DEFAULT_CATEGORIZE_TEMPLATE = (
+    "Categorize the email into one of these labels: Important, To-Do, Newsletter, Spam, Social.\n"
+    "Return only the label (one word).\n\nEmail:\n{email_body}"
+)
+
+DEFAULT_EXTRACT_ACTIONS_TEMPLATE = (
+    "Extract actionable tasks from the email. "
+    "Return a JSON array of objects with keys 'task', 'deadline', and 'assignee'. "
+    "If there are no actions, return an empty JSON array [].\n\nEmail:\n{email_body}"
+)
+
+# Both fields in one JSON call; the two task templates are embedded as instructions
+FUSED_TEMPLATE = (
+    "Do both tasks below for the same email.\n\n"
+    "Task 1 (category):\n{categorize}\n\n"
+    "Task 2 (actions):\n{extract_actions}\n\n"
+    "Answer with a single JSON object and nothing else, in this shape:\n"
+    '{{"category": "<label>", "actions": [{{"task": "...", "deadline": "...", "assignee": "..."}}]}}\n\n'
+    "Email:\n{email_body}"
+)
+FUSED_SCHEMA = {
+    "title": "fused",
+    "type": "object",
+    "properties": {"category": {"type": "string"}, "actions": actions.ACTIONS_SCHEMA["properties"]["actions"]},
+    "required": ["category", "actions"],
+    "additionalProperties": False,
+}
+
+# "parallel": categorize and extract_actions as two concurrent calls
+# "fused": one call returning both fields as JSON
+PROCESS_MODES = ("parallel", "fused")
+PROCESS_MODE = os.getenv("PROCESS_MODE", "parallel")
+
+# Every LLM call made by the pipeline runs on this pool, which bounds the
+# number of in-flight model requests across single and batch processing.
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", "16"))
+_llm_pool = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="llm")
+
+# Batch mode: how many emails are processed at once (each one makes its own LLM calls)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "32"))
+
+
+def load_templates():
+    """
+    Return the latest template for each processing step (falls back to built-in
+    defaults), plus a "version" hash of their content used as the idempotency key.
+    """
+    active = get_active_prompts(("categorize", "extract_actions"))
+    templates = {
+        "categorize": (active["categorize"] or {}).get("content") or DEFAULT_CATEGORIZE_TEMPLATE,
+        "extract_actions": (active["extract_actions"] or {}).get("content") or DEFAULT_EXTRACT_ACTIONS_TEMPLATE,
+    }
+    templates["version"] = hashlib.sha256(
+        f"{templates['categorize']}\0{templates['extract_actions']}".encode("utf-8")
+    ).hexdigest()[:16]
+    return templates
+
+
+def _external_id(email):
+    # normalized so 1 and "1" are the same message; "" when the email has no id
+    return "" if email.get("id") is None else str(email.get("id"))
+
+
+def find_stored_result(email, templates):
+    """Return the stored result for this email body + template version, or None (also if its actions didn't parse)."""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT category, category_tier, actions_json FROM emails
+        WHERE COALESCE(external_id, '') = ? AND body_hash = ? AND prompt_version = ?
+        LIMIT 1
+        """,
+        (_external_id(email), body_hash(email["body"]), templates["version"]),
+    )
+    row = cur.fetchone()
+    conn.close()
+
+    if row is None:
+        return None
+    stored_actions = safe_json_loads(row["actions_json"], None)
+    if not isinstance(stored_actions, list):
+        # the actions reply didn't parse last time (the raw text was kept): a miss, so it is retried
+        return None
+    return {
+        "category": row["category"],
+        "category_tier": row["category_tier"] or "llm",
+        "actions_raw": row["actions_json"],
+        "actions_json": stored_actions,
+    }
+
+
+def persist_result(email, result, templates):
+    """
+    Save a processed email (best-effort; errors here shouldn't break the response).
+    Overwrites the row for the same (external_id, body_hash, prompt_version),
+    or fills in an unprocessed row (e.g. from ingest.py) for the same message.
+    """
+    actions_json = (
+        json.dumps(result["actions_json"])
+        if result["actions_json"] is not None
+        else result["actions_raw"]
+    )
+    key = (_external_id(email), body_hash(email["body"]))
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE emails SET category = ?, category_tier = ?, actions_json = ?, prompt_version = ?
+            WHERE id = (
+                SELECT id FROM emails
+                WHERE COALESCE(external_id, '') = ? AND body_hash = ?
+                  AND (prompt_version = ? OR prompt_version IS NULL)
+                ORDER BY prompt_version IS NULL
+                LIMIT 1
+            )
+            """,
+            (
+                result["category"],
+                result["category_tier"],
+                actions_json,
+                templates["version"],
+                *key,
+                templates["version"],
+            ),
+        )
+        if cur.rowcount == 0:
+            # DO NOTHING: a concurrent request already stored this exact result
+            cur.execute(
+                """
+                INSERT INTO emails(external_id, sender, subject, timestamp, body, category, category_tier,
+                                   actions_json, body_hash, prompt_version)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT DO NOTHING
+                """,
+                (
+                    email.get("id"),
+                    email.get("sender"),
+                    email.get("subject"),
+                    email.get("timestamp"),
+                    email["body"],
+                    result["category"],
+                    result["category_tier"],
+                    actions_json,
+                    key[1],
+                    templates["version"],
+                ),
+            )
+        conn.commit()
+        conn.close()
+    except Exception as db_err:
+        print("Warning: failed to persist processed email:", db_err)
+
+
+def _timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    value = fn(*args, **kwargs)
+    return value, _elapsed_ms(started)
+
+
+def _elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def _observe_stages(timings):
+    for stage, ms in timings.items():
+        metrics.PIPELINE_STAGE.observe(ms / 1000, stage=stage)
+
+
+def _render(template, body_text):
+    return template.replace("{email_body}", body_text)
+
+
+def _parallel_prompts(bodies, templates, timings, category=None):
+    """(categorize prompt or None when the category is already known, extract_actions prompt)."""
+    render_started = time.perf_counter()
+    actions_prompt = _render(templates["extract_actions"], bodies["extract_actions"])
+    cat_prompt = _render(templates["categorize"], bodies["categorize"]) if category is None else None
+    timings["render"] = timings.get("render", 0) + _elapsed_ms(render_started)
+    return cat_prompt, actions_prompt
+
+
+def _parallel_result(cat_resp, extracted, served):
+    actions_resp, actions_list, outcome = extracted
+    return {
+        "category": (cat_resp or "").strip(),
+        "actions_raw": actions_resp,
+        "actions_json": actions_list,  # validated (see actions.py), None if the reply had no usable list
+        "actions_parse": outcome,
+        "llm_error": is_error_reply(cat_resp) or is_error_reply(actions_resp),
+        "models": _models(served),
+    }
+
+
+def _models(served):
+    """{task: serving model} from the info dicts filled by call_llm."""
+    return {task: info["model"] for task, info in served.items() if info.get("model")}
+
+
+def _known_labels(templates):
+    """The label set when the built-in categorize template is in use (the batch checks against it)."""
+    return classifier.LABELS if templates["categorize"] == DEFAULT_CATEGORIZE_TEMPLATE else None
+
+
+def _categorize(email_id, body, prompt, templates, use_cache, priority, info):
+    """
+    The categorize call; micro-batched with other emails when enabled for this
+    priority (see microbatch.py), and made on its own if the batch gives no
+    usable label for this email.
+    """
+    if microbatch.enabled_for(priority):
+        batched = microbatch.batcher.submit(
+            email_id, body, templates["categorize"], use_cache, priority, _known_labels(templates)
+        ).result()
+        if batched is not None:
+            info.update(model=batched["model"], batch_size=batched["batch_size"])
+            return batched["label"]
+    messages = [{"role": "user", "content": prompt}]
+    return call_llm(messages, max_tokens=60, use_cache=use_cache, priority=priority, task="categorize", info=info)
+
+
+def _run_parallel(bodies, templates, timings, use_cache=True, category=None, priority="interactive", email_id=None):
+    """
+    Run the categorize and extract_actions calls at the same time.
+    A category already decided locally skips the categorize call.
+    bodies maps each task to its (budgeted) email body.
+    """
+    cat_prompt, actions_prompt = _parallel_prompts(bodies, templates, timings, category)
+    served = {"extract_actions": {}}
+
+    cat_future = None
+    if category is None:
+        served["categorize"] = {}
+        cat_future = _llm_pool.submit(
+            _timed,
+            _categorize,
+            email_id,
+            bodies["categorize"],
+            cat_prompt,
+            templates,
+            use_cache,
+            priority,
+            served["categorize"],
+        )
+    act_future = _llm_pool.submit(
+        _timed, actions.extract, actions_prompt, use_cache, priority, served["extract_actions"]
+    )
+    if cat_future is not None:
+        cat_resp, timings["categorize"] = cat_future.result()
+    else:
+        cat_resp = category
+    extracted, timings["extract_actions"] = act_future.result()
+
+    return _parallel_result(cat_resp, extracted, served)
+
+
+def _fused_prompt(body_text, templates, timings):
+    placeholder = "(the email is given at the end)"
+    render_started = time.perf_counter()
+    prompt = FUSED_TEMPLATE.format(
+        categorize=_render(templates["categorize"], placeholder),
+        extract_actions=_render(templates["extract_actions"], placeholder),
+        email_body=body_text,
+    )
+    timings["render"] = _elapsed_ms(render_started)
+    return prompt
+
+
+def _parse_fused(resp, served):
+    # prose, code fences and trailing commas around the object are repaired locally
+    parsed, repaired = extract_json(resp, "{")
+    if not isinstance(parsed, dict) or not isinstance(parsed.get("category"), str):
+        return None
+
+    actions_list, changed = actions.validate(parsed.get("actions"))
+    if actions_list is None:
+        outcome = "failed"
+    else:
+        outcome = "repaired" if repaired or changed else "ok"
+    return {
+        "category": parsed["category"].strip(),
+        "actions_raw": json.dumps(parsed.get("actions")) if parsed.get("actions") is not None else resp,
+        "actions_json": actions_list,
+        "actions_parse": outcome,
+        "llm_error": False,
+        "models": _models(served),
+    }
+
+
+def _run_fused(body_text, templates, timings, use_cache=True, priority="interactive"):
+    """
+    Ask for the category and the actions in one JSON call.
+    Returns None if the reply can't be parsed, so the caller can fall back.
+    """
+    prompt = _fused_prompt(body_text, templates, timings)
+    served = {"fused": {}}
+    future = _llm_pool.submit(
+        _timed,
+        call_llm,
+        [{"role": "user", "content": prompt}],
+        max_tokens=460,
+        use_cache=use_cache,
+        priority=priority,
+        task="fused",
+        info=served["fused"],
+        json_schema=FUSED_SCHEMA,
+    )
+    resp, timings["fused"] = future.result()
+    return _parse_fused(resp, served)
+
+
+def _begin(email, templates, force, threshold, timings, started):
+    """
+    The stages before any model call: templates, stored-result lookup and the
+    local classifier. Returns (templates, stored result or None, decision).
+    """
+    if templates is None:
+        templates, timings["templates"] = _timed(load_templates)
+
+    if not force:
+        stored, timings["lookup"] = _timed(find_stored_result, email, templates)
+        if stored is not None:
+            timings["total"] = _elapsed_ms(started)
+            _observe_stages(timings)
+            stored.update(reused=True, prompt_version=templates["version"], timings_ms=timings)
+            return templates, stored, None
+
+    decision, timings["classify"] = _timed(classifier.classify, email, threshold)
+    return templates, None, decision
+
+
+def _condense(email, use_cache, priority):
+    # Bound what the model sees: signatures stripped; quoted history too, and long bodies condensed, if over budget
+    actions_body, body_info = budget.condense(email["body"], budget.TOKEN_BUDGET_ACTIONS, use_cache, priority)
+    bodies = {"categorize": budget.categorize_prefix(email["body"]), "extract_actions": actions_body}
+    return bodies, body_info
+
+
+async def _acondense(email, use_cache, priority):
+    actions_body, body_info = await budget.acondense(
+        email["body"], budget.TOKEN_BUDGET_ACTIONS, use_cache, priority
+    )
+    bodies = {"categorize": budget.categorize_prefix(email["body"]), "extract_actions": actions_body}
+    return bodies, body_info
+
+
+def _finish(email, result, decision, templates, mode, body_info, timings, started):
+    """Record the classifier outcome, persist a successful result and add the result metadata."""
+    result.update(category_tier=decision["tier"], category_confidence=decision["confidence"])
+    classifier.record(decision, None if result["llm_error"] else result["category"])
+
+    # Never store placeholder error strings: they would be reused as results
+    llm_error = result.pop("llm_error")
+    if not llm_error:
+        _, timings["persist"] = _timed(persist_result, email, result, templates)
+        similar.schedule_sync()
+        actions.record(result["actions_parse"], mode)
+    timings["total"] = _elapsed_ms(started)
+    _observe_stages(timings)
+
+    result.update(
+        reused=False, prompt_version=templates["version"], mode=mode, body_budget=body_info, timings_ms=timings
+    )
+    return result
+
+
+def process_one(email, templates=None, mode=None, use_cache=True, force=False, threshold=None, priority="interactive"):
+    """
+    Categorize one email and extract its actions, then persist the result.
+    mode is "parallel" (two concurrent calls) or "fused" (one JSON call);
+    the result carries a per-stage timing breakdown in milliseconds.
+    use_cache=False skips the LLM response cache (fresh generation).
+
+    The local classifier runs first; when it reaches threshold (default
+    CLASSIFIER_THRESHOLD) only the extract_actions call goes to the LLM.
+    "category_tier" says which tier ("rules", "model", "llm") decided.
+    priority is the LLM scheduler class ("interactive" or "batch").
+    The body is cleaned and kept within the per-task token budgets (see
+    budget.py); "body_budget" reports original vs sent tokens and chunking.
+    "models" maps each LLM call made (categorize, extract_actions or fused)
+    to the model that served it (see llm.MODEL_ROUTES).
+    At "batch" priority (or always, with CATEGORIZE_BATCH=all) the categorize
+    call is micro-batched with other emails' (see microbatch.py).
+    "actions_json" is the action list validated against the task/deadline/assignee
+    schema; "actions_parse" says whether the reply was valid as sent ("ok"),
+    fixed locally ("repaired"), needed the repair call ("retried") or "failed".
+
+    If this exact body was already processed with the same template version,
+    the stored result is returned without calling the model ("reused": true);
+    force=True recomputes it anyway.
+    """
+    started = time.perf_counter()
+    timings = {}
+    mode = mode or PROCESS_MODE
+    use_cache = use_cache and not force
+
+    templates, stored, decision = _begin(email, templates, force, threshold, timings, started)
+    if stored is not None:
+        return stored
+    (bodies, body_info), timings["condense"] = _timed(_condense, email, use_cache, priority)
+
+    # Call LLMs (now always return a string, even on error)
+    llm_started = time.perf_counter()
+    result = None
+    if decision["category"] is not None:
+        result = _run_parallel(bodies, templates, timings, use_cache, decision["category"], priority)
+    elif mode == "fused":
+        result = _run_fused(bodies["extract_actions"], templates, timings, use_cache, priority)
+        if result is None:
+            print("Warning: fused reply was not valid JSON, falling back to parallel calls")
+            mode = "parallel"
+    if result is None:
+        result = _run_parallel(bodies, templates, timings, use_cache, priority=priority, email_id=email.get("id"))
+    timings["llm"] = _elapsed_ms(llm_started)
+
+    return _finish(email, result, decision, templates, mode, body_info, timings, started)
+
+
+# ---------- ASYNC (ASGI mode) ----------
+
+async def _atimed(awaitable):
+    started = time.perf_counter()
+    value = await awaitable
+    return value, _elapsed_ms(started)
+
+
+def _llm_message(prompt, max_tokens, use_cache, priority, task, info, json_schema=None):
+    messages = [{"role": "user", "content": prompt}]
+    return acall_llm(
+        messages, max_tokens=max_tokens, use_cache=use_cache, priority=priority, task=task, info=info,
+        json_schema=json_schema,
+    )
+
+
+async def _acategorize(email_id, body, prompt, templates, use_cache, priority, info):
+    """_categorize for coroutines: the batch result is awaited, the single call goes to acall_llm."""
+    if microbatch.enabled_for(priority):
+        future = microbatch.batcher.submit(
+            email_id, body, templates["categorize"], use_cache, priority, _known_labels(templates)
+        )
+        batched = await asyncio.wrap_future(future)
+        if batched is not None:
+            info.update(model=batched["model"], batch_size=batched["batch_size"])
+            return batched["label"]
+    return await _llm_message(prompt, 60, use_cache, priority, "categorize", info)
+
+
+async def _arun_parallel(
+    bodies, templates, timings, use_cache=True, category=None, priority="interactive", email_id=None
+):
+    """_run_parallel for coroutines: both calls are awaited together on acall_llm."""
+    cat_prompt, actions_prompt = _parallel_prompts(bodies, templates, timings, category)
+    served = {"extract_actions": {}}
+    calls = [actions.aextract(actions_prompt, use_cache, priority, served["extract_actions"])]
+    if category is None:
+        served["categorize"] = {}
+        calls.append(_acategorize(
+            email_id, bodies["categorize"], cat_prompt, templates, use_cache, priority, served["categorize"]
+        ))
+    replies = await asyncio.gather(*(_atimed(call) for call in calls))
+
+    extracted, timings["extract_actions"] = replies[0]
+    if category is None:
+        cat_resp, timings["categorize"] = replies[1]
+    else:
+        cat_resp = category
+    return _parallel_result(cat_resp, extracted, served)
+
+
+async def _arun_fused(body_text, templates, timings, use_cache=True, priority="interactive"):
+    prompt = _fused_prompt(body_text, templates, timings)
+    served = {"fused": {}}
+    call = _llm_message(prompt, 460, use_cache, priority, "fused", served["fused"], FUSED_SCHEMA)
+    resp, timings["fused"] = await _atimed(call)
+    return _parse_fused(resp, served)
+
+
+async def aprocess_one(
+    email, templates=None, mode=None, use_cache=True, force=False, threshold=None, priority="interactive"
+):
+    """
+    process_one for coroutines (ASGI mode), with the same arguments and result.
+    SQLite work and the classifier run on the offload threads (db.run_sync);
+    the model calls, including condensing an over-budget body, are awaited,
+    so a waiting email holds no thread.
+    """
+    started = time.perf_counter()
+    timings = {}
+    mode = mode or PROCESS_MODE
+    use_cache = use_cache and not force
+
+    templates, stored, decision = await run_sync(_begin, email, templates, force, threshold, timings, started)
+    if stored is not None:
+        return stored
+    (bodies, body_info), timings["condense"] = await _atimed(_acondense(email, use_cache, priority))
+
+    llm_started = time.perf_counter()
+    result = None
+    if decision["category"] is not None:
+        result = await _arun_parallel(bodies, templates, timings, use_cache, decision["category"], priority)
+    elif mode == "fused":
+        result = await _arun_fused(bodies["extract_actions"], templates, timings, use_cache, priority)
+        if result is None:
+            print("Warning: fused reply was not valid JSON, falling back to parallel calls")
+            mode = "parallel"
+    if result is None:
+        result = await _arun_parallel(
+            bodies, templates, timings, use_cache, priority=priority, email_id=email.get("id")
+        )
+    timings["llm"] = _elapsed_ms(llm_started)
+
+    return await run_sync(_finish, email, result, decision, templates, mode, body_info, timings, started)
+
+
+def process_many(emails, templates=None, concurrency=None, mode=None, use_cache=True, force=False, threshold=None):
+    """
+    Process a list of emails on a bounded thread pool.
+    Yields one dict per email, in completion order (not input order);
+    each carries the email's position in the input as "index".
+    LLM calls run at "batch" priority, behind interactive requests.
+    """
+    if templates is None:
+        templates = load_templates()
+    concurrency = max(1, min(concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+    futures = {}
+    try:
+        for index, email in enumerate(emails):
+            if not isinstance(email, dict) or not email.get("body"):
+                yield {"index": index, "error": "email.body is required"}
+                continue
+            futures[executor.submit(process_one, email, templates, mode, use_cache, force, threshold, "batch")] = index
+
+        for future in as_completed(futures):
+            index = futures[future]
+            item = {"index": index, "id": emails[index].get("id")}
+            try:
+                item.update(future.result())
+            except Exception as e:
+                print("Warning: batch item failed:", repr(e))
+                item["error"] = str(e)
+            yield item
+    finally:
+        # If the client went away mid-stream, don't start the remaining emails
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,108 @@
+# search.py
+# Ranked full-text search over the emails table (SQLite FTS5, see db.init_fts).
+
+import re
+
+from db import fts_available, get_connection
+
+SEARCH_LIMIT_DEFAULT = 20
+SEARCH_LIMIT_MAX = 100
+
+_TERM_RE = re.compile(r"[\w@.'-]+\*?", re.UNICODE)
+
+
+class SearchUnavailable(RuntimeError):
+    pass
+
+
+def to_match_query(text):
+    """
+    Turn free text into a safe FTS5 query: every term is quoted (so FTS
+    operators and punctuation can't cause syntax errors) and all terms must
+    match. A trailing * keeps prefix search, e.g. "invoi*".
+    """
+    terms = []
+    for term in _TERM_RE.findall(text or ""):
+        prefix = term.endswith("*")
+        term = term.rstrip("*").replace('"', "")
+        if term:
+            terms.append(f'"{term}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def search_emails(text, category=None, sender=None, limit=SEARCH_LIMIT_DEFAULT):
+    """
+    Best-ranked emails for text (bm25, subject weighted highest), with a body
+    snippet around the matches. A message stored several times (unprocessed
+    copy, results for older template versions) is returned once, preferring
+    the most recent processed row.
+    """
+    match = to_match_query(text)
+    if not match:
+        return []
+    limit = max(1, min(limit, SEARCH_LIMIT_MAX))
+
+    filters = ""
+    params = [match]
+    if category:
+        filters += " AND e.category = ? COLLATE NOCASE"
+        params.append(category)
+    if sender:
+        filters += " AND e.sender LIKE ?"
+        params.append(f"%{sender}%")
+    params.append(limit)
+
+    conn = get_connection()
+    try:
+        if not fts_available(conn):
+            raise SearchUnavailable("full-text search is not available (SQLite without FTS5)")
+        cur = conn.cursor()
+        # FTS5 auxiliary functions can't run inside a window query, so rank
+        # in a materialized CTE, then dedupe and filter on the joined rows.
+        cur.execute(
+            f"""
+            WITH hits AS MATERIALIZED (
+                SELECT rowid AS id, bm25(emails_fts, 5.0, 1.0, 2.0) AS score
+                FROM emails_fts WHERE emails_fts MATCH ?
+            )
+            SELECT id, external_id, sender, subject, timestamp, category, score FROM (
+                SELECT e.id, e.external_id, e.sender, e.subject, e.timestamp, e.category, h.score,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY COALESCE(e.external_id, e.id)
+                           ORDER BY e.category IS NULL, e.id DESC
+                       ) AS copy
+                FROM hits h
+                JOIN emails e ON e.id = h.id
+                WHERE 1 = 1{filters}
+            )
+            WHERE copy = 1
+            ORDER BY score
+            LIMIT ?
+            """,
+            params,
+        )
+        rows = cur.fetchall()
+
+        # snippets only for the rows we return
+        snippets = {}
+        if rows:
+            ids = [row["id"] for row in rows]
+            cur.execute(
+                f"""
+                SELECT rowid, snippet(emails_fts, 1, '[', ']', '…', 16) AS snippet
+                FROM emails_fts
+                WHERE emails_fts MATCH ? AND rowid IN ({", ".join("?" * len(ids))})
+                """,
+                [match, *ids],
+            )
+            snippets = {r["rowid"]: r["snippet"] for r in cur.fetchall()}
+    finally:
+        conn.close()
+
+    results = []
+    for row in rows:
+        r = dict(row)
+        r["snippet"] = snippets.get(r["id"], "")
+        r["score"] = round(-r["score"], 4)  # bm25 is lower-is-better; flip for readability
+        results.append(r)
+    return results
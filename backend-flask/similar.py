@@ -0,0 +1,403 @@
+# similar.py
+# Offline "similar emails" index. Each stored email becomes a hashed TF-IDF
+# vector (no embedding service); vectors live in append-only float32 files
+# under data/similar_index/ that are memory-mapped, never rebuilt at startup.
+# Top-k is a chunked matrix product of the memmap with the query vector(s).
+#
+# IDF weights are fixed when a row is appended, so older vectors drift as the
+# corpus grows; a sync rebuilds the whole index (into a side directory, then
+# swapped in) once the document count has grown SIMILAR_REBUILD_GROWTH times.
+#
+#   python similar.py sync       # index rows added since the last run
+#   python similar.py rebuild    # re-vectorize everything (refreshes IDF weights)
+
+import json
+import os
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from db import DATA_DIR, get_connection, init_db
+from utils import tokenize
+
+try:
+    import fcntl  # serializes index writers across gunicorn workers (POSIX only)
+except ImportError:
+    fcntl = None
+
+SIMILAR_INDEX_DIR = os.getenv("SIMILAR_INDEX_DIR", os.path.join(DATA_DIR, "similar_index"))
+SIMILAR_DIM = int(os.getenv("SIMILAR_DIM", "512"))  # hashed feature buckets per vector
+SIMILAR_SYNC_BATCH = int(os.getenv("SIMILAR_SYNC_BATCH", "5000"))  # emails vectorized per write
+SIMILAR_REBUILD_GROWTH = float(os.getenv("SIMILAR_REBUILD_GROWTH", "2"))  # rebuild when docs grow this much, 0 = never
+SIMILAR_REBUILD_MIN_DOCS = 500  # no automatic rebuild below twice this many
+SIMILAR_QUERY_CHUNK = 65536  # rows per matrix product, bounds temporary memory
+SIMILAR_K_DEFAULT = 10
+SIMILAR_K_MAX = 100
+
+_lock = threading.Lock()
+_syncer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="similar")
+_sync_pending = False  # a sync is queued and hasn't started yet, so another request needn't queue one
+_pending_lock = threading.Lock()
+# replaced as a whole, never updated in place: a reader holding one view sees matching vectors/ids/keys
+_view = {"meta_mtime": None, "meta": None, "vectors": None, "ids": None, "keys": None}
+
+
+# ---------- VECTORIZING ----------
+
+def _buckets(tokens, dim):
+    """Stable (crc32) signed feature hashing: bucket index and +/-1 per token."""
+    idx = np.empty(len(tokens), dtype=np.int64)
+    sign = np.empty(len(tokens), dtype=np.float32)
+    for i, token in enumerate(tokens):
+        h = zlib.crc32(token.encode("utf-8"))
+        idx[i] = h % dim
+        sign[i] = 1.0 if (h >> 31) & 1 else -1.0
+    return idx, sign
+
+
+def _doc_text(subject, body):
+    # subject words count twice: short but usually the most topical
+    return f"{subject or ''} {subject or ''} {body or ''}"
+
+
+def _term_vector(text, dim):
+    """Signed, log-scaled term frequencies and the set of buckets present."""
+    idx, sign = _buckets(tokenize(text), dim)
+    counts = np.bincount(idx, weights=sign, minlength=dim).astype(np.float32)
+    nz = counts != 0
+    counts[nz] = np.sign(counts[nz]) * (1.0 + np.log(np.abs(counts[nz])))
+    return counts, np.unique(idx)
+
+
+def _weight(tf, meta):
+    df = np.asarray(meta["df"], dtype=np.float32)
+    idf = np.log((1.0 + meta["docs"]) / (1.0 + df)) + 1.0
+    vec = tf * idf
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+def _body_key(body_hash_hex):
+    # first 64 bits of the body hash, to drop identical copies of a message
+    return int(body_hash_hex[:16], 16) - (1 << 63) if body_hash_hex else 0
+
+
+# ---------- STORAGE ----------
+
+_INDEX_FILES = ("vectors.f32", "ids.i64", "keys.i64", "meta.json")  # meta.json last: it commits the rest
+
+
+def _path(name, directory=SIMILAR_INDEX_DIR):
+    return os.path.join(directory, name)
+
+
+def _read_meta(directory=SIMILAR_INDEX_DIR):
+    try:
+        with open(_path("meta.json", directory), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {
+            "dim": SIMILAR_DIM, "count": 0, "docs": 0, "rebuilt_docs": 0, "last_email_id": 0,
+            "df": [0] * SIMILAR_DIM,
+        }
+
+
+def _write_meta(meta, directory=SIMILAR_INDEX_DIR):
+    tmp = _path("meta.json.tmp", directory)
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, _path("meta.json", directory))  # readers see the old or the new count, never half
+
+
+def _current_view():
+    """Memory-mapped vectors/ids/keys for the rows counted in meta.json (re-mapped when it changes)."""
+    global _view
+    view = _view
+    try:
+        mtime = os.stat(_path("meta.json")).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime == view["meta_mtime"] and view["meta"] is not None:
+        return view
+
+    meta = _read_meta()
+    n, dim = meta["count"], meta["dim"]
+    view = {"meta_mtime": mtime, "meta": meta, "vectors": None, "ids": None, "keys": None}
+    if n:
+        view["vectors"] = np.memmap(_path("vectors.f32"), dtype=np.float32, mode="r", shape=(n, dim))
+        view["ids"] = np.memmap(_path("ids.i64"), dtype=np.int64, mode="r", shape=(n,))
+        view["keys"] = np.memmap(_path("keys.i64"), dtype=np.int64, mode="r", shape=(n,))
+    _view = view  # one reference assignment: concurrent readers keep the view they already hold
+    return view
+
+
+class _WriterLock:
+    """Thread lock plus an exclusive file lock, so one process appends at a time."""
+
+    def __enter__(self):
+        _lock.acquire()
+        os.makedirs(SIMILAR_INDEX_DIR, exist_ok=True)
+        self.f = open(_path("write.lock"), "w")
+        if fcntl:
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        _lock.release()
+
+
+def _append(name, array, offset_rows, row_bytes, directory=SIMILAR_INDEX_DIR):
+    with open(_path(name, directory), "ab+") as f:
+        # drop any tail a crashed writer left past the committed count
+        f.truncate(offset_rows * row_bytes)
+    with open(_path(name, directory), "ab") as f:
+        f.write(np.ascontiguousarray(array).tobytes())
+
+
+def _sync_into(directory, limit=None):
+    """Append rows past meta's last_email_id to the index in directory (caller holds _WriterLock)."""
+    indexed = 0
+    meta = _read_meta(directory)
+    dim = meta["dim"]
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        while limit is None or indexed < limit:
+            cur.execute(
+                "SELECT id, subject, body, body_hash FROM emails WHERE id > ? ORDER BY id LIMIT ?",
+                (meta["last_email_id"], SIMILAR_SYNC_BATCH),
+            )
+            rows = cur.fetchall()
+            if not rows:
+                break
+
+            tfs = []
+            df = np.asarray(meta["df"], dtype=np.float64)
+            for row in rows:
+                tf, present = _term_vector(_doc_text(row["subject"], row["body"]), dim)
+                df[present] += 1
+                tfs.append(tf)
+            meta["df"] = df.tolist()
+            meta["docs"] += len(rows)
+            vectors = np.stack([_weight(tf, meta) for tf in tfs]).astype(np.float32)
+
+            n = meta["count"]
+            _append("vectors.f32", vectors, n, dim * 4, directory)
+            _append("ids.i64", np.array([r["id"] for r in rows], dtype=np.int64), n, 8, directory)
+            keys = np.array([_body_key(r["body_hash"]) for r in rows], dtype=np.int64)
+            _append("keys.i64", keys, n, 8, directory)
+
+            meta["count"] = n + len(rows)
+            meta["last_email_id"] = rows[-1]["id"]
+            _write_meta(meta, directory)
+            indexed += len(rows)
+    finally:
+        conn.close()
+    return indexed
+
+
+def _rebuild_locked():
+    """
+    Re-vectorize every row into a side directory, then swap its files in
+    (meta.json last). Readers keep their mapped files until they see the new
+    meta.json, so queries keep working during a rebuild. Returns the row count.
+    """
+    side = _path("rebuild")
+    os.makedirs(side, exist_ok=True)
+    for name in _INDEX_FILES:
+        if os.path.exists(_path(name, side)):
+            os.remove(_path(name, side))
+    count = _sync_into(side)
+    meta = _read_meta(side)
+    meta["rebuilt_docs"] = meta["docs"]
+    _write_meta(meta, side)
+    for name in _INDEX_FILES:
+        os.replace(_path(name, side), _path(name))
+    return count
+
+
+def _needs_rebuild(meta):
+    """IDF weights drift as the corpus grows: rebuild once docs have grown SIMILAR_REBUILD_GROWTH times."""
+    if SIMILAR_REBUILD_GROWTH <= 0:
+        return False
+    baseline = max(meta.get("rebuilt_docs", 0), SIMILAR_REBUILD_MIN_DOCS)
+    return meta["docs"] >= baseline * SIMILAR_REBUILD_GROWTH
+
+
+def sync(limit=None):
+    """Vectorize emails rows added since the last sync (rebuilding if IDF is stale). Returns the number indexed."""
+    with _WriterLock():
+        indexed = _sync_into(SIMILAR_INDEX_DIR, limit)
+        if indexed and _needs_rebuild(_read_meta()):
+            _rebuild_locked()
+    return indexed
+
+
+def schedule_sync():
+    """
+    Index new rows in the background (called after process_email stores a row).
+    Calls while a sync is already queued are dropped: that sync will see their rows.
+    """
+    global _sync_pending
+    with _pending_lock:
+        if _sync_pending:
+            return
+        _sync_pending = True
+    _syncer.submit(_sync_quietly)
+
+
+def _sync_quietly():
+    global _sync_pending
+    with _pending_lock:
+        _sync_pending = False  # rows stored from now on need the next run
+    try:
+        sync()
+    except Exception as e:
+        print("Warning: similar-email index sync failed:", repr(e))
+
+
+def rebuild():
+    """Re-vectorize every row (IDF weights from the full corpus). Returns the row count."""
+    with _WriterLock():
+        return _rebuild_locked()
+
+
+# ---------- QUERIES ----------
+
+def top_k(queries, k, exclude_keys=None, view=None):
+    """
+    Best k rows for each query vector (rows of a 2-D array), computed chunk by
+    chunk as one matrix product per chunk. Returns, per query, a list of
+    (email_row_id, score) with duplicate bodies and exclude_keys removed.
+    """
+    view = view or _current_view()
+    vectors, ids, keys = view["vectors"], view["ids"], view["keys"]
+    if vectors is None:
+        return [[] for _ in range(len(queries))]
+
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    n = vectors.shape[0]
+    # over-fetch so duplicates of one message can be dropped and still leave k
+    fetch = min(n, k * 4 + 8)
+    best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+
+    for start in range(0, n, SIMILAR_QUERY_CHUNK):
+        block = vectors[start:start + SIMILAR_QUERY_CHUNK]
+        scores = queries @ block.T  # (queries, rows in chunk)
+        take = min(fetch, scores.shape[1])
+        part = np.argpartition(-scores, take - 1, axis=1)[:, :take]
+        best_scores = np.concatenate([best_scores, np.take_along_axis(scores, part, axis=1)], axis=1)
+        best_rows = np.concatenate([best_rows, part + start], axis=1)
+        if best_scores.shape[1] > fetch:
+            keep = np.argpartition(-best_scores, fetch - 1, axis=1)[:, :fetch]
+            best_scores = np.take_along_axis(best_scores, keep, axis=1)
+            best_rows = np.take_along_axis(best_rows, keep, axis=1)
+
+    results = []
+    for qi in range(len(queries)):
+        order = np.argsort(-best_scores[qi])
+        seen = set(exclude_keys or ())
+        hits = []
+        for j in order:
+            row = best_rows[qi, j]
+            key = int(keys[row])
+            if key and key in seen:
+                continue
+            seen.add(key)
+            hits.append((int(ids[row]), float(best_scores[qi, j])))
+            if len(hits) == k:
+                break
+        results.append(hits)
+    return results
+
+
+def query_vector(subject, body, view=None):
+    meta = (view or _current_view())["meta"]
+    tf, _ = _term_vector(_doc_text(subject, body), meta["dim"])
+    return _weight(tf, meta)
+
+
+def similar_to_text(text, k=SIMILAR_K_DEFAULT, exclude_keys=None):
+    """Most similar stored emails for free text: [(email_row_id, score)]."""
+    if not tokenize(text):
+        return []
+    view = _current_view()  # one view for weighting and scoring
+    return top_k(query_vector("", text, view)[None, :], k, exclude_keys, view)[0]
+
+
+def similar_to_email(email_row, k=SIMILAR_K_DEFAULT):
+    """Most similar stored emails to an emails row, excluding copies of itself."""
+    exclude = {_body_key(email_row["body_hash"])} if email_row["body_hash"] else None
+    if not tokenize(_doc_text(email_row["subject"], email_row["body"])):
+        return []
+    view = _current_view()
+    vec = query_vector(email_row["subject"], email_row["body"], view)
+    hits = top_k(vec[None, :], k + 1, exclude, view)[0]
+    return [h for h in hits if h[0] != email_row["id"]][:k]
+
+
+def find_email_row(email_id):
+    """emails row for a message id (external_id, else the numeric row id), or None."""
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, subject, body, body_hash FROM emails
+            WHERE external_id = ?
+            ORDER BY category IS NULL, id DESC
+            LIMIT 1
+            """,
+            (str(email_id),),
+        )
+        row = cur.fetchone()
+        if row is None and str(email_id).isdigit():
+            cur.execute("SELECT id, subject, body, body_hash FROM emails WHERE id = ?", (int(email_id),))
+            row = cur.fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def describe(hits):
+    """Attach stored fields to [(email_row_id, score)], keeping the ranking."""
+    if not hits:
+        return []
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        placeholders = ",".join("?" * len(hits))
+        cur.execute(
+            f"""
+            SELECT id, external_id, sender, subject, timestamp, category
+            FROM emails WHERE id IN ({placeholders})
+            """,
+            [row_id for row_id, _ in hits],
+        )
+        rows = {row["id"]: dict(row) for row in cur.fetchall()}
+    finally:
+        conn.close()
+    return [dict(rows[row_id], score=round(score, 4)) for row_id, score in hits if row_id in rows]
+
+
+def main():
+    init_db()
+    command = sys.argv[1] if len(sys.argv) > 1 else "sync"
+    if command == "rebuild":
+        print(f"Rebuilt similar-email index: {rebuild()} rows")
+    elif command == "sync":
+        print(f"Indexed {sync()} new rows")
+    else:
+        print("usage: python similar.py [sync|rebuild]")
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# utils.py
+# Small helpers shared by the Flask routes and the processing pipeline.
+
+import ast
+import hashlib
+import json
+import re
+
+
+def safe_json_loads(s, fallback=None):
+    try:
+        return json.loads(s)
+    except Exception:
+        return fallback
+
+
+def body_hash(body_text):
+    """Content hash of an email body, part of the processed-email idempotency key."""
+    return hashlib.sha256(body_text.encode("utf-8")).hexdigest()
+
+
+# ---------- TOKENS ----------
+
+_TOKEN_RE = re.compile(r"[a-z0-9][a-z0-9'_-]+")
+_STOPWORDS = frozenset(
+    "the and for you your with this that are was will have from not but can our all any "
+    "has had its it's been were they them their there here what when which who how out "
+    "about into than then also just more some would could should please thanks thank "
+    "regards hi hello dear best".split()
+)
+
+
+def tokenize(text):
+    """Lowercased word tokens without stopwords (similar-emails vectors, classifier features)."""
+    return [t for t in _TOKEN_RE.findall((text or "").lower()) if t not in _STOPWORDS]
+
+
+# ---------- JSON REPAIR ----------
+
+_FENCE_RE = re.compile(r"```[\w-]*\s*\n?(.*?)```", re.DOTALL)
+_TRAILING_COMMA_RE = re.compile(r",(\s*[\]}])")
+_CLOSERS = {"[": "]", "{": "}"}
+
+
+def _balanced(text, start):
+    """The bracketed value starting at text[start] (quotes respected), or None if it never closes."""
+    stack, quote, escaped = [], None, False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if quote:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == quote:
+                quote = None
+        elif ch in "\"'":
+            quote = ch
+        elif ch in _CLOSERS:
+            stack.append(_CLOSERS[ch])
+        elif ch in "]}":
+            if not stack or stack.pop() != ch:
+                return None
+            if not stack:
+                return text[start:i + 1]
+    return None
+
+
+def _loads_lenient(candidate):
+    """json.loads, then with trailing commas removed, then as a Python literal (single quotes, None)."""
+    for attempt in (candidate, _TRAILING_COMMA_RE.sub(r"\1", candidate)):
+        try:
+            return json.loads(attempt), True
+        except ValueError:
+            pass
+    try:
+        return ast.literal_eval(candidate), True
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        return None, False
+
+
+def extract_json(text, openers="[{"):
+    """
+    Pull a JSON value out of a model reply: the reply itself if it parses,
+    else the first balanced value starting with one of openers, looked for
+    inside a ``` code fence first and then in the whole reply (prose around
+    it is ignored, trailing commas and single quotes are tolerated).
+    Returns (value, repaired); value is None if nothing usable was found.
+    """
+    if not isinstance(text, str) or not text.strip():
+        return None, False
+    try:
+        return json.loads(text), False
+    except ValueError:
+        pass
+
+    sources = [m.group(1) for m in _FENCE_RE.finditer(text)] + [text]
+    for source in sources:
+        starts = [i for i in (source.find(o) for o in openers) if i != -1]
+        while starts:
+            start = min(starts)
+            candidate = _balanced(source, start)
+            if candidate is not None:
+                value, ok = _loads_lenient(candidate)
+                if ok:
+                    return value, True
+            starts = [i for i in (source.find(o, start + 1) for o in openers) if i != -1]
+    return None, False
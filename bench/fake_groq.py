@@ -0,0 +1,292 @@
+# fake_groq.py
+# Offline stand-in for Groq's OpenAI-compatible chat-completions API, for
+# benchmarks and load tests. Point the backend at it with
+#   GROQ_BASE_URL=http://127.0.0.1:8099 GROQ_API_KEY=fake python app.py
+#
+#   python fake_groq.py --latency lognormal:0.6,0.5 --error-rate 0.02 --tokens-per-sec 250
+#   python fake_groq.py --latency fixed:0.3 --model-latency llama-3.3-70b-versatile=fixed:1.5
+#
+# Latency specs: fixed:<s>, uniform:<lo>,<hi>, lognormal:<median>,<sigma>, or 0.
+# --model-latency overrides the spec for one model (repeatable).
+# Replies look like what the pipeline expects: a label for categorize prompts,
+# a JSON task list for action prompts, a JSON object for fused prompts and a
+# JSON array of {"id", "label"} for micro-batched categorize prompts.
+# With response_format (JSON mode) action replies are a {"actions": [...]}
+# object; without it, --messy-json wraps that fraction of JSON replies the way
+# models do (code fences, prose, trailing commas, or no JSON at all).
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LABELS = ["Important", "To-Do", "Newsletter", "Spam", "Social"]
+WORDS = (
+    "thanks for the update I will review the proposal and get back to you by "
+    "Friday with comments on scope timeline budget and next steps for the team"
+).split()
+
+
+def parse_latency(spec):
+    """Return a function that samples a delay in seconds from a latency spec."""
+    spec = str(spec or "0")
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: random.lognormvariate(math.log(median), sigma)
+    return lambda: float(spec)
+
+
+def parse_model_latency(items):
+    """["model=spec", ...] -> {model: spec}."""
+    specs = {}
+    for item in items:
+        model, sep, spec = item.partition("=")
+        if not sep:
+            raise ValueError(f"expected MODEL=SPEC, got {item!r}")
+        specs[model.strip()] = spec.strip()
+    return specs
+
+
+class FakeGroq:
+    """Counters plus the knobs that shape responses; shared by handler threads."""
+
+    def __init__(
+        self, latency="0", error_rate=0.0, rate_limit_rate=0.0, tokens_per_sec=0.0, retry_after=1.0, model_latency=None,
+        messy_json=0.0,
+    ):
+        self.default_latency = parse_latency(latency)
+        self.model_latency = {model: parse_latency(spec) for model, spec in (model_latency or {}).items()}
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.tokens_per_sec = tokens_per_sec
+        self.retry_after = retry_after
+        self.messy_json = messy_json
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0, "errors": 0, "rate_limited": 0, "streams": 0, "completion_tokens": 0, "json_mode": 0,
+            "messy": 0, "models": {},
+        }
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def count_model(self, model):
+        with self.lock:
+            self.stats["models"][model] = self.stats["models"].get(model, 0) + 1
+
+    def sample_latency(self, model=None):
+        return self.model_latency.get(model, self.default_latency)()
+
+    def reply_for(self, messages, max_tokens, response_format=None):
+        prompt = (messages[-1].get("content") or "") if messages else ""
+        json_mode = bool(response_format)
+        if json_mode:
+            self.count("json_mode")
+        batch_ids = re.findall(r"^### id: (\S+)$", prompt, re.MULTILINE)
+        if batch_ids:
+            return self._json([{"id": i, "label": random.choice(LABELS)} for i in batch_ids], json_mode)
+        if "Task 1 (category)" in prompt:
+            return self._json({"category": random.choice(LABELS), "actions": self._actions()}, json_mode)
+        if "Categorize" in prompt or max_tokens <= 60:
+            return random.choice(LABELS)
+        if '{"actions"' in prompt:  # the pipeline's repair call
+            return self._json({"actions": self._actions()}, json_mode)
+        if "actionable tasks" in prompt or "JSON array" in prompt:
+            return self._json({"actions": self._actions()} if json_mode else self._actions(), json_mode)
+        n = min(max_tokens, random.randint(40, 160))
+        return " ".join(random.choice(WORDS) for _ in range(n))
+
+    def _json(self, value, json_mode):
+        text = json.dumps(value)
+        if json_mode or random.random() >= self.messy_json:
+            return text
+        self.count("messy")
+        return random.choice((
+            lambda: f"```json\n{text}\n```",
+            lambda: f"Here is what I found:\n{text}\nLet me know if you need anything else.",
+            lambda: re.sub(r"([\]}])$", r",\1", re.sub(r"}(\s*)\]", r"},\1]", text)),
+            lambda: "I could not find any clear tasks in this email.",
+        ))()
+
+    def _actions(self):
+        return [
+            {"task": "Reply with " + random.choice(WORDS), "deadline": None, "assignee": None}
+            for _ in range(random.randint(0, 3))
+        ]
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+        def log_message(self, *args):
+            pass
+
+        def _json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                with fake.lock:
+                    return self._json(200, dict(fake.stats))
+            self._json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                req = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                return self._json(400, {"error": {"message": "invalid JSON"}})
+            if not self.path.endswith("/chat/completions"):
+                return self._json(404, {"error": {"message": "not found"}})
+
+            fake.count("requests")
+            fake.count_model(req.get("model", "fake-model"))
+            time.sleep(fake.sample_latency(req.get("model")))  # time to first token
+
+            roll = random.random()
+            if roll < fake.rate_limit_rate:
+                fake.count("rate_limited")
+                return self._json(
+                    429,
+                    {"error": {"message": "Rate limit reached", "type": "tokens", "code": "rate_limit_exceeded"}},
+                    {"retry-after": str(fake.retry_after)},
+                )
+            if roll < fake.rate_limit_rate + fake.error_rate:
+                fake.count("errors")
+                return self._json(500, {"error": {"message": "Internal server error", "type": "internal_server_error"}})
+
+            model = req.get("model", "fake-model")
+            content = fake.reply_for(
+                req.get("messages") or [], int(req.get("max_tokens") or 800), req.get("response_format")
+            )
+            tokens = content.split(" ")
+            usage = {
+                "prompt_tokens": sum(len(m.get("content") or "") for m in req.get("messages") or []) // 4,
+                "completion_tokens": len(tokens),
+            }
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            fake.count("completion_tokens", len(tokens))
+            completion_id = "chatcmpl-" + uuid.uuid4().hex[:24]
+
+            if req.get("stream"):
+                return self._stream(completion_id, model, tokens, usage)
+
+            if fake.tokens_per_sec:
+                time.sleep(len(tokens) / fake.tokens_per_sec)
+            self._json(
+                200,
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                    ],
+                    "usage": usage,
+                },
+            )
+
+        def _stream(self, completion_id, model, tokens, usage):
+            fake.count("streams")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def send(data):
+                chunk = f"data: {data}\n\n".encode("utf-8")
+                self.wfile.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n")
+                self.wfile.flush()
+
+            for i, token in enumerate(tokens):
+                delta = {"content": token if i == 0 else " " + token}
+                send(json.dumps({
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+                }))
+                if fake.tokens_per_sec:
+                    time.sleep(1 / fake.tokens_per_sec)
+            # like Groq: the last chunk carries the usage, under x_groq
+            send(json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "x_groq": {"id": "req_" + completion_id[-24:], "usage": usage},
+            }))
+            send("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+
+    return Handler
+
+
+def serve(host="127.0.0.1", port=8099, **options):
+    """Start the fake API on a background thread; returns (server, fake)."""
+    fake = FakeGroq(**options)
+    ThreadingHTTPServer.request_queue_size = 1024  # listen backlog; the default 5 refuses bursts
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, fake
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Groq chat-completions server for offline load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", default="lognormal:0.4,0.5", help="time to first token (see module doc)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 500 responses")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of 429 responses")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry-after seconds sent with 429s")
+    parser.add_argument("--tokens-per-sec", type=float, default=0.0, help="generation speed (0 = instant)")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SPEC",
+                        help="latency spec for one model (repeatable)")
+    parser.add_argument("--messy-json", type=float, default=0.0,
+                        help="fraction of JSON replies wrapped in fences/prose or broken (without JSON mode)")
+    args = parser.parse_args()
+
+    server, _ = serve(
+        args.host,
+        args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        tokens_per_sec=args.tokens_per_sec,
+        retry_after=args.retry_after,
+        model_latency=parse_model_latency(args.model_latency),
+        messy_json=args.messy_json,
+    )
+    print(f"Fake Groq listening on http://{args.host}:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
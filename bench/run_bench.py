@@ -0,0 +1,383 @@
+# run_bench.py
+# Load test for the Flask API and the Django views, fully offline: the backend
+# is started against fake_groq.py with a throwaway database, then each target
+# is driven at every concurrency level. Results (p50/p95/p99 latency,
+# requests/sec, SQLite time from the Server-Timing header) are printed and
+# saved as JSON so runs can be compared.
+#
+#   python run_bench.py                                  # all targets, concurrency 1,8,32
+#   python run_bench.py --targets process,agent --concurrency 4,16 --requests 200
+#   python run_bench.py --latency fixed:0.8 --error-rate 0.05 --out before.json
+#   python run_bench.py --compare before.json            # print deltas against an older run
+
+import argparse
+import json
+import math
+import os
+import platform
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+import fake_groq
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(ROOT, "backend-flask")
+FRONTEND_DIR = os.path.join(ROOT, "frontend-django")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+SERVER_TIMING_DB_RE = re.compile(r"\bdb;dur=([\d.]+)")
+
+SAMPLE_EMAIL = {
+    "sender": "alice@acme.com",
+    "subject": "Project kickoff: availability next week",
+    "timestamp": "2025-11-18T09:15:00Z",
+    "body": (
+        "Hi, can we schedule a 60-minute kickoff meeting next week to align on "
+        "milestones and owners? Please send your availability by Thursday."
+    ),
+}
+
+
+# ---------- TARGETS ----------
+
+def _email(i, unique):
+    email = dict(SAMPLE_EMAIL, id=f"bench-{i}")
+    if unique:
+        # a new body each time, so the idempotent pipeline can't reuse a stored result
+        email["body"] = f"{email['body']}\n\nRef {uuid.uuid4().hex}"
+    return email
+
+
+def t_process(ctx, session, i):
+    return session.post(f"{ctx['backend']}/api/process", json={"email": _email(i, ctx["unique"])}, timeout=120)
+
+
+def t_agent(ctx, session, i):
+    payload = {"email": _email(i, ctx["unique"]), "userInstruction": "Draft a short reply.", "fresh": ctx["unique"]}
+    return session.post(f"{ctx['backend']}/api/agent", json=payload, timeout=120)
+
+
+def t_drafts_post(ctx, session, i):
+    payload = {"subject": f"Re: bench {i}", "body": "Thanks, sounds good.", "meta": {"bench": True}}
+    return session.post(f"{ctx['backend']}/api/drafts", json=payload, timeout=30)
+
+
+def t_drafts_get(ctx, session, i):
+    return session.get(f"{ctx['backend']}/api/drafts", timeout=30)
+
+
+def t_drafts_page(ctx, session, i):
+    return session.get(f"{ctx['backend']}/api/drafts", params={"limit": 20}, timeout=30)
+
+
+def t_django_inbox(ctx, session, i):
+    return session.get(f"{ctx['django']}/", timeout=60)
+
+
+def t_django_email(ctx, session, i):
+    return session.get(f"{ctx['django']}/", params={"email_id": f"e-{i % 15 + 1:03d}"}, timeout=60)
+
+
+def t_django_agent(ctx, session, i):
+    return session.get(f"{ctx['django']}/agent/e-{i % 15 + 1:03d}/", timeout=60)
+
+
+def t_django_drafts(ctx, session, i):
+    return session.get(f"{ctx['django']}/drafts/", timeout=60)
+
+
+TARGETS = {
+    "process": t_process,
+    "agent": t_agent,
+    "drafts_post": t_drafts_post,
+    "drafts_get": t_drafts_get,
+    "drafts_page": t_drafts_page,
+    "django_inbox": t_django_inbox,
+    "django_email": t_django_email,
+    "django_agent": t_django_agent,
+    "django_drafts": t_django_drafts,
+}
+
+
+# ---------- SERVERS ----------
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url, proc, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"server for {url} exited with code {proc.returncode}")
+        try:
+            requests.get(url, timeout=2)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_servers(args, workdir):
+    """Start fake Groq, the backend and Django; returns (ctx, processes, fake)."""
+    procs = []
+    logs = None if args.verbose else subprocess.DEVNULL  # server request logs
+    fake_port = _free_port()
+    _, fake = fake_groq.serve(
+        port=fake_port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        tokens_per_sec=args.tokens_per_sec,
+        model_latency=fake_groq.parse_model_latency(args.model_latency),
+        messy_json=args.messy_json,
+    )
+
+    backend_url = args.backend_url
+    if not backend_url:
+        port = _free_port()
+        env = dict(
+            os.environ,
+            PORT=str(port),
+            GROQ_API_KEY="fake-key",
+            GROQ_BASE_URL=f"http://127.0.0.1:{fake_port}",
+            APP_DB_PATH=os.path.join(workdir, "app.db"),
+            LLM_CACHE_PATH=os.path.join(workdir, "llm_cache.db"),
+            LLM_CACHE_ENABLED="1" if args.llm_cache else "0",
+            SIMILAR_INDEX_DIR=os.path.join(workdir, "similar_index"),
+            LLM_RPM=str(args.llm_rpm),
+            LLM_TPM=str(args.llm_tpm),
+        )
+        if args.server == "gunicorn":
+            cmd = [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "--threads", str(args.threads),
+                   "-b", f"127.0.0.1:{port}", "app:app"]
+        elif args.server == "asgi":
+            cmd = [sys.executable, "-m", "gunicorn", "-k", "asgi", "-w", str(args.workers),
+                   "--worker-connections", "1000", "-b", f"127.0.0.1:{port}", "asgi:app"]
+        else:
+            cmd = [sys.executable, "app.py"]
+        procs.append(subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=logs))
+        backend_url = f"http://127.0.0.1:{port}"
+        _wait_for(f"{backend_url}/api/health", procs[-1])
+
+    django_url = args.django_url
+    if not django_url and any(t.startswith("django_") for t in args.targets):
+        port = _free_port()
+        env = dict(os.environ, FLASK_API_BASE=backend_url)
+        if args.server in ("gunicorn", "asgi"):
+            cmd = [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "--threads", str(args.threads),
+                   "-b", f"127.0.0.1:{port}", "email_site.wsgi"]
+        else:
+            cmd = [sys.executable, "manage.py", "runserver", "--noreload", f"127.0.0.1:{port}"]
+        procs.append(subprocess.Popen(cmd, cwd=FRONTEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=logs))
+        django_url = f"http://127.0.0.1:{port}"
+        _wait_for(f"{django_url}/drafts/", procs[-1])
+
+    ctx = {"backend": backend_url, "django": django_url, "unique": not args.reuse}
+    return ctx, procs, fake
+
+
+# ---------- MEASUREMENT ----------
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def _summary(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        "mean": round(sum(values) / len(values), 2),
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "max": round(values[-1], 2),
+    }
+
+
+def run_level(ctx, name, concurrency, n_requests, warmup):
+    fn = TARGETS[name]
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    def one(i):
+        started = time.perf_counter()
+        try:
+            resp = fn(ctx, session(), i)
+            resp.content  # read the whole body
+            status = resp.status_code
+            match = SERVER_TIMING_DB_RE.search(resp.headers.get("Server-Timing", ""))
+            db_ms = float(match.group(1)) if match else None
+        except requests.RequestException:
+            status, db_ms = None, None
+        return (time.perf_counter() - started) * 1000, status, db_ms
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(warmup)))
+        started = time.perf_counter()
+        samples = list(pool.map(one, range(warmup, warmup + n_requests)))
+        wall = time.perf_counter() - started
+
+    ok = [s for s in samples if s[1] is not None and s[1] < 400]
+    db_times = [s[2] for s in samples if s[2] is not None]
+    return {
+        "target": name,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "seconds": round(wall, 3),
+        "rps": round(len(samples) / wall, 2) if wall else None,
+        "latency_ms": _summary([s[0] for s in ok]),
+        "db_ms": _summary(db_times),
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ---------- REPORTING ----------
+
+def print_results(results):
+    print(f"{'target':<15}{'conc':>5}{'req':>6}{'err':>5}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'db p50':>9}")
+    for r in results:
+        lat = r["latency_ms"] or {}
+        db = r["db_ms"] or {}
+        print(
+            f"{r['target']:<15}{r['concurrency']:>5}{r['requests']:>6}{r['errors']:>5}{r['rps'] or 0:>9.1f}"
+            f"{lat.get('p50', float('nan')):>9.1f}{lat.get('p95', float('nan')):>9.1f}"
+            f"{lat.get('p99', float('nan')):>9.1f}{db.get('p50', float('nan')):>9.2f}"
+        )
+
+
+def print_comparison(base, results):
+    """p50/p95 latency and rps of this run against an older results file."""
+    old = {(r["target"], r["concurrency"]): r for r in base["results"]}
+
+    def delta(new, prev):
+        if new is None or not prev:
+            return "     n/a"
+        return f"{(new - prev) / prev * 100:>+7.1f}%"
+
+    print(f"\nvs {base['meta'].get('revision')} ({base['meta'].get('started_at')})")
+    print(f"{'target':<15}{'conc':>5}{'p50':>9}{'p95':>9}{'rps':>9}")
+    for r in results:
+        prev = old.get((r["target"], r["concurrency"]))
+        if prev is None:
+            continue
+        lat, prev_lat = r["latency_ms"] or {}, prev["latency_ms"] or {}
+        print(
+            f"{r['target']:<15}{r['concurrency']:>5}"
+            f"{delta(lat.get('p50'), prev_lat.get('p50'))}{delta(lat.get('p95'), prev_lat.get('p95'))}"
+            f"{delta(r['rps'], prev['rps'])}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency/throughput benchmark for the email agent.")
+    parser.add_argument("--targets", default=",".join(TARGETS), help=f"comma-separated: {', '.join(TARGETS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="measured requests per target and level")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests before each level")
+    parser.add_argument("--latency", default="lognormal:0.3,0.5", help="fake Groq time to first token")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--tokens-per-sec", type=float, default=0.0)
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SPEC",
+                        help="fake Groq latency for one model (repeatable), e.g. llama-3.3-70b-versatile=fixed:1.5")
+    parser.add_argument("--messy-json", type=float, default=0.0,
+                        help="fraction of fake JSON replies wrapped in prose/fences or broken (see fake_groq.py)")
+    parser.add_argument("--reuse", action="store_true", help="send identical emails (measures the reuse/cache path)")
+    parser.add_argument("--llm-cache", action="store_true", help="keep the backend's LLM response cache on")
+    parser.add_argument("--llm-rpm", type=int, default=0, help="backend LLM_RPM (0 = unlimited)")
+    parser.add_argument("--llm-tpm", type=int, default=0, help="backend LLM_TPM (0 = unlimited)")
+    parser.add_argument("--server", choices=("dev", "gunicorn", "asgi"), default="dev",
+                        help="asgi: the backend under gunicorn -k asgi (asgi.py)")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers per server")
+    parser.add_argument("--threads", type=int, default=16, help="gunicorn threads per worker")
+    parser.add_argument("--backend-url", help="use a running backend instead of starting one")
+    parser.add_argument("--django-url", help="use a running Django site instead of starting one")
+    parser.add_argument("--verbose", action="store_true", help="show the servers' logs")
+    parser.add_argument("--out", help="results file (default: results/<timestamp>.json)")
+    parser.add_argument("--compare", help="older results file to compare against")
+    args = parser.parse_args()
+
+    args.targets = [t.strip() for t in args.targets.split(",") if t.strip()]
+    unknown = [t for t in args.targets if t not in TARGETS]
+    if unknown:
+        parser.error(f"unknown targets: {', '.join(unknown)}")
+    levels = [int(c) for c in args.concurrency.split(",")]
+
+    started_at = datetime.now(timezone.utc)
+    workdir = tempfile.mkdtemp(prefix="email-bench-")
+    procs = []
+    try:
+        ctx, procs, fake = start_servers(args, workdir)
+        results = []
+        for name in args.targets:
+            for concurrency in levels:
+                result = run_level(ctx, name, concurrency, args.requests, args.warmup)
+                results.append(result)
+                print_results([result])
+    finally:
+        for proc in procs:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "started_at": started_at.isoformat(),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+            "fake_groq": dict(fake.stats),
+        },
+        "results": results,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, started_at.strftime("%Y%m%dT%H%M%SZ") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print()
+    print_results(results)
+    print(f"\nSaved {out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
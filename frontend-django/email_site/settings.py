@@ -73,3 +73,10 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Base URL of the Flask API
 FLASK_API_BASE = os.getenv('FLASK_API_BASE', 'http://localhost:5000')
+
+# HTTP client settings for calls to the Flask API (see emails/backend.py)
+FLASK_API_CONNECT_TIMEOUT = float(os.getenv('FLASK_API_CONNECT_TIMEOUT', '3.05'))
+FLASK_API_READ_TIMEOUT = float(os.getenv('FLASK_API_READ_TIMEOUT', '30'))
+FLASK_API_LLM_TIMEOUT = float(os.getenv('FLASK_API_LLM_TIMEOUT', '90'))  # endpoints that call the model
+FLASK_API_RETRIES = int(os.getenv('FLASK_API_RETRIES', '2'))
+FLASK_API_POOL_SIZE = int(os.getenv('FLASK_API_POOL_SIZE', '20'))  # keep-alive connections per host
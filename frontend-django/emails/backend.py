@@ -0,0 +1,99 @@
+# emails/backend.py
+# Shared HTTP client for the Flask API: one keep-alive connection pool per
+# process, consistent timeouts and retries, and a small pool for issuing
+# independent backend calls at the same time.
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+FLASK_API_BASE = settings.FLASK_API_BASE
+
+# (connect, read) timeouts; LLM-backed endpoints get a longer read timeout
+TIMEOUT = (settings.FLASK_API_CONNECT_TIMEOUT, settings.FLASK_API_READ_TIMEOUT)
+LLM_TIMEOUT = (settings.FLASK_API_CONNECT_TIMEOUT, settings.FLASK_API_LLM_TIMEOUT)
+
+
+def _build_session():
+    # Connection failures are retried for every method (nothing reached the
+    # backend yet); read errors and 502/503/504 only for idempotent GETs.
+    retry = Retry(
+        total=settings.FLASK_API_RETRIES,
+        connect=settings.FLASK_API_RETRIES,
+        read=settings.FLASK_API_RETRIES,
+        status=settings.FLASK_API_RETRIES,
+        backoff_factor=0.2,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=settings.FLASK_API_POOL_SIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+session = _build_session()
+
+_fanout = ThreadPoolExecutor(
+    max_workers=settings.FLASK_API_POOL_SIZE,
+    thread_name_prefix="backend",
+)
+
+
+def get(path, timeout=TIMEOUT, **kwargs):
+    return session.get(f"{FLASK_API_BASE}{path}", timeout=timeout, **kwargs)
+
+
+def post(path, timeout=TIMEOUT, **kwargs):
+    return session.post(f"{FLASK_API_BASE}{path}", timeout=timeout, **kwargs)
+
+
+# Last ETag + decoded body per URL, so unchanged responses come back as an
+# empty 304 instead of being transferred and parsed again.
+_ETAG_CACHE_SIZE = 256
+_etag_cache = OrderedDict()
+_etag_lock = threading.Lock()
+
+
+def get_json(path, params=None, **kwargs):
+    """GET a backend path and return the decoded JSON (raises on HTTP errors)."""
+    key = (path, tuple(sorted((params or {}).items())))
+    with _etag_lock:
+        cached = _etag_cache.get(key)
+
+    headers = kwargs.pop("headers", {})
+    if cached:
+        headers = {**headers, "If-None-Match": cached[0]}
+
+    resp = get(path, params=params, headers=headers, **kwargs)
+    if resp.status_code == 304 and cached:
+        with _etag_lock:
+            _etag_cache.move_to_end(key)
+        return cached[1]
+    resp.raise_for_status()
+    data = resp.json()
+
+    etag = resp.headers.get("ETag")
+    if etag:
+        with _etag_lock:
+            _etag_cache[key] = (etag, data)
+            _etag_cache.move_to_end(key)
+            while len(_etag_cache) > _ETAG_CACHE_SIZE:
+                _etag_cache.popitem(last=False)
+    return data
+
+
+def submit(fn, *args, **kwargs):
+    """Run a backend call in the background; .result() re-raises its exception."""
+    return _fanout.submit(fn, *args, **kwargs)
@@ -6,4 +6,6 @@ urlpatterns = [
     path('prompts/', views.prompts_view, name='prompts'),
     path('drafts/', views.drafts_view, name='drafts'),
     path('agent/<email_id>/', views.agent_view, name='agent'),
+    path('agent/<email_id>/stream/', views.agent_stream_view, name='agent_stream'),
+    path('agent/<email_id>/save-draft/', views.agent_save_draft_view, name='agent_save_draft'),
 ]
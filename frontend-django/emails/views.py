@@ -1,53 +1,114 @@
 # emails/views.py
 import json
+from urllib.parse import quote, urlencode
+
 import requests
-from django.conf import settings
 from django.shortcuts import render, redirect
-from django.http import Http404
+from django.urls import reverse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_POST
 
-FLASK_API_BASE = settings.FLASK_API_BASE
+from . import backend
 
 
-def inbox_view(request):
-    # Load inbox from Flask
-    inbox_resp = requests.get(f"{FLASK_API_BASE}/api/inbox")
-    inbox_resp.raise_for_status()
-    emails = inbox_resp.json()
+INBOX_PAGE_SIZE = 50
+INBOX_LIST_FIELDS = "id,sender,subject,timestamp"  # list rows don't need bodies
+SEARCH_CATEGORIES = ["Important", "To-Do", "Newsletter", "Spam", "Social"]
+DRAFTS_PAGE_SIZE = 20
+DRAFTS_LIST_FIELDS = "id,subject,body,created_at"  # the page doesn't show meta
 
+
+def inbox_view(request):
+    error_message = None
     email_id = request.GET.get("email_id")
+    cursor = request.GET.get("cursor")
+    job_id = request.GET.get("job")
+
+    query = (request.GET.get("q") or "").strip()
+    category = request.GET.get("category") or ""
+
+    # Load one page of the inbox (or the search results) and the selected email at the same time
+    if query:
+        params = {"q": query, "limit": INBOX_PAGE_SIZE}
+        if category:
+            params["category"] = category
+        page_call = backend.submit(backend.get_json, "/api/search", params=params)
+    else:
+        params = {"limit": INBOX_PAGE_SIZE, "fields": INBOX_LIST_FIELDS}
+        if cursor:
+            params["cursor"] = cursor
+        page_call = backend.submit(backend.get_json, "/api/inbox", params=params)
+    email_call = backend.submit(_find_email, email_id) if email_id else None
+    job_call = backend.submit(backend.get_json, f"/api/jobs/{quote(job_id, safe='')}") if job_id else None
+
+    try:
+        page = page_call.result()
+    except requests.RequestException as e:
+        page = {"items": [], "next_cursor": None, "total": 0}
+        error_message = f"Failed to load inbox from backend: {e}"
+
+    if query:
+        # search hits use the message id (external_id) like inbox rows do
+        results = page.get("results", [])
+        page = {
+            "items": [dict(r, id=r.get("external_id")) for r in results],
+            "next_cursor": None,
+            "total": len(results),
+        }
+
     selected_email = None
-    if email_id:
-        selected_email = next(
-            (e for e in emails if str(e.get("id")) == str(email_id)),
-            None,
-        )
+    if email_call:
+        try:
+            selected_email = email_call.result()
+        except requests.RequestException as e:
+            error_message = f"Failed to load email from backend: {e}"
 
     process_result = None
     actions_json_pretty = None
-    error_message = None
+    job = None
 
     if request.method == "POST" and "process_email" in request.POST and selected_email:
+        # Queue it and come back to this page: the LLM calls run in the backend's job workers
         try:
-            resp = requests.post(
-                f"{FLASK_API_BASE}/api/process",
-                json={"email": selected_email},
-                timeout=60,
-            )
+            resp = backend.post("/api/jobs", json={"email": selected_email})
             data = resp.json()
-            if resp.status_code != 200:
+            if resp.status_code != 202:
                 error_message = data.get("error", f"Backend error {resp.status_code}")
             else:
-                process_result = data
-                if data.get("actions_json") is not None:
-                    actions_json_pretty = json.dumps(data["actions_json"], indent=2)
+                params = {"email_id": email_id, "job": data["id"]}
+                if query:
+                    params.update(q=query, category=category)
+                elif cursor:
+                    params["cursor"] = cursor
+                return redirect(f"{reverse('inbox')}?{urlencode(params)}")
         except requests.RequestException as e:
             error_message = f"Failed to contact backend: {e}"
 
+    if job_call:
+        try:
+            job = job_call.result()
+        except requests.RequestException as e:
+            error_message = f"Failed to load job status: {e}"
+        if job and job["status"] == "done":
+            process_result = job["result"]
+            if process_result.get("actions_json") is not None:
+                actions_json_pretty = json.dumps(process_result["actions_json"], indent=2)
+        elif job and job["status"] == "failed":
+            error_message = f"Processing failed: {job.get('error')}"
+
     context = {
-        "emails": emails,
+        "emails": page["items"],
+        "total": page["total"],
+        "cursor": cursor,
+        "next_cursor": page["next_cursor"],
+        "query": query,
+        "category": category,
+        "categories": SEARCH_CATEGORIES,
         "selected_email": selected_email,
         "process_result": process_result,
         "actions_json_pretty": actions_json_pretty,
+        "job": job,
+        "job_pending": bool(job and job["status"] in ("queued", "running")),
         "error_message": error_message,
     }
     return render(request, "emails/inbox.html", context)
@@ -55,13 +116,6 @@ def inbox_view(request):
 
 def prompts_view(request):
     error_message = None
-    try:
-        resp = requests.get(f"{FLASK_API_BASE}/api/prompts", timeout=30)
-        resp.raise_for_status()
-        prompts = resp.json()
-    except requests.RequestException as e:
-        prompts = []
-        error_message = f"Failed to load prompts from backend: {e}"
 
     if request.method == "POST":
         name = request.POST.get("name")
@@ -69,10 +123,9 @@ def prompts_view(request):
         content = request.POST.get("content")
         if name and content:
             try:
-                requests.post(
-                    f"{FLASK_API_BASE}/api/prompts",
+                backend.post(
+                    "/api/prompts",
                     json={"name": name, "type": ptype, "content": content},
-                    timeout=60,
                 )
                 return redirect("prompts")
             except requests.RequestException as e:
@@ -80,6 +133,12 @@ def prompts_view(request):
         else:
             error_message = "Name and content are required."
 
+    try:
+        prompts = backend.get_json("/api/prompts")
+    except requests.RequestException as e:
+        prompts = []
+        error_message = error_message or f"Failed to load prompts from backend: {e}"
+
     return render(
         request,
         "emails/prompts.html",
@@ -89,62 +148,84 @@ def prompts_view(request):
 
 def drafts_view(request):
     error_message = None
+    cursor = request.GET.get("cursor")
+    params = {"limit": DRAFTS_PAGE_SIZE, "fields": DRAFTS_LIST_FIELDS}
+    if cursor:
+        params["cursor"] = cursor
     try:
-        resp = requests.get(f"{FLASK_API_BASE}/api/drafts", timeout=30)
-        resp.raise_for_status()
-        drafts = resp.json()
+        page = backend.get_json("/api/drafts", params=params)
     except requests.RequestException as e:
-        drafts = []
+        page = {"items": [], "next_cursor": None, "total_estimate": 0}
         error_message = f"Failed to load drafts from backend: {e}"
 
     return render(
         request,
         "emails/drafts.html",
-        {"drafts": drafts, "error_message": error_message},
+        {
+            "drafts": page["items"],
+            "cursor": cursor,
+            "next_cursor": page["next_cursor"],
+            "total_estimate": page["total_estimate"],
+            "error_message": error_message,
+        },
     )
 
 
-def agent_view(request, email_id):
-    # Load inbox to find email
+def _find_email(email_id):
+    """Return one inbox email by id, or None if the backend doesn't know it."""
+    try:
+        return backend.get_json(f"/api/inbox/{quote(str(email_id), safe='')}")
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return None
+        raise
+
+
+def _load_email(email_id):
     try:
-        inbox_resp = requests.get(f"{FLASK_API_BASE}/api/inbox", timeout=30)
-        inbox_resp.raise_for_status()
-        emails = inbox_resp.json()
+        email = _find_email(email_id)
     except requests.RequestException as e:
         raise Http404(f"Could not load inbox from backend: {e}")
 
-    email = next((e for e in emails if str(e.get("id")) == str(email_id)), None)
     if not email:
         raise Http404("Email not found")
+    return email
+
+
+def agent_view(request, email_id):
+    # The email and the prompts for the dropdown are independent: fetch both at once
+    email_call = backend.submit(_load_email, email_id)
+    prompts_call = backend.submit(backend.get_json, "/api/prompts")
 
-    # Load prompts for the dropdown
+    email = email_call.result()
     try:
-        p_resp = requests.get(f"{FLASK_API_BASE}/api/prompts", timeout=30)
-        p_resp.raise_for_status()
-        prompts = p_resp.json()
+        prompts = prompts_call.result()
     except requests.RequestException:
         prompts = []
 
     agent_reply = None
     selected_prompt_content = ""
     user_instruction = ""
+    fresh = False
     error_message = None
     success_message = None
 
     if request.method == "POST":
         selected_prompt_content = request.POST.get("prompt_content") or ""
         user_instruction = request.POST.get("instruction") or "Summarize this email."
+        fresh = "fresh" in request.POST
 
         # We run the agent for BOTH buttons (run_agent & save_draft)
         try:
-            agent_resp = requests.post(
-                f"{FLASK_API_BASE}/api/agent",
+            agent_resp = backend.post(
+                "/api/agent",
                 json={
                     "email": email,
                     "promptTemplate": selected_prompt_content,
                     "userInstruction": user_instruction,
+                    "fresh": fresh,
                 },
-                timeout=90,
+                timeout=backend.LLM_TIMEOUT,
             )
             data = agent_resp.json()
 
@@ -158,14 +239,13 @@ def agent_view(request, email_id):
 
                 # If they clicked "Run & Save as Draft", save via backend
                 if "save_draft" in request.POST and agent_reply:
-                    d_resp = requests.post(
-                        f"{FLASK_API_BASE}/api/drafts",
+                    d_resp = backend.post(
+                        "/api/drafts",
                         json={
                             "subject": f"Re: {email.get('subject', 'draft')}",
                             "body": agent_reply,
                             "meta": {"fromEmailId": email.get("id")},
                         },
-                        timeout=60,
                     )
                     if d_resp.status_code == 201:
                         success_message = "Draft saved successfully."
@@ -183,7 +263,78 @@ def agent_view(request, email_id):
         "agent_reply": agent_reply,
         "selected_prompt_content": selected_prompt_content,
         "user_instruction": user_instruction,
+        "fresh": fresh,
         "error_message": error_message,
         "success_message": success_message,
     }
     return render(request, "emails/agent.html", context)
+
+
+@require_POST
+def agent_stream_view(request, email_id):
+    """Relay the backend's SSE reply stream to the browser as it is generated."""
+    email = _load_email(email_id)
+    try:
+        upstream = backend.post(
+            "/api/agent/stream",
+            json={
+                "email": email,
+                "promptTemplate": request.POST.get("prompt_content") or "",
+                "userInstruction": request.POST.get("instruction") or "Summarize this email.",
+                "fresh": "fresh" in request.POST,
+            },
+            stream=True,
+            timeout=backend.LLM_TIMEOUT,  # read timeout is the max gap between chunks
+        )
+    except requests.RequestException as e:
+        return JsonResponse({"error": f"Failed to contact backend: {e}"}, status=502)
+
+    if upstream.status_code != 200:
+        try:
+            error = upstream.json().get("error")
+        except ValueError:
+            error = None
+        upstream.close()
+        return JsonResponse(
+            {"error": error or f"Backend error {upstream.status_code}"},
+            status=upstream.status_code,
+        )
+
+    def relay():
+        try:
+            for chunk in upstream.iter_content(chunk_size=None):
+                yield chunk
+        finally:
+            upstream.close()
+
+    response = StreamingHttpResponse(relay(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@require_POST
+def agent_save_draft_view(request, email_id):
+    """Save a reply that the browser assembled from the stream."""
+    body = request.POST.get("body")
+    if not body:
+        return JsonResponse({"error": "draft body is required"}, status=400)
+
+    try:
+        d_resp = backend.post(
+            "/api/drafts",
+            json={
+                "subject": request.POST.get("subject") or "Re: draft",
+                "body": body,
+                "meta": {"fromEmailId": email_id},
+            },
+        )
+    except requests.RequestException as e:
+        return JsonResponse({"error": f"Failed to contact backend: {e}"}, status=502)
+
+    if d_resp.status_code != 201:
+        return JsonResponse(
+            {"error": f"Draft save failed: {d_resp.status_code} {d_resp.text}"},
+            status=502,
+        )
+    return JsonResponse(d_resp.json(), status=201)